@@ -2,9 +2,12 @@ import flask; from flask import request
 from flask_login import LoginManager
 import random
 
+import recipedb
 
 from . import common
+from . import debug_endpoint
 from . import image_endpoint
+from . import metrics_endpoint
 from . import profile_endpoint
 from . import recipe_endpoint
 from . import register_endpoint
@@ -13,6 +16,13 @@ from . import register_endpoint
 site = common.site
 loginmanager = LoginManager(site)
 
+@loginmanager.user_loader
+def load_user(user_id):
+    try:
+        return common.rdb.get_user(id=user_id)
+    except recipedb.exceptions.NoSuchUser:
+        return None
+
 
 @site.route('/')
 def root():
@@ -23,13 +33,13 @@ def root():
 @site.route('/img/<imgid>')
 def get_img(imgid):
     img = common.rdb.get_image(imgid)
-    return flask.send_file(img.file_path)
+    return common.send_image(img)
 
 
 @site.route('/favicon.ico')
 @site.route('/favicon.png')
 def favicon():
-    return flask.send_file(common.FAVICON_PATH.absolute_path)
+    return common.send_file(common.FAVICON_PATH.absolute_path, max_age=site.config['SEND_FILE_MAX_AGE_DEFAULT'])
 
 
 if __name__ == '__main__':
@@ -1,6 +1,10 @@
 import flask; from flask import request
+import datetime
 import os
 import mimetypes
+import urllib.parse
+import werkzeug.http
+import werkzeug.wsgi
 
 import recipedb
 
@@ -8,6 +12,7 @@ from voussoirkit import pathclass
 
 from .. import jsonify
 from .. import jinja_filters
+from .. import sessions
 
 
 root_dir = pathclass.Path(__file__).parent.parent.parent
@@ -29,98 +34,291 @@ site.jinja_env.add_extension('jinja2.ext.do')
 site.jinja_env.trim_blocks = True
 site.jinja_env.lstrip_blocks = True
 site.jinja_env.filters['divmod'] = divmod
+site.jinja_env.filters['image_srcset'] = jinja_filters.image_srcset
 site.jinja_env.filters['split_paragraphs'] = jinja_filters.split_paragraphs
 site.jinja_env.filters['unix_to_human'] = jinja_filters.unix_to_human
 site.debug = True
 
 rdb = recipedb.RecipeDB()
 
-COOKIE_MAX_AGE = 7 * 24 * 60 * 60
+@site.teardown_request
+def release_database_connection(exception):
+    rdb.release_connection()
+
+RECIPES_PER_PAGE = 48
+RECIPES_PER_PAGE_MAX = 200
+
+# Files are read and sent this many bytes at a time when they can't be
+# handed to the server whole.
+FILE_BUFFER_SIZE = 2 ** 16
+# Cache-Control max-age for urls whose content never changes, one year.
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+# Range requests with more ranges than this are answered with the whole file.
+MAX_RANGES = 16
+
 COOKIE_NAME = 'cookie_name'
-cookie_dict = {}
+session_config = rdb.config['sessions']
+COOKIE_MAX_AGE = session_config['max_age']
+
+if session_config['backend'] == 'sqlite':
+    _session_store = sessions.SQLiteSessionStore(
+        rdb.data_directory.with_child(recipedb.constants.DEFAULT_SESSIONDB).absolute_path,
+        max_age=COOKIE_MAX_AGE,
+        sweep_interval=session_config['sweep_interval'],
+    )
+elif session_config['backend'] == 'signed':
+    _secret = session_config['secret'] or sessions.load_or_create_secret(
+        rdb.data_directory.with_child(recipedb.constants.DEFAULT_SESSIONSECRET).absolute_path
+    )
+    _session_store = sessions.SignedSessionStore(_secret, max_age=COOKIE_MAX_AGE)
+else:
+    raise ValueError('Unknown session backend %s.' % session_config['backend'])
+
+session_store = sessions.CachedSessionStore(
+    _session_store,
+    maxlen=session_config['cache_size'],
+    cache_seconds=session_config['cache_seconds'],
+)
 
 def back_url():
     return request.args.get('goto') or request.referrer or '/'
 
-def new_user_cookie(cookie_value, user):
-    cookie_dict[cookie_value] = user
+def end_session(request, response):
+    '''
+    Log out whoever the request's cookie belongs to.
+    '''
+    cookie_value = request.cookies.get(COOKIE_NAME, None)
+    if cookie_value:
+        session_store.delete(cookie_value)
+    response.delete_cookie(COOKIE_NAME)
 
 def get_user_from_cookie(cookie_value):
-    return cookie_dict.get(cookie_value, None)
+    if not cookie_value:
+        return None
+    session = session_store.get(cookie_value)
+    if session is None:
+        return None
+    (user_id, expires) = session
+    try:
+        return rdb.get_user(id=user_id)
+    except recipedb.exceptions.NoSuchUser:
+        return None
+
+def start_session(response, user):
+    '''
+    Log the user in by giving them a session cookie.
+    '''
+    cookie_value = session_store.new(user.id)
+    response.set_cookie(
+        COOKIE_NAME,
+        value=cookie_value,
+        max_age=COOKIE_MAX_AGE,
+        httponly=True,
+        samesite='Lax',
+    )
+
+def get_page_args():
+    '''
+    Read the `after` cursor and `limit` page size from the query string.
+    '''
+    after = request.args.get('after', None) or None
+    try:
+        limit = int(request.args.get('limit', RECIPES_PER_PAGE))
+    except ValueError:
+        flask.abort(400)
+    limit = max(1, min(limit, RECIPES_PER_PAGE_MAX))
+    return (after, limit)
+
+def paginate(results, limit):
+    '''
+    Given results which were fetched with `limit + 1`, return the page of
+    results to display and the url of the next page, or None if this is the
+    last page.
+    '''
+    if len(results) <= limit:
+        return (results, None)
+
+    results = results[:limit]
+    args = request.args.to_dict()
+    args['after'] = results[-1].page_cursor
+    next_url = request.path + '?' + urllib.parse.urlencode(args)
+    return (results, next_url)
+
+def get_image_size():
+    '''
+    Read the `size` query parameter, the height in pixels the image will be
+    displayed at, or None to send the original.
+    '''
+    size = request.args.get('size', None)
+    if size is None:
+        return None
+    if not size.isdigit() or int(size) < 1:
+        flask.abort(400)
+    return int(size)
 
 def get_session(request):
     cookie_check = request.cookies.get(COOKIE_NAME, None)
     return get_user_from_cookie(cookie_check)
 
-def send_file(filepath, override_mimetype=None):
+def _resolve_ranges(ranges, file_size):
     '''
-    Range-enabled file sending.
+    Turn the (start, stop) pairs of a Range header, where stop is exclusive
+    and a negative start counts from the end, into absolute spans within the
+    file. Unsatisfiable spans are dropped and overlapping ones are merged.
+    '''
+    spans = []
+    for (start, stop) in ranges:
+        if start < 0:
+            start = max(file_size + start, 0)
+            stop = file_size
+        else:
+            stop = file_size if stop is None else min(stop, file_size)
+        if start < stop:
+            spans.append((start, stop))
+
+    spans.sort()
+    merged = []
+    for (start, stop) in spans:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+def _read_spans(file, spans, separators=None):
+    '''
+    Yield the bytes of each (start, stop) span of the file, preceded by the
+    matching separator if given, then the final separator, and close the
+    file when done.
+    '''
+    with file:
+        for (index, (start, stop)) in enumerate(spans):
+            if separators is not None:
+                yield separators[index]
+            file.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = file.read(min(FILE_BUFFER_SIZE, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+        if separators is not None:
+            yield separators[-1]
+
+def send_file(filepath, *, max_age=None, immutable=False):
+    '''
+    Send a file from disk, supporting:
+
+    - ETag and Last-Modified validators, answering If-None-Match and
+      If-Modified-Since with 304 Not Modified;
+    - Cache-Control which is long-lived for files whose url always refers to
+      the same bytes (immutable), max_age seconds, or else revalidation on
+      every use;
+    - single and multiple byte ranges, with If-Range;
+    - handing whole files to the server's wsgi.file_wrapper, which under our
+      gevent server sends them with os.sendfile.
     '''
     try:
-        file_size = os.path.getsize(filepath)
+        stat = os.stat(filepath)
     except FileNotFoundError:
         flask.abort(404)
 
-    outgoing_headers = {}
-    if override_mimetype is not None:
-        mimetype = override_mimetype
-    else:
-        mimetype = mimetypes.guess_type(filepath)[0]
-
-    if mimetype is not None:
-        if 'text/' in mimetype:
-            mimetype += '; charset=utf-8'
-        outgoing_headers['Content-Type'] = mimetype
-
-    if 'range' in request.headers:
-        desired_range = request.headers['range'].lower()
-        desired_range = desired_range.split('bytes=')[-1]
-
-        int_helper = lambda x: int(x) if x.isdigit() else None
-        if '-' in desired_range:
-            (desired_min, desired_max) = desired_range.split('-')
-            range_min = int_helper(desired_min)
-            range_max = int_helper(desired_max)
-        else:
-            range_min = int_helper(desired_range)
-
-        if range_min is None:
-            range_min = 0
-        if range_max is None:
-            range_max = file_size
+    file_size = stat.st_size
+    last_modified = datetime.datetime.fromtimestamp(int(stat.st_mtime), datetime.timezone.utc)
+    etag = '%x-%x' % (stat.st_mtime_ns, file_size)
+    mimetype = mimetypes.guess_type(filepath)[0] or 'application/octet-stream'
 
-        # because ranges are 0-indexed
-        range_max = min(range_max, file_size - 1)
-        range_min = max(range_min, 0)
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': '"%s"' % etag,
+        'Last-Modified': werkzeug.http.http_date(last_modified),
+    }
+    if immutable:
+        headers['Cache-Control'] = 'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE
+    elif max_age is not None:
+        headers['Cache-Control'] = 'public, max-age=%d' % max_age
+    else:
+        headers['Cache-Control'] = 'no-cache'
 
-        range_header = 'bytes {min}-{max}/{outof}'.format(
-            min=range_min,
-            max=range_max,
-            outof=file_size,
-        )
-        outgoing_headers['Content-Range'] = range_header
-        status = 206
+    # If-None-Match takes precedence, and If-Modified-Since is ignored when
+    # it is present.
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
     else:
-        range_max = file_size - 1
-        range_min = 0
-        status = 200
+        not_modified = request.if_modified_since is not None and last_modified <= request.if_modified_since
+    if not_modified:
+        return flask.Response(status=304, headers=headers)
+
+    headers['Content-Type'] = mimetype
+    spans = None
+    if request.range is not None and request.range.units == 'bytes':
+        if_range = request.if_range
+        if if_range.etag is not None:
+            range_applies = if_range.etag == etag
+        elif if_range.date is not None:
+            range_applies = if_range.date == last_modified
+        else:
+            range_applies = True
+        # A long list of tiny ranges costs more to serve than the whole file.
+        if range_applies and len(request.range.ranges) <= MAX_RANGES:
+            spans = _resolve_ranges(request.range.ranges, file_size)
+            if not spans:
+                headers['Content-Range'] = 'bytes */%d' % file_size
+                return flask.Response(status=416, headers=headers)
 
-    outgoing_headers['Accept-Ranges'] = 'bytes'
-    outgoing_headers['Content-Length'] = (range_max - range_min) + 1
+    if spans is None:
+        headers['Content-Length'] = str(file_size)
+        if request.method == 'HEAD':
+            return flask.Response(status=200, headers=headers)
+        body = werkzeug.wsgi.wrap_file(request.environ, open(filepath, 'rb'), buffer_size=FILE_BUFFER_SIZE)
+        return flask.Response(body, status=200, headers=headers, direct_passthrough=True)
 
-    if request.method == 'HEAD':
-        outgoing_data = bytes()
+    if len(spans) == 1:
+        (start, stop) = spans[0]
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, file_size)
+        headers['Content-Length'] = str(stop - start)
+        separators = None
     else:
-        outgoing_data = recipedb.helpers.read_filebytes(
-            filepath,
-            range_min=range_min,
-            range_max=range_max,
-            chunk_size=P.config['file_read_chunk'],
+        boundary = recipedb.helpers.random_hex(length=32)
+        separators = [
+            (
+                '--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' %
+                (boundary, mimetype, start, stop - 1, file_size)
+            ).encode('ascii')
+            for (start, stop) in spans
+        ]
+        # Each part after the first starts on a new line.
+        separators[1:] = [b'\r\n' + separator for separator in separators[1:]]
+        separators.append(('\r\n--%s--\r\n' % boundary).encode('ascii'))
+        headers['Content-Type'] = 'multipart/byteranges; boundary=%s' % boundary
+        headers['Content-Length'] = str(
+            sum(len(separator) for separator in separators) +
+            sum(stop - start for (start, stop) in spans)
         )
 
-    response = flask.Response(
-        outgoing_data,
-        status=status,
-        headers=outgoing_headers,
-    )
-    return response
+    if request.method == 'HEAD':
+        return flask.Response(status=206, headers=headers)
+    body = _read_spans(open(filepath, 'rb'), spans, separators)
+    return flask.Response(body, status=206, headers=headers, direct_passthrough=True)
+
+def send_image(image, size=None):
+    '''
+    Send the image's original, or its rendition for the given size.
+
+    Only a ready image's files are named by their content, so only those are
+    sent as immutable. While the image is processing, the file is its source,
+    which is revalidated on every use. When a rendition can't be had and the
+    original stands in for it, a later request may get the rendition, so the
+    original is only cached briefly.
+    '''
+    is_ready = image.status == recipedb.constants.IMAGE_STATUS_READY
+    if size is None:
+        return send_file(image.file_path, immutable=is_ready)
+
+    filepath = image.get_rendition_path(size)
+    if not is_ready:
+        return send_file(filepath)
+    if filepath == image.file_path:
+        return send_file(filepath, max_age=site.config['SEND_FILE_MAX_AGE_DEFAULT'])
+    return send_file(filepath, immutable=True)
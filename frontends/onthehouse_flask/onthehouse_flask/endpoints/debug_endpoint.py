@@ -0,0 +1,90 @@
+import flask; from flask import request
+import time
+
+import recipedb
+
+from . import common
+
+from .. import jsonify
+from .. import profiling
+
+site = common.site
+
+# These only do anything when query_tracing or profiling are enabled in the
+# RecipeDB config.
+tracer = common.rdb.tracer
+
+profiling_config = dict(common.rdb.config['profiling'])
+if profiling_config.pop('enabled'):
+    profiler = profiling.RequestProfiler(
+        common.rdb.data_directory.with_child(recipedb.constants.DEFAULT_PROFILEDIR).absolute_path,
+        **profiling_config,
+    )
+else:
+    profiler = None
+
+
+@site.before_request
+def start_request_profile():
+    if profiler is None:
+        return
+    flask.g.profile_start = time.perf_counter()
+    flask.g.profile_capture = profiler.start(request.endpoint, token=request.headers.get('X-Profile-Token'))
+
+@site.after_request
+def note_request_profile_status(response):
+    if profiler is not None:
+        flask.g.profile_status = response.status_code
+    return response
+
+@site.teardown_request
+def finish_request_profile(exception):
+    if profiler is None or 'profile_start' not in flask.g:
+        return
+    profiler.finish(
+        flask.g.pop('profile_capture', None),
+        endpoint=request.endpoint,
+        description='%s %s' % (request.method, request.full_path.rstrip('?')),
+        elapsed=time.perf_counter() - flask.g.profile_start,
+        status=flask.g.get('profile_status', 500),
+    )
+
+
+@site.before_request
+def start_query_trace():
+    if tracer is not None:
+        tracer.start('%s %s' % (request.method, request.full_path.rstrip('?')))
+
+@site.after_request
+def finish_query_trace(response):
+    if tracer is None:
+        return response
+
+    trace = tracer.stop()
+    if trace is None:
+        return response
+
+    repeated = trace.repeated()
+    response.headers['X-Query-Count'] = str(trace.count)
+    response.headers['X-Query-Time'] = '%.3fms' % (trace.total_time * 1000)
+    response.headers['X-Query-Repeated'] = str(len(repeated))
+    for group in repeated:
+        common.rdb.log.warning(
+            '%s ran a statement %d times (%.3fms) from %s: %s',
+            trace.name,
+            group['count'],
+            group['total_time'] * 1000,
+            '; '.join(group['call_sites']),
+            group['statement'],
+        )
+    return response
+
+@site.route('/debug/queries')
+def get_query_traces():
+    if tracer is None:
+        flask.abort(404)
+
+    traces = [trace.jsonify() for trace in reversed(tracer.recent)]
+    if request.args.get('repeated_only'):
+        traces = [trace for trace in traces if trace['repeated']]
+    return jsonify.make_json_response(traces)
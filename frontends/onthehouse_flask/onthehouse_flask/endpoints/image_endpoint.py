@@ -2,11 +2,37 @@ import flask; from flask import request, render_template
 
 from . import common
 
+from .. import jsonify
+
 site = common.site
 
+# The longest a status request may wait for an image to finish processing.
+MAX_STATUS_WAIT = 30
+
 
 @site.route('/image/<image_id>')
 @site.route('/user/<image_id>.<ext>')
 def get_image(image_id, ext=None):
     image = common.rdb.get_image(id=image_id)
-    return flask.send_file(image.file_path)
+    return common.send_image(image, common.get_image_size())
+
+@site.route('/image/<image_id>/status')
+def get_image_status(image_id):
+    '''
+    Report whether the image has finished processing. With ?wait=seconds,
+    wait up to that long for it to finish first.
+    '''
+    image = common.rdb.get_image(id=image_id)
+    wait = request.args.get('wait', None)
+    if wait is not None:
+        try:
+            wait = min(float(wait), MAX_STATUS_WAIT)
+        except ValueError:
+            flask.abort(400)
+        if image.is_processing:
+            # Waiting can take a while, and shouldn't keep a read connection
+            # from other requests. The lookup below leases one again.
+            common.rdb.release_connection()
+            image.wait(timeout=max(0, wait))
+            image = common.rdb.get_image(id=image_id)
+    return jsonify.make_json_response({'id': image.id, 'status': image.status})
@@ -0,0 +1,46 @@
+import flask; from flask import request
+import time
+
+import recipedb
+
+from . import common
+
+site = common.site
+
+# Any other method is recorded as 'other', since the method is chosen by the
+# client and each distinct value would become a new label.
+KNOWN_METHODS = {'DELETE', 'GET', 'HEAD', 'OPTIONS', 'PATCH', 'POST', 'PUT'}
+
+REQUEST_SECONDS = recipedb.metrics.REGISTRY.histogram(
+    'onthehouse_request_seconds',
+    'Time spent handling each request, by endpoint.',
+    labels=['endpoint', 'method'],
+)
+RESPONSES = recipedb.metrics.REGISTRY.counter(
+    'onthehouse_responses_total',
+    'Responses sent, by endpoint and status code.',
+    labels=['endpoint', 'status'],
+)
+
+
+@site.before_request
+def start_request_timer():
+    flask.g.request_start = time.perf_counter()
+
+@site.after_request
+def record_request_metrics(response):
+    start = flask.g.get('request_start')
+    # Requests that matched no route are grouped together, so that scanning
+    # for random urls can't create unlimited label values.
+    endpoint = request.endpoint or 'unmatched'
+    method = request.method if request.method in KNOWN_METHODS else 'other'
+    if start is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint, method)
+    RESPONSES.inc(endpoint, response.status_code)
+    return response
+
+@site.route('/metrics')
+def get_metrics():
+    response = flask.Response(recipedb.metrics.REGISTRY.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
@@ -8,7 +8,7 @@ site = common.site
 @site.route('/user/<username>')
 def get_user(username):
     user = common.rdb.get_user(username = username)
-    recipes = common.rdb.search(author=user)
+    recipes = common.rdb.search(author=user, prefetch=['image'])
     response = render_template("profile.html", user=user, recipes=recipes, session_user=common.get_session(request))
     return response
 
@@ -18,10 +18,13 @@ def get_user(username):
 def get_profile_pic(username, ext=None):
     user = common.rdb.get_user(username=username)
     if user.profile_pic:
-        return flask.send_file(user.profile_pic.file_path)
+        size = common.get_image_size()
+        if size is None:
+            return common.send_file(user.profile_pic.file_path)
+        return common.send_file(user.profile_pic.get_rendition_path(size))
     else:
         path = common.STATIC_DIR.with_child('default_profile_pic.jpg').absolute_path
-        return flask.send_file(path)
+        return common.send_file(path, max_age=site.config['SEND_FILE_MAX_AGE_DEFAULT'])
 
 @site.route('/user')
 def user():
@@ -1,4 +1,4 @@
-from flask import request, render_template
+import flask; from flask import request, render_template
 
 import recipedb
 
@@ -11,14 +11,25 @@ site = common.site
 @site.route('/recipe/<recipeid>/<slug>')
 def get_recipe(recipeid, slug=None):
     recipe = common.rdb.get_recipe(recipeid)
+    common.rdb.prefetch([recipe], ['author', 'image', 'ingredients'])
     response = render_template("recipe.html", recipe=recipe, session_user=common.get_session(request))
     return response
 
 
 @site.route('/recipe')
 def recipes():
-    recipes = common.rdb.get_recipes()
-    response = render_template("recipes.html", recipes=recipes, session_user=common.get_session(request))
+    (after, limit) = common.get_page_args()
+    try:
+        recipes = common.rdb.get_recipes(after=after, limit=limit + 1, prefetch=['image'])
+    except ValueError:
+        flask.abort(400)
+    (recipes, next_url) = common.paginate(recipes, limit)
+    response = render_template(
+        "recipes.html",
+        recipes=recipes,
+        next_url=next_url,
+        session_user=common.get_session(request),
+    )
     return response
 
 
@@ -27,15 +38,30 @@ def recipes_search():
     ingredients = request.args.get('ingredients', None)
     ingredients_exclude = request.args.get('exclude', None)
     meal_type = request.args.get('meal_type', None)
+    text = request.args.get('q', None)
     strict_ingredients = request.args.get('strict', False)
     strict_ingredients = recipedb.helpers.truthystring(strict_ingredients)
+    (after, limit) = common.get_page_args()
 
-    results = common.rdb.search(
-        ingredients=ingredients,
-        ingredients_exclude=ingredients_exclude,
-        meal_type=meal_type,
-        strict_ingredients=strict_ingredients,
-    )
+    try:
+        results = common.rdb.search(
+            after=after,
+            ingredients=ingredients,
+            ingredients_exclude=ingredients_exclude,
+            limit=limit + 1,
+            meal_type=meal_type,
+            prefetch=['image'],
+            strict_ingredients=strict_ingredients,
+            text=text,
+        )
+    except ValueError:
+        flask.abort(400)
+    (results, next_url) = common.paginate(results, limit)
 
-    response = render_template("recipes.html", recipes=results, session_user=common.get_session(request))
+    response = render_template(
+        "recipes.html",
+        recipes=results,
+        next_url=next_url,
+        session_user=common.get_session(request),
+    )
     return response
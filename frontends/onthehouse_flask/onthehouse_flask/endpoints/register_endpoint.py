@@ -27,14 +27,13 @@ def post_login():
         flask.abort(403)
 
     response = jsonify.make_json_response({'username': user.username})
-    cookie_value = recipedb.helpers.random_hex(length=32)
-    response.set_cookie(
-        common.COOKIE_NAME,
-        value=cookie_value,
-        max_age=common.COOKIE_MAX_AGE,
-    )
-    common.new_user_cookie(cookie_value, user)
+    common.start_session(response, user)
+    return response
 
+@site.route('/logout', methods=['POST'])
+def post_logout():
+    response = jsonify.make_json_response({})
+    common.end_session(request, response)
     return response
 
 @site.route('/register', methods=['POST'])
@@ -59,13 +58,5 @@ def post_register():
     )
 
     response = jsonify.make_json_response({'username': user.username})
-
-    cookie_value = recipedb.helpers.random_hex(length=32)
-    response.set_cookie(
-        common.COOKIE_NAME,
-        value=cookie_value,
-        max_age=common.COOKIE_MAX_AGE,
-    )
-    common.new_user_cookie(cookie_value, user)
-
+    common.start_session(response, user)
     return response
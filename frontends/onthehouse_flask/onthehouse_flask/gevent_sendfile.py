@@ -0,0 +1,88 @@
+'''
+A gevent WSGI handler which sends files with os.sendfile, so that image
+bytes go from the page cache to the socket without passing through Python.
+
+gevent.pywsgi doesn't offer wsgi.file_wrapper, and gevent's socket.sendfile
+deliberately avoids os.sendfile because a blocking call would stall every
+greenlet. Our sockets are non-blocking underneath, so here os.sendfile sends
+what fits in the socket buffer and the greenlet waits for the socket to be
+writable again, like any other gevent I/O.
+
+    gevent.pywsgi.WSGIServer(listener, application, handler_class=SendfileWSGIHandler)
+'''
+import os
+
+import gevent.pywsgi
+import gevent.socket
+
+# The most os.sendfile is asked to send in one call.
+SENDFILE_CHUNK_SIZE = 2 ** 20
+
+
+class FileWrapper:
+    '''
+    The wsgi.file_wrapper given to applications. When the application
+    returns one, the handler sends the file with os.sendfile. Middleware
+    which iterates it instead gets the file's contents in blocks.
+    '''
+    def __init__(self, filelike, block_size=8192):
+        self.filelike = filelike
+        self.block_size = block_size
+
+    def __iter__(self):
+        while True:
+            block = self.filelike.read(self.block_size)
+            if not block:
+                return
+            yield block
+
+    def close(self):
+        close = getattr(self.filelike, 'close', None)
+        if close is not None:
+            close()
+
+
+class SendfileWSGIHandler(gevent.pywsgi.WSGIHandler):
+    def get_environ(self):
+        environ = super().get_environ()
+        environ['wsgi.file_wrapper'] = FileWrapper
+        return environ
+
+    def _can_sendfile(self):
+        if not hasattr(os, 'sendfile') or not isinstance(self.result, FileWrapper):
+            return False
+        # Without a Content-Length the response would be chunked, which
+        # os.sendfile can't produce.
+        if self.provided_content_length is None or self.code in (204, 304):
+            return False
+        try:
+            self.result.filelike.fileno()
+        except (AttributeError, OSError, ValueError):
+            return False
+        return True
+
+    def process_result(self):
+        if not self._can_sendfile():
+            return super().process_result()
+
+        # Writing nothing sends the headers.
+        self.write(b'')
+
+        file = self.result.filelike
+        in_fd = file.fileno()
+        out_fd = self.socket.fileno()
+        offset = file.tell()
+        remaining = int(self.provided_content_length)
+        while remaining > 0:
+            try:
+                sent = os.sendfile(out_fd, in_fd, offset, min(remaining, SENDFILE_CHUNK_SIZE))
+            except BlockingIOError:
+                gevent.socket.wait_write(out_fd, timeout=self.socket.gettimeout())
+                continue
+            if sent == 0:
+                # The file is shorter than the Content-Length said. The client
+                # will see a short response, same as the iterating path.
+                break
+            offset += sent
+            remaining -= sent
+            self.response_length += sent
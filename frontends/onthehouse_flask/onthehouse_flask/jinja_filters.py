@@ -4,6 +4,19 @@ Instead of `length(items)`, filter calls look like `items|length`
 '''
 import datetime
 
+def image_srcset(image):
+    '''
+    List every version of the image with its width, for an <img srcset>, so
+    the browser can fetch the smallest one that is sharp enough on its screen.
+    '''
+    candidates = []
+    for (size, width) in image.get_rendition_sizes():
+        url = '/image/%s' % image.id
+        if size is not None:
+            url += '?size=%d' % size
+        candidates.append('%s %dw' % (url, width))
+    return ', '.join(candidates)
+
 def split_paragraphs(text):
     paragraphs = text.strip().split('\n\n')
     paragraphs = [p.replace('\n', ' ') for p in paragraphs]
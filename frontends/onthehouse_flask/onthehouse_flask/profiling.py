@@ -0,0 +1,214 @@
+'''
+Capture cProfile and tracemalloc snapshots of individual web requests, so
+that a slow page can be broken down into SQL, object construction and
+template rendering without redeploying.
+
+Each capture is written to the profiles directory as a pair of files with
+the same name: a .prof file which pstats or snakeviz can load, and a .txt
+summary with the request, the slowest functions and the biggest
+allocations. Only the newest `max_captures` pairs are kept.
+
+cProfile profiles the thread that enabled it. Under gevent every request
+runs in greenlets on the same thread, so a capture also records whatever
+other greenlets ran while the request was waiting on I/O. Captures are
+still taken one at a time, but such captures say so in their summary, and
+the time spent in another request's functions is not this request's.
+'''
+import cProfile
+import hmac
+import io
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import tracemalloc
+
+try:
+    import gevent.monkey
+except ImportError:
+    gevent = None
+
+log = logging.getLogger(__name__)
+
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 25
+
+def _gevent_patched():
+    return gevent is not None and gevent.monkey.is_module_patched('threading')
+
+def _safe_filename(text):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', text).strip('_')[:80]
+
+
+class Capture:
+    def __init__(self, reason, trace_memory):
+        self.reason = reason
+        self.profile = cProfile.Profile()
+        # tracemalloc is process-wide, so only stop it if we started it.
+        self.started_tracemalloc = trace_memory and not tracemalloc.is_tracing()
+        if self.started_tracemalloc:
+            tracemalloc.start()
+        self.trace_memory = trace_memory
+        # See the top of this file.
+        self.includes_other_greenlets = _gevent_patched()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.snapshot = None
+        self.peak_memory = None
+        if self.trace_memory:
+            self.snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            ])
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+
+
+class RequestProfiler:
+    '''
+    Decides which requests to capture:
+
+    - a random `sample_rate` fraction of all requests;
+    - after a request takes longer than `slow_threshold` seconds, the next
+      `profile_after_slow` requests to the same endpoint, since the slow one
+      has already happened by the time we know it was slow;
+    - any request carrying the configured token in its X-Profile-Token
+      header, for profiling on demand.
+
+    Only one request is captured at a time, because the profilers would
+    otherwise measure each other's requests. Note that memory allocations
+    from other requests running concurrently do show up in a snapshot, and
+    under gevent so do their function calls.
+    '''
+    def __init__(
+            self,
+            directory,
+            *,
+            max_captures=100,
+            profile_after_slow=3,
+            sample_rate=0.0,
+            slow_threshold=1.0,
+            token='',
+            trace_memory=True,
+        ):
+        self.directory = directory
+        self.max_captures = max_captures
+        self.profile_after_slow = profile_after_slow
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.token = token
+        self.trace_memory = trace_memory
+
+        self.armed_endpoints = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _token_matches(self, token):
+        # Compared in constant time, so that the token can't be guessed a
+        # character at a time from how long a request takes. Bytes, because
+        # compare_digest refuses non-ASCII strings.
+        return hmac.compare_digest(token.encode('utf-8'), self.token.encode('utf-8'))
+
+    def _choose_reason(self, endpoint, token):
+        if self.token and token is not None and self._token_matches(token):
+            return 'token'
+        if self.armed_endpoints.get(endpoint):
+            return 'after_slow'
+        if self.sample_rate and random.random() < self.sample_rate:
+            return 'sampled'
+        return None
+
+    def start(self, endpoint, token=None):
+        '''
+        Return a Capture if this request should be profiled, else None.
+        '''
+        reason = self._choose_reason(endpoint, token)
+        if reason is None:
+            return None
+        if not self._lock.acquire(blocking=False):
+            return None
+        # Only used up once the capture is certain to happen, so that
+        # requests which arrive during another capture don't use up the
+        # ones meant for after a slow request.
+        if reason == 'after_slow':
+            if not self.armed_endpoints.get(endpoint):
+                self._lock.release()
+                return None
+            self.armed_endpoints[endpoint] -= 1
+        try:
+            return Capture(reason, trace_memory=self.trace_memory)
+        except Exception:
+            self._lock.release()
+            raise
+
+    def finish(self, capture, *, endpoint, description, elapsed, status):
+        '''
+        Stop the capture if there is one and write it out. If the request was
+        slow and not captured, arm the endpoint so the next ones will be.
+        '''
+        if capture is None:
+            if endpoint is not None and elapsed >= self.slow_threshold and self.profile_after_slow:
+                log.warning(
+                    '%s took %.3fs, profiling the next %d requests to %s.',
+                    description, elapsed, self.profile_after_slow, endpoint,
+                )
+                self.armed_endpoints[endpoint] = self.profile_after_slow
+            return None
+
+        try:
+            capture.stop()
+            return self._write(capture, endpoint=endpoint, description=description, elapsed=elapsed, status=status)
+        finally:
+            self._lock.release()
+
+    def _write(self, capture, *, endpoint, description, elapsed, status):
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime()) + '-%06d' % (time.time() % 1 * 1000000)
+        basename = '%s_%s_%dms' % (stamp, _safe_filename(endpoint or 'unmatched'), elapsed * 1000)
+        basepath = os.path.join(self.directory, basename)
+
+        capture.profile.dump_stats(basepath + '.prof')
+
+        summary = io.StringIO()
+        summary.write('%s\n' % description)
+        summary.write('status: %s\n' % status)
+        summary.write('elapsed: %.6fs\n' % elapsed)
+        summary.write('reason: %s\n' % capture.reason)
+        if capture.includes_other_greenlets:
+            summary.write('note: includes other greenlets which ran during the request\n')
+        if capture.peak_memory is not None:
+            summary.write('peak traced memory: %d bytes\n' % capture.peak_memory)
+
+        summary.write('\n== Functions by cumulative time ==\n')
+        stats = pstats.Stats(capture.profile, stream=summary)
+        stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+
+        if capture.snapshot is not None:
+            summary.write('\n== Allocations by line ==\n')
+            for stat in capture.snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                summary.write('%s\n' % stat)
+
+        with open(basepath + '.txt', 'w', encoding='utf-8') as handle:
+            handle.write(summary.getvalue())
+
+        self._rotate()
+        log.info('Wrote request profile %s', basepath)
+        return basepath
+
+    def _rotate(self):
+        # Filenames start with the timestamp, so sorting them is oldest first.
+        captures = sorted(
+            name[:-len('.prof')] for name in os.listdir(self.directory)
+            if name.endswith('.prof')
+        )
+        for name in captures[:max(0, len(captures) - self.max_captures)]:
+            for extension in ['.prof', '.txt']:
+                try:
+                    os.remove(os.path.join(self.directory, name + extension))
+                except FileNotFoundError:
+                    pass
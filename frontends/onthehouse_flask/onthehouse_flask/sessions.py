@@ -0,0 +1,219 @@
+'''
+Session stores, which remember which user a login cookie belongs to.
+
+The cookie holds a token which the store maps to a UserID, never to a User
+object, so the user is always looked up fresh through RecipeDB's cache.
+
+- SQLiteSessionStore keeps sessions in their own SQLite database in the data
+  directory, so logins survive restarts, are shared by every process
+  serving the same data, and end when the user logs out.
+- SignedSessionStore keeps nothing. The token is the UserID and the time it
+  was issued, signed with a secret which every process shares. There is
+  nothing to look up or sweep, but a token can't be revoked before it
+  expires, so logging out only removes the cookie.
+
+CachedSessionStore sits in front of either one and remembers recent lookups
+for a few seconds, so that most requests don't touch the database or check
+a signature. A logout in another process takes up to that long to be seen.
+'''
+import hashlib
+import itsdangerous
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from recipedb import caching
+
+SESSION_DB_INIT = '''
+CREATE TABLE IF NOT EXISTS Session(
+    TokenHash TEXT PRIMARY KEY,
+    UserID TEXT NOT NULL,
+    Created INT NOT NULL,
+    Expires INT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS index_Session_Expires on Session(Expires);
+'''
+
+# Mixed into the signature so that these tokens can't be confused with
+# anything else signed with the same secret.
+SIGNED_TOKEN_SALT = 'onthehouse-session'
+
+def load_or_create_secret(filepath):
+    '''
+    Return the secret in the file, creating it with a random one if it
+    doesn't exist yet. Every process serving the same data directory agrees
+    on the secret, even if they start at the same time.
+    '''
+    try:
+        with open(filepath, 'r') as handle:
+            return handle.read().strip()
+    except FileNotFoundError:
+        pass
+
+    (handle, temp_filepath) = tempfile.mkstemp(dir=os.path.dirname(filepath), suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'w') as file:
+            file.write(os.urandom(32).hex())
+        # Linking fails if another process got there first, in which case
+        # theirs is the secret.
+        os.link(temp_filepath, filepath)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(temp_filepath)
+
+    with open(filepath, 'r') as handle:
+        return handle.read().strip()
+
+
+class SessionStore:
+    '''
+    Sessions last `max_age` seconds from when they are created.
+    '''
+    def __init__(self, max_age):
+        self.max_age = max_age
+
+    def delete(self, token):
+        raise NotImplementedError
+
+    def get(self, token):
+        '''
+        Return (user_id, expires) for the token, where expires is a unix
+        timestamp, or None if it is unknown or has expired.
+        '''
+        raise NotImplementedError
+
+    def new(self, user_id):
+        '''
+        Start a session for the user and return its token.
+        '''
+        raise NotImplementedError
+
+    def sweep(self):
+        '''
+        Forget expired sessions and return how many there were.
+        '''
+        return 0
+
+
+class SQLiteSessionStore(SessionStore):
+    '''
+    Only a hash of each token is stored, so that a copy of the database
+    can't be used to log in.
+
+    Expired sessions are swept out at most every `sweep_interval` seconds,
+    when a new session is created, rather than by a background thread.
+    '''
+    def __init__(self, filepath, *, max_age, sweep_interval=3600):
+        super().__init__(max_age)
+        self.filepath = filepath
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0
+        self._lock = threading.Lock()
+
+        # Every statement is a single row, so autocommit is enough. WAL lets
+        # other processes read while one of them writes.
+        self._sql = sqlite3.connect(filepath, check_same_thread=False, isolation_level=None)
+        self._sql.execute('PRAGMA busy_timeout = 5000')
+        self._sql.execute('PRAGMA journal_mode = WAL')
+        self._sql.execute('PRAGMA synchronous = NORMAL')
+        self._sql.executescript(SESSION_DB_INIT)
+
+    @staticmethod
+    def _hash_token(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def close(self):
+        with self._lock:
+            self._sql.close()
+
+    def delete(self, token):
+        with self._lock:
+            self._sql.execute('DELETE FROM Session WHERE TokenHash = ?', [self._hash_token(token)])
+
+    def get(self, token):
+        with self._lock:
+            row = self._sql.execute(
+                'SELECT UserID, Expires FROM Session WHERE TokenHash = ? AND Expires > ?',
+                [self._hash_token(token), int(time.time())]
+            ).fetchone()
+        return row
+
+    def new(self, user_id):
+        token = os.urandom(32).hex()
+        now = int(time.time())
+        with self._lock:
+            self._sql.execute(
+                'INSERT INTO Session VALUES(?, ?, ?, ?)',
+                [self._hash_token(token), user_id, now, now + self.max_age]
+            )
+        if now - self._last_sweep >= self.sweep_interval:
+            self.sweep()
+        return token
+
+    def sweep(self):
+        now = int(time.time())
+        self._last_sweep = now
+        with self._lock:
+            cur = self._sql.execute('DELETE FROM Session WHERE Expires <= ?', [now])
+        return cur.rowcount
+
+
+class SignedSessionStore(SessionStore):
+    def __init__(self, secret, *, max_age):
+        super().__init__(max_age)
+        self._serializer = itsdangerous.URLSafeTimedSerializer(secret, salt=SIGNED_TOKEN_SALT)
+
+    def delete(self, token):
+        # The token stays valid until it expires. See the top of this file.
+        pass
+
+    def get(self, token):
+        try:
+            (user_id, issued) = self._serializer.loads(token, max_age=self.max_age, return_timestamp=True)
+        except itsdangerous.BadData:
+            return None
+        return (user_id, int(issued.timestamp()) + self.max_age)
+
+    def new(self, user_id):
+        return self._serializer.dumps(user_id)
+
+
+class CachedSessionStore(SessionStore):
+    '''
+    Remembers the last `maxlen` lookups, each for at most `cache_seconds`,
+    so that a request doesn't have to ask the store behind it. Unknown
+    tokens aren't remembered, since they are rarely asked about twice.
+    '''
+    def __init__(self, store, *, maxlen=1000, cache_seconds=60):
+        super().__init__(store.max_age)
+        self.store = store
+        self.cache_seconds = cache_seconds
+        self.cache = caching.ObjectCache(maxlen=maxlen)
+
+    def delete(self, token):
+        self.cache.remove(token)
+        self.store.delete(token)
+
+    def get(self, token):
+        now = time.time()
+        cached = self.cache.get(token)
+        if cached is not None:
+            (session, cached_until) = cached
+            if now < cached_until:
+                return session
+            self.cache.remove(token)
+
+        session = self.store.get(token)
+        if session is not None:
+            (user_id, expires) = session
+            self.cache[token] = (session, min(now + self.cache_seconds, expires))
+        return session
+
+    def new(self, user_id):
+        return self.store.new(user_id)
+
+    def sweep(self):
+        return self.store.sweep()
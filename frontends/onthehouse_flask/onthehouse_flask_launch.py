@@ -8,6 +8,7 @@ handler.setFormatter(logging.Formatter(log_format, style='{'))
 logging.getLogger().addHandler(handler)
 
 import onthehouse_flask
+import onthehouse_flask.gevent_sendfile
 import gevent.pywsgi
 import sys
 
@@ -23,6 +24,7 @@ else:
 http = gevent.pywsgi.WSGIServer(
     listener=('0.0.0.0', port),
     application=onthehouse_flask.site,
+    handler_class=onthehouse_flask.gevent_sendfile.SendfileWSGIHandler,
 )
 
 
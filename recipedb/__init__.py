@@ -1,8 +1,13 @@
+from . import caching
+from . import connections
 from . import constants
 from . import decorators
 from . import exceptions
 from . import helpers
+from . import images
+from . import metrics
 from . import objects
 from . import recipedb
+from . import tracing
 
 RecipeDB = recipedb.RecipeDB
@@ -0,0 +1,72 @@
+'''
+This file contains the object cache that RecipeDB uses as an identity map, so
+that frequently used rows like popular tags and prolific authors are not
+queried and reconstructed on every access.
+'''
+import collections
+import threading
+
+
+class ObjectCache:
+    '''
+    A mapping which holds at most `maxlen` items, evicting the least recently
+    used item when it is full. Hits and misses are counted so that the size
+    can be tuned from the config file.
+
+    A maxlen of 0 disables the cache, so every lookup is a miss.
+
+    The cache is shared by every thread using the RecipeDB, so each
+    operation holds a lock.
+    '''
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self.hits = 0
+        self.misses = 0
+        self._dict = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._dict
+
+    def __len__(self):
+        return len(self._dict)
+
+    def __setitem__(self, key, value):
+        if self.maxlen <= 0:
+            return
+
+        with self._lock:
+            self._dict[key] = value
+            self._dict.move_to_end(key)
+            while len(self._dict) > self.maxlen:
+                self._dict.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._dict.clear()
+
+    def get(self, key, fallback=None):
+        with self._lock:
+            try:
+                value = self._dict[key]
+                self._dict.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return fallback
+
+            self.hits += 1
+            return value
+
+    def remove(self, key):
+        with self._lock:
+            self._dict.pop(key, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._dict),
+            'maxlen': self.maxlen,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits / lookups) if lookups else None,
+        }
@@ -0,0 +1,175 @@
+'''
+This file contains the connection manager that lets RecipeDB be shared by
+many threads or greenlets, such as the gevent server's request handlers.
+'''
+import re
+import sqlite3
+import threading
+
+from . import exceptions
+
+# Settings which belong to the database file rather than the connection.
+# They are applied by the writer only, page_size first since it can't be
+# changed once the database is in WAL mode.
+DATABASE_PRAGMAS = ['page_size', 'journal_mode']
+
+# PRAGMA statements can't take bindings, so values from the config file are
+# checked against this before being formatted in.
+PRAGMA_VALUE_PATTERN = re.compile(r'^-?[A-Za-z0-9_]+$')
+
+
+class ConnectionPool:
+    '''
+    Hands out connections to a single SQLite database file.
+
+    There is one writer connection, which may only be used by whoever holds
+    `write_lock`. Reads go through read-only connections, each leased to one
+    thread at a time and kept by that thread until it calls `release`. At
+    most `max_readers` connections are leased at once; further threads wait
+    for one to be released, so a thread which is about to wait on something
+    other than the database should release its connection first. The
+    leases are only read or changed under `_lease_lock`.
+
+    Because the database is in WAL mode, readers see the last committed
+    state and are not blocked by the writer.
+
+    pragmas: A dict of PRAGMA name to value which is applied to every
+    connection when it is opened.
+
+    factory: The sqlite3.Connection subclass to create, as for
+    sqlite3.connect.
+
+    reader_timeout: Seconds to wait for a read connection before raising
+    NoFreeReadConnection, or None to wait forever.
+    '''
+    def __init__(self, filepath, max_readers, pragmas=None, factory=sqlite3.Connection, reader_timeout=None):
+        if pragmas is None:
+            pragmas = {}
+        for (name, value) in pragmas.items():
+            if not PRAGMA_VALUE_PATTERN.match(name) or not PRAGMA_VALUE_PATTERN.match(str(value)):
+                raise ValueError('Invalid sqlite setting %s = %s' % (name, value))
+
+        self.filepath = filepath
+        self.max_readers = max_readers
+        self.reader_timeout = reader_timeout
+        self.pragmas = pragmas
+        self.factory = factory
+        self.connect_hooks = []
+        self.write_lock = threading.RLock()
+        self.writer = self._connect()
+
+        self._idle_readers = []
+        self._leases = {}
+        self._lease_lock = threading.Lock()
+        self._reader_slots = threading.BoundedSemaphore(max_readers)
+        # How many times a thread had to wait for another to release a
+        # reader, a sign that max_readers is too low.
+        self.reader_waits = 0
+
+    def _connect(self, readonly=False):
+        # Connections are created on one thread and leased to others, which
+        # is safe as long as only one thread uses each at a time.
+        connection = sqlite3.connect(self.filepath, check_same_thread=False, factory=self.factory)
+        for (name, value) in self.pragmas.items():
+            if name in DATABASE_PRAGMAS:
+                continue
+            connection.execute('PRAGMA %s = %s' % (name, value))
+
+        if readonly:
+            connection.execute('PRAGMA query_only = ON')
+        else:
+            for name in DATABASE_PRAGMAS:
+                if name in self.pragmas:
+                    connection.execute('PRAGMA %s = %s' % (name, self.pragmas[name]))
+
+        for hook in self.connect_hooks:
+            hook(connection)
+        return connection
+
+    def add_connect_hook(self, function):
+        '''
+        Call function(connection) on every connection, both those already
+        open and those opened later. Useful for instrumentation such as
+        sqlite3's set_trace_callback.
+        '''
+        self.connect_hooks.append(function)
+        with self._lease_lock:
+            connections = [self.writer] + self._idle_readers + list(self._leases.values())
+        for connection in connections:
+            function(connection)
+
+    def close(self):
+        with self._lease_lock:
+            readers = self._idle_readers + list(self._leases.values())
+            self._idle_readers.clear()
+            self._leases.clear()
+        for connection in readers:
+            connection.close()
+        self.writer.close()
+
+    def get_pragmas(self):
+        '''
+        Return the values SQLite is actually using for each configured
+        setting, which may differ from the config if SQLite rejected one.
+        '''
+        return {
+            name: self.writer.execute('PRAGMA %s' % name).fetchone()[0]
+            for name in self.pragmas
+        }
+
+    def stats(self):
+        with self._lease_lock:
+            return {
+                'leased': len(self._leases),
+                'idle': len(self._idle_readers),
+                'max_readers': self.max_readers,
+                'reader_waits': self.reader_waits,
+            }
+
+    def reader(self):
+        '''
+        Return the read connection leased to the current thread, leasing one
+        if it does not have one yet.
+        '''
+        ident = threading.get_ident()
+        with self._lease_lock:
+            connection = self._leases.get(ident)
+        if connection is not None:
+            return connection
+
+        if not self._reader_slots.acquire(blocking=False):
+            with self._lease_lock:
+                self.reader_waits += 1
+            # Waiting forever would hang the thread if leases are leaking.
+            if not self._reader_slots.acquire(timeout=self.reader_timeout):
+                raise exceptions.NoFreeReadConnection(
+                    max_readers=self.max_readers,
+                    timeout=self.reader_timeout,
+                )
+        with self._lease_lock:
+            if self._idle_readers:
+                connection = self._idle_readers.pop()
+        if connection is None:
+            connection = self._connect(readonly=True)
+
+        with self._lease_lock:
+            self._leases[ident] = connection
+        return connection
+
+    def release(self):
+        '''
+        Return the current thread's read connection to the pool, if it has
+        one. Threads that are finished with the database, like a request
+        handler at the end of the request, should call this.
+        '''
+        with self._lease_lock:
+            connection = self._leases.pop(threading.get_ident(), None)
+        if connection is None:
+            return
+
+        if connection.in_transaction:
+            connection.rollback()
+
+        with self._lease_lock:
+            self._idle_readers.append(connection)
+        self._reader_slots.release()
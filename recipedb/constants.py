@@ -14,18 +14,24 @@ FILENAME_BADCHARS = '\\/:*?<>|"'
 # Note: Setting user_version pragma in init sequence is safe because it only
 # happens after the out-of-date check occurs, so no chance of accidentally
 # overwriting it.
-DATABASE_VERSION = 1
+DATABASE_VERSION = 9
 DB_INIT = '''
-PRAGMA count_changes = OFF;
-PRAGMA cache_size = 10000;
 PRAGMA user_version = {user_version};
 
 ----------------------------------------------------------------------------------------------------
 CREATE TABLE IF NOT EXISTS Image(
     ImageID TEXT PRIMARY KEY,
-    ImageFilePath TEXT
+    ImageFilePath TEXT,
+    Hash TEXT,
+    ByteSize INT,
+    MimeType TEXT,
+    Status TEXT,
+    Width INT,
+    Height INT
 );
 CREATE INDEX IF NOT EXISTS index_Image_ImageID on Image(ImageID);
+CREATE INDEX IF NOT EXISTS index_Image_Hash on Image(Hash);
+CREATE INDEX IF NOT EXISTS index_Image_Processing on Image(ImageID) WHERE Status = 'processing';
 ----------------------------------------------------------------------------------------------------
 CREATE TABLE IF NOT EXISTS Image_Recipe_Map(
     RecipeID TEXT,
@@ -53,6 +59,18 @@ CREATE TABLE IF NOT EXISTS IngredientTag(
     TagName TEXT COLLATE NOCASE,
     ParentTagID TEXT
 );
+CREATE INDEX IF NOT EXISTS index_IngredientTag_TagName on IngredientTag(TagName);
+CREATE INDEX IF NOT EXISTS index_IngredientTag_ParentTagID on IngredientTag(ParentTagID);
+----------------------------------------------------------------------------------------------------
+CREATE TABLE IF NOT EXISTS IngredientTag_Closure(
+    AncestorID TEXT,
+    DescendantID TEXT,
+    Depth INT,
+    FOREIGN KEY(AncestorID) REFERENCES IngredientTag(IngredientTagID),
+    FOREIGN KEY(DescendantID) REFERENCES IngredientTag(IngredientTagID)
+);
+CREATE INDEX IF NOT EXISTS index_IngredientTagClosure_AncestorID on IngredientTag_Closure(AncestorID, DescendantID);
+CREATE INDEX IF NOT EXISTS index_IngredientTagClosure_DescendantID on IngredientTag_Closure(DescendantID, AncestorID);
 ----------------------------------------------------------------------------------------------------
 CREATE TABLE IF NOT EXISTS Ingredient_IngredientTag_Map(
     IngredientID TEXT,
@@ -61,6 +79,7 @@ CREATE TABLE IF NOT EXISTS Ingredient_IngredientTag_Map(
     FOREIGN KEY(IngredientTagID) REFERENCES IngredientTag(IngredientTagID)
 );
 CREATE INDEX IF NOT EXISTS index_IngredientIngredientTagMap_IngredientID on Ingredient_IngredientTag_Map(IngredientID);
+CREATE INDEX IF NOT EXISTS index_IngredientIngredientTagMap_IngredientTagID on Ingredient_IngredientTag_Map(IngredientTagID);
 ----------------------------------------------------------------------------------------------------
 CREATE TABLE IF NOT EXISTS Recipe(
     RecipeID TEXT PRIMARY KEY,
@@ -80,6 +99,37 @@ CREATE TABLE IF NOT EXISTS Recipe(
     FOREIGN KEY(AuthorID) REFERENCES User(UserID)
 );
 CREATE INDEX IF NOT EXISTS index_Recipe_RecipeID on Recipe(RecipeID);
+CREATE INDEX IF NOT EXISTS index_Recipe_DateAdded on Recipe(DateAdded, RecipeID);
+CREATE INDEX IF NOT EXISTS index_Recipe_AuthorID on Recipe(AuthorID, DateAdded, RecipeID);
+CREATE INDEX IF NOT EXISTS index_Recipe_CountryOfOrigin on Recipe(CountryOfOrigin, DateAdded, RecipeID);
+CREATE INDEX IF NOT EXISTS index_Recipe_Cuisine on Recipe(Cuisine, DateAdded, RecipeID);
+CREATE INDEX IF NOT EXISTS index_Recipe_MealType on Recipe(MealType, DateAdded, RecipeID);
+----------------------------------------------------------------------------------------------------
+-- Full-text index over the recipe text, kept in sync with Recipe by the
+-- triggers below. It holds its own copy of the text, keyed by RecipeID,
+-- because Recipe's implicit rowids are not stable across VACUUM.
+CREATE VIRTUAL TABLE IF NOT EXISTS Recipe_FTS USING fts5(
+    RecipeID UNINDEXED,
+    Name,
+    Blurb,
+    Instructions,
+    tokenize='porter unicode61'
+);
+CREATE TRIGGER IF NOT EXISTS trigger_Recipe_FTS_insert AFTER INSERT ON Recipe
+BEGIN
+    INSERT INTO Recipe_FTS(RecipeID, Name, Blurb, Instructions)
+    VALUES (new.RecipeID, new.Name, new.Blurb, new.Instructions);
+END;
+CREATE TRIGGER IF NOT EXISTS trigger_Recipe_FTS_delete AFTER DELETE ON Recipe
+BEGIN
+    DELETE FROM Recipe_FTS WHERE RecipeID = old.RecipeID;
+END;
+CREATE TRIGGER IF NOT EXISTS trigger_Recipe_FTS_update AFTER UPDATE OF Name, Blurb, Instructions ON Recipe
+BEGIN
+    DELETE FROM Recipe_FTS WHERE RecipeID = old.RecipeID;
+    INSERT INTO Recipe_FTS(RecipeID, Name, Blurb, Instructions)
+    VALUES (new.RecipeID, new.Name, new.Blurb, new.Instructions);
+END;
 ----------------------------------------------------------------------------------------------------
 CREATE TABLE IF NOT EXISTS Recipe_Ingredient_Map(
     RecipeID TEXT,
@@ -90,8 +140,8 @@ CREATE TABLE IF NOT EXISTS Recipe_Ingredient_Map(
     FOREIGN KEY(RecipeID) REFERENCES Recipe(RecipeID),
     FOREIGN KEY(IngredientID) REFERENCES Ingredient(IngredientID)
 );
-CREATE INDEX IF NOT EXISTS index_RecipeIngredientMap_RecipeID on Recipe_Ingredient_Map(RecipeID);
-CREATE INDEX IF NOT EXISTS index_RecipeIngredientMap_IngredientID on Recipe_Ingredient_Map(IngredientID);
+CREATE INDEX IF NOT EXISTS index_RecipeIngredientMap_RecipeID on Recipe_Ingredient_Map(RecipeID, IngredientID);
+CREATE INDEX IF NOT EXISTS index_RecipeIngredientMap_IngredientID on Recipe_Ingredient_Map(IngredientID, RecipeID);
 ----------------------------------------------------------------------------------------------------
 CREATE TABLE IF NOT EXISTS Review(
     ReviewID TEXT PRIMARY KEY,
@@ -137,6 +187,10 @@ CREATE INDEX IF NOT EXISTS index_UserFollowingMap_UserID on User_Following_Map(U
 CREATE INDEX IF NOT EXISTS index_UserFollowingMap_TargetID on User_Following_Map(TargetID);
 '''.format(user_version=DATABASE_VERSION)
 
+# Older builds of SQLite refuse statements with more than 999 bindings, so
+# large `IN (...)` queries are split into chunks of this size.
+SQL_MAX_BINDINGS = 999
+
 def _extract_column_names(table):
     statement = DB_INIT.split('CREATE TABLE IF NOT EXISTS %s(' % table)[1]
     statement = statement.split(');')[0]
@@ -151,6 +205,7 @@ SQL_IMAGE_COLUMNS = _extract_column_names('Image')
 SQL_INGREDIENT_COLUMNS = _extract_column_names('Ingredient')
 SQL_INGREDIENTAUTOCORRECT_COLUMNS = _extract_column_names('IngredientAutocorrect')
 SQL_INGREDIENTTAG_COLUMNS = _extract_column_names('IngredientTag')
+SQL_INGREDIENTTAGCLOSURE_COLUMNS = _extract_column_names('IngredientTag_Closure')
 SQL_INGREDIENTINGREDIENTTAG_COLUMNS = _extract_column_names('Ingredient_IngredientTag_Map')
 SQL_RECIPE_COLUMNS = _extract_column_names('Recipe')
 SQL_RECIPEINGREDIENT_COLUMNS = _extract_column_names('Recipe_Ingredient_Map')
@@ -164,6 +219,30 @@ DEFAULT_DATADIR = '.\\_recipedb'
 DEFAULT_DBNAME = 'recipe.db'
 DEFAULT_CONFIGNAME = 'config.json'
 DEFAULT_IMAGEDIR = 'images'
+DEFAULT_PROFILEDIR = 'profiles'
+DEFAULT_SESSIONDB = 'sessions.db'
+DEFAULT_SESSIONSECRET = 'session_secret'
+
+# Heights in pixels of the resized copies made of every image, matching the
+# sizes the pages display them at. See images.py.
+IMAGE_RENDITION_HEIGHTS = [120, 240, 400, 800]
+IMAGE_RENDITION_FORMAT = 'jpg'
+IMAGE_RENDITION_PIL_FORMAT = 'JPEG'
+IMAGE_RENDITION_QUALITY = 82
+
+# An image is 'processing' from the moment it is registered until its file
+# has been stored and its renditions made in the background, then 'ready',
+# or 'failed' if its file could not be read. See ingest.py.
+IMAGE_STATUS_FAILED = 'failed'
+IMAGE_STATUS_PROCESSING = 'processing'
+IMAGE_STATUS_READY = 'ready'
+
+# Separates the values inside a page cursor, see helpers.make_page_cursor.
+PAGE_CURSOR_SEPARATOR = '~'
+
+# bm25 column weights for Recipe_FTS(RecipeID, Name, Blurb, Instructions).
+# A hit in the name counts for more than a hit in the instructions.
+FTS_COLUMN_WEIGHTS = (0.0, 10.0, 4.0, 1.0)
 
 USERNAME_CHARACTERS = set(string.ascii_letters + string.digits + '_-')
 USERNAME_MAXLENGTH = 24
@@ -171,5 +250,72 @@ USERNAME_MINLENGTH = 1
 PASSWORD_MINLENGTH = 1
 
 DEFAULT_CONFIGURATION = {
+    # Maximum number of objects of each type held in RecipeDB's identity map.
+    # Set to 0 to disable caching for that type.
+    'cache_size': {
+        'image': 1000,
+        'ingredient': 2000,
+        'ingredient_tag': 500,
+        'user': 1000,
+    },
+    # Number of threads storing and resizing new images in the background.
+    'ingest_workers': 2,
     'log_level': logging.DEBUG,
+    # Used by the web frontend to capture cProfile and tracemalloc snapshots
+    # of requests into the profiles directory. sample_rate is the fraction
+    # of requests captured at random. A request slower than slow_threshold
+    # seconds makes the next profile_after_slow requests to the same page be
+    # captured. Requests with an X-Profile-Token header equal to a non-empty
+    # token are always captured.
+    'profiling': {
+        'enabled': False,
+        'max_captures': 100,
+        'profile_after_slow': 3,
+        'sample_rate': 0.01,
+        'slow_threshold': 1.0,
+        'token': '',
+        'trace_memory': True,
+    },
+    # Record every statement with its duration and call site, grouped into
+    # traces such as one per web request. Statements run at least
+    # repeat_threshold times in one trace are reported as likely N+1 loops.
+    # This slows every query down, so leave it off in production.
+    'query_tracing': {
+        'enabled': False,
+        'keep_recent': 50,
+        'repeat_threshold': 5,
+    },
+    # Login sessions of the web frontend. backend is 'sqlite', which keeps
+    # them in sessions.db in the data directory, or 'signed', which keeps
+    # nothing and signs the cookie instead, so logging out can't revoke it.
+    # If secret is empty, one is generated into session_secret in the data
+    # directory. A login lasts max_age seconds. The last cache_size lookups
+    # are remembered for cache_seconds, which is also how long a logout
+    # takes to reach other processes.
+    'sessions': {
+        'backend': 'sqlite',
+        'cache_seconds': 60,
+        'cache_size': 1000,
+        'max_age': 7 * 24 * 60 * 60,
+        'secret': '',
+        'sweep_interval': 3600,
+    },
+    # Applied to every connection RecipeDB opens. page_size only takes effect
+    # when the database is first created, and journal_mode is set by the
+    # writer connection alone. Readers rely on 'wal' to run during writes.
+    'sqlite': {
+        'busy_timeout': 5000,
+        'cache_size': -64000,
+        'journal_mode': 'wal',
+        'mmap_size': 268435456,
+        'page_size': 4096,
+        'synchronous': 'normal',
+        'temp_store': 'memory',
+    },
+    # Maximum number of read-only connections that may be leased to threads
+    # or greenlets at once. Writes always go through a single connection.
+    'max_read_connections': 16,
+    # Seconds a thread waits for a read connection when all of them are
+    # leased, before raising NoFreeReadConnection.
+    'read_connection_timeout': 30,
 }
@@ -5,16 +5,41 @@ or class methods.
 import functools
 import time
 
+from . import metrics
+
 
 def time_me(function):
     '''
-    After the function is run, print the elapsed time.
+    Record each call's duration, and whether it raised, in the metrics
+    registry under the function's qualified name.
     '''
+    # Bound once here, so a call costs two clock reads and an observe. The
+    # clock reads are most of that, so the overhead depends on how fast the
+    # machine's clock is rather than on anything here.
+    observe_ns = metrics.CALL_SECONDS.labels(function.__qualname__).observe_ns
+    errors = metrics.CALL_ERRORS.labels(function.__qualname__)
+    perf_counter_ns = time.perf_counter_ns
     @functools.wraps(function)
     def timed_function(*args, **kwargs):
-        start = time.time()
-        result = function(*args, **kwargs)
-        end = time.time()
-        print('%s: %0.8f' % (function.__name__, end-start))
-        return result
+        start = perf_counter_ns()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            observe_ns(perf_counter_ns() - start)
     return timed_function
+
+def transaction(method):
+    '''
+    Run the method inside a RecipeDB transaction, so that its writes go
+    through the writer connection and are committed together, or not at all.
+    Works on methods of RecipeDB and of the objects which belong to one.
+    '''
+    @functools.wraps(method)
+    def wrapped_transaction(self, *args, **kwargs):
+        recipedb = getattr(self, 'recipedb', self)
+        with recipedb.transaction():
+            return method(self, *args, **kwargs)
+    return wrapped_transaction
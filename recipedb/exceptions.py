@@ -60,11 +60,22 @@ class DatabaseOutOfDate(RecipeDBException):
     '''
     error_message = OUTOFDATE
 
+class NoFreeReadConnection(RecipeDBException):
+    '''
+    Raised when a thread waits too long for a read connection, because every
+    one of them is leased. Usually a sign that threads aren't releasing their
+    connections when they finish.
+    '''
+    error_message = 'All {max_readers} read connections stayed leased for {timeout} seconds.'
+
 ################################################################################
 
 class AlreadyHasParent(RecipeDBException):
     error_message = 'Tag "{tag}" already has parent "{parent}".'
 
+class RecursiveGrouping(RecipeDBException):
+    error_message = 'Tag "{tag}" cannot be grouped under its own descendant "{parent}".'
+
 ################################################################################
 
 class InvalidUsername(RecipeDBException):
@@ -12,6 +12,29 @@ from . import constants
 from . import exceptions
 
 
+def chunk_sequence(sequence, chunk_length):
+    '''
+    Yield successive slices of the sequence, each no longer than chunk_length.
+    Useful for keeping `IN (...)` queries under SQLite's binding limit.
+    '''
+    for index in range(0, len(sequence), chunk_length):
+        yield sequence[index:index + chunk_length]
+
+def chunk_iterable(iterable, chunk_length):
+    '''
+    Yield successive lists of up to chunk_length items from any iterable,
+    so that generators can be processed in batches without loading them
+    all into memory.
+    '''
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_length:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
 def now(timestamp=True):
     '''
     Return the current UTC timestamp or datetime object.
@@ -21,31 +44,33 @@ def now(timestamp=True):
         return n.timestamp()
     return n
 
-def random_hex(length=12):
-    randbytes = os.urandom(math.ceil(length / 2))
-    token = ''.join('{:02x}'.format(x) for x in randbytes)
-    token = token[:length]
-    return token
+def make_page_cursor(score, relevance, date_added, recipe_id):
+    '''
+    Build the token that marks a position in a keyset-paginated list of
+    recipes. Results are ordered by ingredient score, text relevance,
+    DateAdded and RecipeID, all descending, so these four values are enough
+    to resume after any recipe.
+    '''
+    values = [str(score), repr(float(relevance)), repr(float(date_added)), recipe_id]
+    return constants.PAGE_CURSOR_SEPARATOR.join(values)
 
-def read_filebytes(filepath, range_min, range_max, chunk_size=2 ** 20):
+def parse_page_cursor(cursor):
     '''
-    Yield chunks of bytes from the file between the endpoints.
+    Return the (score, relevance, date_added, recipe_id) tuple from a page
+    cursor. Raises ValueError if the cursor is malformed.
     '''
-    range_span = range_max - range_min
+    parts = cursor.split(constants.PAGE_CURSOR_SEPARATOR)
+    if len(parts) != 4:
+        raise ValueError('Malformed page cursor %s.' % repr(cursor))
 
-    #print('read span', range_min, range_max, range_span)
-    f = open(filepath, 'rb')
-    f.seek(range_min)
-    sent_amount = 0
-    with f:
-        while sent_amount < range_span:
-            #print(sent_amount)
-            chunk = f.read(chunk_size)
-            if len(chunk) == 0:
-                break
+    (score, relevance, date_added, recipe_id) = parts
+    return (int(score), float(relevance), float(date_added), recipe_id)
 
-            yield chunk
-            sent_amount += len(chunk)
+def random_hex(length=12):
+    randbytes = os.urandom(math.ceil(length / 2))
+    token = ''.join('{:02x}'.format(x) for x in randbytes)
+    token = token[:length]
+    return token
 
 def recursive_dict_update(d1, d2):
     '''
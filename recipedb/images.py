@@ -0,0 +1,328 @@
+'''
+This file contains the image storage and rendition pipeline.
+
+Uploaded files are stored by content: the name is the sha256 of the bytes,
+fanned out into two levels of subdirectories by its first four hex digits,
+so uploading the same file twice stores it once. Images with the same hash
+share the file. Nothing counts how many images use a file, so stored files
+and their renditions are never deleted, even when no image uses them.
+
+Renditions are the smaller re-encoded copies that pages display instead of
+the original. They are stored next to the original with the target height
+in the filename, so images/ab/cd/abcd...ef.png has
+images/ab/cd/abcd...ef.240.jpg.
+
+Pillow is optional. Without it no renditions are made and the original is
+served at every size.
+'''
+import hashlib
+import logging
+import math
+import mimetypes
+import os
+import struct
+import tempfile
+
+try:
+    import PIL.Image
+    import PIL.ImageOps
+except ImportError:
+    PIL = None
+
+from . import constants
+
+log = logging.getLogger(__name__)
+
+# What a corrupt, truncated or unsupported file can raise from Pillow.
+if PIL is not None:
+    RENDITION_ERRORS = (OSError, ValueError, PIL.Image.DecompressionBombError)
+else:
+    RENDITION_ERRORS = (OSError, ValueError)
+
+# Files are copied in chunks of this many bytes, hashing as they go.
+COPY_CHUNK_SIZE = 2 ** 20
+
+# Leading bytes of the formats we expect, checked before trusting the
+# uploaded filename's extension.
+MAGIC_NUMBERS = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+]
+
+MIMETYPE_EXTENSIONS = {
+    'image/bmp': 'bmp',
+    'image/gif': 'gif',
+    'image/jpeg': 'jpg',
+    'image/png': 'png',
+    'image/webp': 'webp',
+}
+
+def sniff_mimetype(header, filename=None):
+    '''
+    Return the mimetype of a file from its first bytes, falling back to its
+    filename's extension.
+    '''
+    for (magic, mimetype) in MAGIC_NUMBERS:
+        if header.startswith(magic):
+            return mimetype
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    if filename is not None:
+        return mimetypes.guess_type(filename)[0]
+    return None
+
+# JPEG Start Of Frame markers, whose segment holds the image's dimensions.
+# 0xC4, 0xC8 and 0xCC share the range but mean something else.
+JPEG_SOF_MARKERS = {
+    0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+    0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF,
+}
+# Markers which stand alone, without a length and segment after them.
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8}
+
+# EXIF orientations which rotate the image a quarter turn, so that it is
+# displayed with its width and height swapped.
+EXIF_TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+def _exif_orientation(tiff):
+    '''
+    Return the Orientation tag from the TIFF structure inside a JPEG's EXIF
+    segment, or 1, the upright default, if it has none.
+    '''
+    if tiff[:2] == b'II':
+        endian = '<'
+    elif tiff[:2] == b'MM':
+        endian = '>'
+    else:
+        return 1
+    try:
+        ifd_offset = struct.unpack(endian + 'I', tiff[4:8])[0]
+        entry_count = struct.unpack(endian + 'H', tiff[ifd_offset:ifd_offset + 2])[0]
+        for index in range(entry_count):
+            start = ifd_offset + 2 + (index * 12)
+            (tag, kind, count, value) = struct.unpack(endian + 'HHIH', tiff[start:start + 10])
+            if tag == 0x0112:
+                return value
+    except struct.error:
+        pass
+    return 1
+
+def _read_jpeg_dimensions(handle):
+    '''
+    Walk the segments at the start of the JPEG until the Start Of Frame,
+    noting the EXIF orientation on the way, without reading any of the
+    compressed image data.
+    '''
+    handle.seek(2)
+    transposed = False
+    while True:
+        byte = handle.read(1)
+        if byte != b'\xff':
+            return None
+        marker = handle.read(1)
+        # Any number of 0xFF may pad the space between segments.
+        while marker == b'\xff':
+            marker = handle.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        # End Of Image or Start Of Scan before a frame header.
+        if marker in (0xD9, 0xDA):
+            return None
+
+        length = struct.unpack('>H', handle.read(2))[0]
+        if marker in JPEG_SOF_MARKERS:
+            (height, width) = struct.unpack('>xHH', handle.read(5))
+            if transposed:
+                return (height, width)
+            return (width, height)
+        if marker == 0xE1:
+            segment = handle.read(length - 2)
+            if segment.startswith(b'Exif\x00\x00'):
+                transposed = _exif_orientation(segment[6:]) in EXIF_TRANSPOSED_ORIENTATIONS
+        else:
+            handle.seek(length - 2, os.SEEK_CUR)
+
+def read_image_header(filepath):
+    '''
+    Return (mimetype, width, height) of the image from the first bytes of
+    the file, without decoding it. Width and height are as displayed, after
+    any EXIF rotation, and are None if the format is one we can't read them
+    from or the header is damaged.
+    '''
+    with open(filepath, 'rb') as handle:
+        header = handle.read(32)
+        mimetype = sniff_mimetype(header, filepath)
+        dimensions = None
+        try:
+            if mimetype == 'image/jpeg' and header.startswith(b'\xff\xd8'):
+                dimensions = _read_jpeg_dimensions(handle)
+            elif mimetype == 'image/png' and header[12:16] == b'IHDR':
+                dimensions = struct.unpack('>II', header[16:24])
+            elif mimetype == 'image/gif' and header.startswith(b'GIF'):
+                dimensions = struct.unpack('<HH', header[6:10])
+            elif mimetype == 'image/bmp' and header.startswith(b'BM'):
+                (width, height) = struct.unpack('<ii', header[18:26])
+                # A negative height means the rows are stored top down.
+                dimensions = (width, abs(height))
+        except struct.error:
+            dimensions = None
+
+    if not dimensions or min(dimensions) < 1:
+        return (mimetype, None, None)
+    return (mimetype, dimensions[0], dimensions[1])
+
+def blob_filepath(directory, hash, extension):
+    return os.path.join(directory, hash[0:2], hash[2:4], '%s.%s' % (hash, extension))
+
+def _hash_stream(source, destination=None):
+    '''
+    Read the source file to the end, writing it to destination if given, and
+    return (hash, byte_size, header) where header is the first few bytes.
+    '''
+    hasher = hashlib.sha256()
+    byte_size = 0
+    header = b''
+    while True:
+        chunk = source.read(COPY_CHUNK_SIZE)
+        if not chunk:
+            break
+        if not header:
+            header = chunk[:32]
+        hasher.update(chunk)
+        if destination is not None:
+            destination.write(chunk)
+        byte_size += len(chunk)
+    return (hasher.hexdigest(), byte_size, header)
+
+def hash_file(filepath):
+    '''
+    Return (hash, byte_size, mimetype) of an existing file.
+    '''
+    with open(filepath, 'rb') as handle:
+        (hash, byte_size, header) = _hash_stream(handle)
+    return (hash, byte_size, sniff_mimetype(header, filepath))
+
+def store_file(source_filepath, directory):
+    '''
+    Copy the file into the content-addressed store under `directory`, hashing
+    it on the way, and return (filepath, hash, byte_size, mimetype).
+
+    If the store already has a file with the same hash, the copy is thrown
+    away and the existing file's path is returned.
+    '''
+    (handle, temp_filepath) = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with open(source_filepath, 'rb') as source, os.fdopen(handle, 'wb') as destination:
+            (hash, byte_size, header) = _hash_stream(source, destination)
+
+        mimetype = sniff_mimetype(header, source_filepath)
+        extension = MIMETYPE_EXTENSIONS.get(mimetype)
+        if extension is None:
+            extension = os.path.splitext(source_filepath)[1].lstrip('.').lower() or 'bin'
+
+        filepath = blob_filepath(directory, hash, extension)
+        if os.path.isfile(filepath):
+            os.remove(temp_filepath)
+        else:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            os.replace(temp_filepath, filepath)
+    except BaseException:
+        if os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+        raise
+
+    return (filepath, hash, byte_size, mimetype)
+
+def rendition_filepath(original_filepath, height):
+    (base, extension) = os.path.splitext(original_filepath)
+    return '%s.%d.%s' % (base, height, constants.IMAGE_RENDITION_FORMAT)
+
+def choose_rendition_height(size):
+    '''
+    Return the smallest rendition height which is at least `size` pixels,
+    or None if the original should be used.
+    '''
+    for height in constants.IMAGE_RENDITION_HEIGHTS:
+        if height >= size:
+            return height
+    return None
+
+def make_rendition(original_filepath, height):
+    '''
+    Write the rendition of the original with the given height and return its
+    filepath. Images shorter than the height are re-encoded but not enlarged.
+
+    The file is written under a temporary name and renamed into place, so a
+    concurrent request never sees a partial file.
+    '''
+    if PIL is None:
+        raise RuntimeError('Pillow is not installed.')
+
+    filepath = rendition_filepath(original_filepath, height)
+    with PIL.Image.open(original_filepath) as image:
+        # Let the JPEG decoder skip detail we're about to throw away. The
+        # shorter side is scaled to `height` because EXIF rotation may yet
+        # turn it into the height.
+        scale = height / max(min(image.size), 1)
+        if scale < 1:
+            image.draft('RGB', (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+        image = PIL.ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = PIL.Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.thumbnail((image.width, height), PIL.Image.LANCZOS)
+
+        (handle, temp_filepath) = tempfile.mkstemp(dir=os.path.dirname(filepath), suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                image.save(
+                    file,
+                    format=constants.IMAGE_RENDITION_PIL_FORMAT,
+                    quality=constants.IMAGE_RENDITION_QUALITY,
+                    optimize=True,
+                )
+            os.replace(temp_filepath, filepath)
+        except Exception:
+            os.remove(temp_filepath)
+            raise
+    return filepath
+
+def ingest_file(source_filepath, directory):
+    '''
+    Store the file and make all of its renditions, returning the same as
+    store_file. This is the slow part of adding an image, which the ingest
+    pool runs in the background.
+
+    Renditions are only made for heights below the original's, since the
+    others would be the original again, re-encoded. The original is served
+    for those sizes instead. See Image.get_rendition_path.
+
+    If the file can't be resized, because it is corrupt or not an image
+    Pillow understands, it is still stored and the original is served at
+    every size.
+    '''
+    (filepath, hash, byte_size, mimetype) = store_file(source_filepath, directory)
+    if PIL is not None:
+        original_height = read_image_header(filepath)[2]
+        for height in constants.IMAGE_RENDITION_HEIGHTS:
+            if original_height is not None and height >= original_height:
+                break
+            if os.path.isfile(rendition_filepath(filepath, height)):
+                continue
+            try:
+                make_rendition(filepath, height)
+            except RENDITION_ERRORS:
+                # The other sizes would fail the same way.
+                log.warning('Could not make renditions of %s.', filepath, exc_info=True)
+                break
+    return (filepath, hash, byte_size, mimetype)
@@ -0,0 +1,75 @@
+'''
+This file contains the worker pool that processes new images in the
+background: copying them into the content-addressed store, hashing them
+and making their renditions. See RecipeDB.new_image.
+
+The work runs on native threads. Copying, hashing and Pillow's resizing
+spend most of their time outside the GIL, so threads are enough to keep it
+off the caller's back without the cost of pickling to a process pool.
+
+When the process has been monkeypatched by gevent, the pool uses gevent's
+own thread pool, because a patched ThreadPoolExecutor would run the work in
+greenlets on the event loop. Either way the `on_done` callback, which
+writes the result to the database, runs in the same kind of context as the
+rest of the program: a thread normally, a greenlet under gevent.
+'''
+import concurrent.futures
+import logging
+
+try:
+    import gevent
+    import gevent.monkey
+    import gevent.threadpool
+except ImportError:
+    gevent = None
+
+log = logging.getLogger(__name__)
+
+def _gevent_patched():
+    return gevent is not None and gevent.monkey.is_module_patched('threading')
+
+
+class IngestPool:
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._executor = None
+
+    def _get_executor(self):
+        # Created on first use, so that a process which is monkeypatched
+        # after importing recipedb still gets the right kind of pool.
+        if self._executor is None:
+            if _gevent_patched():
+                self._executor = gevent.threadpool.ThreadPoolExecutor(self.max_workers)
+            else:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    self.max_workers,
+                    thread_name_prefix='recipedb-ingest',
+                )
+        return self._executor
+
+    def submit(self, function, *args, on_done):
+        '''
+        Run function(*args) on a worker, then call on_done(future) with its
+        finished future.
+        '''
+        future = self._get_executor().submit(function, *args)
+        if _gevent_patched():
+            # gevent calls this from the hub, which must not block, and
+            # on_done takes the database's write lock.
+            future.add_done_callback(lambda future: gevent.spawn(self._call, on_done, future))
+        else:
+            future.add_done_callback(lambda future: self._call(on_done, future))
+        return future
+
+    def _call(self, on_done, future):
+        # Exceptions from done callbacks are swallowed by both kinds of
+        # executor, so log them here instead.
+        try:
+            on_done(future)
+        except Exception:
+            log.exception('Ingest callback %s failed.', on_done)
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
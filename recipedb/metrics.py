@@ -0,0 +1,251 @@
+'''
+This file contains the metrics registry: counters and latency histograms
+which are cheap enough to record on every call in production, rendered in
+the Prometheus text format for scraping.
+
+Recording a value is a bisect and a couple of list increments. Everything
+else, such as turning the bucket counts into cumulative samples, happens
+when the metrics are rendered.
+
+Timing a call with decorators.time_me costs between half a microsecond and
+a microsecond, depending on the machine, and most of that is the two clock
+reads. That is small next to a query, but too much for something called in
+a tight loop, so only methods which do real work should be timed.
+
+Recording takes no lock, because an uncontended lock would cost more than
+everything else put together. Under the GIL a thread switch in the middle
+of an increment can occasionally lose one observation, which is acceptable
+for monitoring. Greenlets are never switched in the middle of one.
+'''
+import bisect
+import threading
+import weakref
+
+# Upper bounds in seconds, from sub-millisecond cache hits to slow searches.
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_sample(name, labels, value):
+    if labels:
+        label_string = ','.join(
+            '%s="%s"' % (key, _escape_label_value(value))
+            for (key, value) in labels.items()
+        )
+        name = '%s{%s}' % (name, label_string)
+    return '%s %s' % (name, value)
+
+
+class _LabeledMetric:
+    '''
+    The values of a metric, one child per combination of label values.
+    Callers on a hot path should hold on to the child returned by `labels`
+    rather than looking it up on every call.
+    '''
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *label_values):
+        child = self._children.get(label_values)
+        if child is not None:
+            return child
+        with self._lock:
+            return self._children.setdefault(label_values, self._new_child())
+
+    def _items(self):
+        with self._lock:
+            return [
+                (dict(zip(self.label_names, label_values)), child)
+                for (label_values, child) in self._children.items()
+            ]
+
+
+class _CounterChild:
+    __slots__ = ['value']
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(_LabeledMetric):
+    '''
+    A value per combination of labels which only goes up.
+    '''
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, *label_values, amount=1):
+        self.labels(*label_values).inc(amount)
+
+    def samples(self):
+        for (labels, child) in self._items():
+            yield (self.name, labels, child.value)
+
+
+class _HistogramChild:
+    __slots__ = ['buckets', 'buckets_ns', 'counts', 'sum', 'sum_ns']
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # The same bounds in integer nanoseconds, for durations measured with
+        # time.perf_counter_ns, which avoids float arithmetic on the way in.
+        self.buckets_ns = tuple(round(bound * 1e9) for bound in buckets)
+        # One count per bucket, then the count above the last bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.sum_ns = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def observe_ns(self, nanoseconds):
+        self.counts[bisect.bisect_left(self.buckets_ns, nanoseconds)] += 1
+        self.sum_ns += nanoseconds
+
+
+class Histogram(_LabeledMetric):
+    '''
+    Counts observations into fixed buckets per combination of labels, along
+    with their sum, so that percentiles and averages can be computed by the
+    monitoring system.
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value, *label_values):
+        self.labels(*label_values).observe(value)
+
+    def samples(self):
+        bounds = [repr(bound) for bound in self.buckets] + ['+Inf']
+        for (labels, child) in self._items():
+            counts = list(child.counts)
+            cumulative = 0
+            for (bound, count) in zip(bounds, counts):
+                cumulative += count
+                yield (self.name + '_bucket', dict(labels, le=bound), cumulative)
+            yield (self.name + '_sum', labels, child.sum + child.sum_ns / 1e9)
+            yield (self.name + '_count', labels, cumulative)
+
+
+class Registry:
+    '''
+    Holds the metrics of a process and renders them.
+
+    Values that already live elsewhere, like the object caches' hit counts,
+    are gathered at render time by collectors instead of being recorded
+    twice. A collector is a function returning (name, kind, help, samples)
+    tuples, where samples are (name, labels, value) tuples.
+    '''
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError('Metric %s is already registered as a %s.' % (name, metric.kind))
+            return metric
+
+    def add_collector(self, function):
+        '''
+        Bound methods are held weakly, so that a RecipeDB which is thrown
+        away stops being reported instead of being kept alive.
+        '''
+        if hasattr(function, '__self__'):
+            function = weakref.WeakMethod(function)
+        else:
+            function = (lambda function=function: function)
+        with self._lock:
+            self._collectors.append(function)
+
+    def collect(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+
+        families = {}
+        for metric in metrics:
+            families[metric.name] = (metric.kind, metric.help, list(metric.samples()))
+
+        dead = []
+        for reference in collectors:
+            collector = reference()
+            if collector is None:
+                dead.append(reference)
+                continue
+            for (name, kind, help, samples) in collector():
+                if name in families:
+                    families[name][2].extend(samples)
+                else:
+                    families[name] = (kind, help, list(samples))
+
+        if dead:
+            with self._lock:
+                self._collectors = [c for c in self._collectors if c not in dead]
+
+        return families
+
+    def counter(self, name, help, labels=()):
+        return self._get_or_create(Counter, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help, labels, buckets)
+
+    def render(self):
+        '''
+        Return the metrics in the Prometheus text exposition format.
+        '''
+        lines = []
+        for (name, (kind, help, samples)) in sorted(self.collect().items()):
+            lines.append('# HELP %s %s' % (name, help.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.extend(_format_sample(*sample) for sample in samples)
+        return '\n'.join(lines) + '\n'
+
+
+# The registry used by RecipeDB and the frontends.
+REGISTRY = Registry()
+
+CALL_SECONDS = REGISTRY.histogram(
+    'recipedb_call_seconds',
+    'Time spent in RecipeDB methods.',
+    labels=['method'],
+)
+CALL_ERRORS = REGISTRY.counter(
+    'recipedb_call_errors_total',
+    'RecipeDB method calls which raised an exception.',
+    labels=['method'],
+)
+INGEST_SECONDS = REGISTRY.histogram(
+    'recipedb_image_ingest_seconds',
+    'Time from an image being committed until its file is stored and resized.',
+    labels=['status'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
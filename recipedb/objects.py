@@ -1,8 +1,11 @@
 from flask_login import UserMixin
+import os
 
 from . import constants
+from . import decorators
 from . import exceptions
 from . import helpers
+from . import images
 
 from voussoirkit import sqlhelpers
 
@@ -37,6 +40,80 @@ class Image(ObjectBase):
 
         self.id = db_row['ImageID']
         self.file_path = db_row['ImageFilePath']
+        self.hash = db_row['Hash']
+        self.byte_size = db_row['ByteSize']
+        self.mimetype = db_row['MimeType']
+        self.status = db_row['Status']
+        self.width = db_row['Width']
+        self.height = db_row['Height']
+
+    def _set_ingest_result(self, data):
+        if 'ImageFilePath' in data:
+            self.file_path = data['ImageFilePath']
+            self.hash = data['Hash']
+            self.byte_size = data['ByteSize']
+            self.mimetype = data['MimeType']
+        self.status = data['Status']
+
+    @property
+    def is_processing(self):
+        return self.status == constants.IMAGE_STATUS_PROCESSING
+
+    def get_rendition_path(self, size):
+        '''
+        Return the filepath of the smallest rendition at least `size` pixels
+        tall, making it first if needed. If there is no rendition that big,
+        the original is no taller than the rendition would be, it can't be
+        made, or the image is still processing, return the original's
+        filepath.
+        '''
+        height = images.choose_rendition_height(size)
+        if height is None or images.PIL is None or self.status != constants.IMAGE_STATUS_READY:
+            return self.file_path
+        if self.height and height >= self.height:
+            return self.file_path
+
+        filepath = images.rendition_filepath(self.file_path, height)
+        if os.path.isfile(filepath):
+            return filepath
+        try:
+            return images.make_rendition(self.file_path, height)
+        except images.RENDITION_ERRORS:
+            self.recipedb.log.warning('Could not make the %dpx rendition of %s.', height, self.file_path, exc_info=True)
+            return self.file_path
+
+    def get_rendition_sizes(self):
+        '''
+        Return a (size, width) pair for each version of the image that can be
+        sent, smallest first: the renditions smaller than the original, then
+        the original itself with a size of None. Empty if the image's
+        dimensions aren't known.
+        '''
+        if not self.width or not self.height:
+            return []
+        sizes = []
+        if images.PIL is not None:
+            for height in constants.IMAGE_RENDITION_HEIGHTS:
+                if height < self.height:
+                    sizes.append((height, self.get_width_at(height)))
+        sizes.append((None, self.width))
+        return sizes
+
+    def get_width_at(self, height):
+        '''
+        Return the width of the image when displayed `height` pixels tall, or
+        None if its dimensions aren't known.
+        '''
+        if not self.width or not self.height:
+            return None
+        return max(1, round(self.width * height / self.height))
+
+    def wait(self, timeout=None):
+        '''
+        Wait for the image to finish processing. Return True if it has, or
+        False if the timeout ran out first. See RecipeDB.new_image.
+        '''
+        return self.recipedb.wait_for_ingest([self], timeout=timeout)
 
 
 class Ingredient(ObjectBase):
@@ -48,6 +125,7 @@ class Ingredient(ObjectBase):
         self.id = db_row['IngredientID']
         self.name = db_row['Name']
 
+    @decorators.transaction
     def add_autocorrect(self, alternate_name):
         alternate_name = self.recipedb._normalize_ingredient_name(alternate_name)
         try:
@@ -65,8 +143,8 @@ class Ingredient(ObjectBase):
         (qmarks, bindings) = sqlhelpers.insert_filler(constants.SQL_INGREDIENTAUTOCORRECT_COLUMNS, data)
         query = 'INSERT INTO IngredientAutocorrect VALUES(%s)' % qmarks
         cur.execute(query, bindings)
-        self.recipedb.sql.commit()
 
+    @decorators.transaction
     def add_tag(self, tag):
         if self.has_tag(tag):
             return
@@ -79,14 +157,32 @@ class Ingredient(ObjectBase):
         (qmarks, bindings) = sqlhelpers.insert_filler(constants.SQL_INGREDIENTINGREDIENTTAG_COLUMNS, data)
         query = 'INSERT INTO Ingredient_IngredientTag_Map VALUES(%s)' % qmarks
         cur.execute(query, bindings)
-        self.recipedb.sql.commit()
 
-    def get_tags(self):
+    def get_all_tags(self):
+        '''
+        Return the ingredient's tags plus all of their ancestors.
+        '''
         cur = self.recipedb.sql.cursor()
-        cur.execute('SELECT IngredientTagID FROM Ingredient_IngredientTag_Map WHERE IngredientID = ?', [self.id])
-        lines = cur.fetchall()
-        tags = {self.recipedb.get_ingredient_tag_by_id(line[0]) for line in lines}
+        cur.execute('''
+            SELECT DISTINCT IngredientTag.* FROM Ingredient_IngredientTag_Map
+            INNER JOIN IngredientTag_Closure
+                ON IngredientTag_Closure.DescendantID = Ingredient_IngredientTag_Map.IngredientTagID
+            INNER JOIN IngredientTag
+                ON IngredientTag.IngredientTagID = IngredientTag_Closure.AncestorID
+            WHERE Ingredient_IngredientTag_Map.IngredientID = ?
+        ''', [self.id])
+        tags = {self.recipedb.get_cached_instance('ingredient_tag', row) for row in cur.fetchall()}
+        return tags
 
+    def get_tags(self):
+        cur = self.recipedb.sql.cursor()
+        cur.execute('''
+            SELECT IngredientTag.* FROM Ingredient_IngredientTag_Map
+            INNER JOIN IngredientTag
+                ON IngredientTag.IngredientTagID = Ingredient_IngredientTag_Map.IngredientTagID
+            WHERE Ingredient_IngredientTag_Map.IngredientID = ?
+        ''', [self.id])
+        tags = {self.recipedb.get_cached_instance('ingredient_tag', row) for row in cur.fetchall()}
         return tags
 
     def has_tag(self, tag):
@@ -98,12 +194,12 @@ class Ingredient(ObjectBase):
         exists = cur.fetchone()
         return bool(exists)
 
+    @decorators.transaction
     def remove_tag(self, tag):
         cur = self.recipedb.sql.cursor()
         cur.execute('DELETE FROM Ingredient_IngredientTag_Map WHERE IngredientID = ? AND IngredientTagId = ?',
             [self.id, tag.id]
         )
-        self.recipedb.sql.commit()
 
     def rename(self, name):
         # Check if `name` is already taken by an other ingredient
@@ -121,6 +217,7 @@ class IngredientTag(ObjectBase):
         self.name = db_row['TagName']
         self.parent_id = db_row['ParentTagID']
 
+    @decorators.transaction
     def add_child(self, tag):
         cur = self.recipedb.sql.cursor()
         cur.execute('SELECT ParentTagID FROM IngredientTag WHERE IngredientTagID = ?', [tag.id])
@@ -128,6 +225,13 @@ class IngredientTag(ObjectBase):
         if row is not None:
             raise exceptions.AlreadyHasParent(tag=tag, parent=self)
 
+        cur.execute(
+            'SELECT 1 FROM IngredientTag_Closure WHERE AncestorID = ? AND DescendantID = ?',
+            [tag.id, self.id]
+        )
+        if cur.fetchone() is not None:
+            raise exceptions.RecursiveGrouping(tag=tag, parent=self)
+
         data = {
             'IngredientTagID': tag.id,
             'ParentTagID': self.id,
@@ -135,22 +239,77 @@ class IngredientTag(ObjectBase):
         (query, bindings) = sqlhelpers.update_filler(data, where_key='IngredientTagID')
         query = 'UPDATE IngredientTag %s' % query
         cur.execute(query, bindings)
+
+        # Connect every ancestor of self (including self) to every descendant
+        # of the new child (including the child).
+        cur.execute('''
+            INSERT INTO IngredientTag_Closure
+            SELECT above.AncestorID, below.DescendantID, above.Depth + below.Depth + 1
+            FROM IngredientTag_Closure AS above, IngredientTag_Closure AS below
+            WHERE above.DescendantID = ? AND below.AncestorID = ?
+        ''', [self.id, tag.id])
         tag.parent_id = self.id
-        self.recipedb.sql.commit()
+        self.recipedb.caches['ingredient_tag'].remove(tag.id)
+
+    def get_ancestors(self):
+        '''
+        Return the list of tags above this one, nearest first.
+        '''
+        cur = self.recipedb.sql.cursor()
+        cur.execute('''
+            SELECT IngredientTag.* FROM IngredientTag_Closure
+            INNER JOIN IngredientTag
+                ON IngredientTag.IngredientTagID = IngredientTag_Closure.AncestorID
+            WHERE IngredientTag_Closure.DescendantID = ? AND IngredientTag_Closure.Depth > 0
+            ORDER BY IngredientTag_Closure.Depth
+        ''', [self.id])
+        tags = [self.recipedb.get_cached_instance('ingredient_tag', row) for row in cur.fetchall()]
+        return tags
 
     def get_children(self):
         cur = self.recipedb.sql.cursor()
         cur.execute('SELECT * FROM IngredientTag WHERE ParentTagID = ?', [self.id])
         rows = cur.fetchall()
-        tags = set(IngredientTag(self.recipedb, row) for row in rows)
+        tags = set(self.recipedb.get_cached_instance('ingredient_tag', row) for row in rows)
+        return tags
+
+    def get_descendants(self):
+        '''
+        Return the set of tags anywhere below this one.
+        '''
+        cur = self.recipedb.sql.cursor()
+        cur.execute('''
+            SELECT IngredientTag.* FROM IngredientTag_Closure
+            INNER JOIN IngredientTag
+                ON IngredientTag.IngredientTagID = IngredientTag_Closure.DescendantID
+            WHERE IngredientTag_Closure.AncestorID = ? AND IngredientTag_Closure.Depth > 0
+        ''', [self.id])
+        tags = {self.recipedb.get_cached_instance('ingredient_tag', row) for row in cur.fetchall()}
         return tags
 
+    def get_ingredients(self):
+        '''
+        Return the set of Ingredients which have this tag or any tag below it.
+        '''
+        cur = self.recipedb.sql.cursor()
+        cur.execute('''
+            SELECT DISTINCT Ingredient.* FROM IngredientTag_Closure
+            INNER JOIN Ingredient_IngredientTag_Map
+                ON Ingredient_IngredientTag_Map.IngredientTagID = IngredientTag_Closure.DescendantID
+            INNER JOIN Ingredient
+                ON Ingredient.IngredientID = Ingredient_IngredientTag_Map.IngredientID
+            WHERE IngredientTag_Closure.AncestorID = ?
+        ''', [self.id])
+        ingredients = {self.recipedb.get_cached_instance('ingredient', row) for row in cur.fetchall()}
+        return ingredients
+
     def get_parent(self):
         if self.parent_id is None:
             return None
 
         return self.recipedb.get_ingredient_tag_by_id(self.parent_id)
 
+    @decorators.transaction
     def leave_parent(self):
         parent = self.get_parent()
         if parent is None:
@@ -164,8 +323,15 @@ class IngredientTag(ObjectBase):
         (query, bindings) = sqlhelpers.update_filler(data, where_key='IngredientTagID')
         query = 'UPDATE IngredientTag %s' % query
         cur.execute(query, bindings)
+
+        # Disconnect the whole subtree from everything that used to be above it.
+        cur.execute('''
+            DELETE FROM IngredientTag_Closure
+            WHERE DescendantID IN (SELECT DescendantID FROM IngredientTag_Closure WHERE AncestorID = ?)
+            AND AncestorID NOT IN (SELECT DescendantID FROM IngredientTag_Closure WHERE AncestorID = ?)
+        ''', [self.id, self.id])
         self.parent_id = None
-        self.recipedb.sql.commit()
+        self.recipedb.caches['ingredient_tag'].remove(self.id)
 
     def rename(self, name):
         # Check if `name` is already taken somewhere else.
@@ -217,10 +383,6 @@ class Recipe(ObjectBase):
         self.name = db_row['Name']
         self.slug = helpers.slugify(self.name)
         self.author_id = db_row['AuthorID']
-        if self.author_id is not None:
-            self.author = self.recipedb.get_user(id=self.author_id)
-        else:
-            self.author = None
         self.country = db_row['CountryOfOrigin']
         self.meal_type = db_row['MealType']
         self.cuisine = db_row['Cuisine']
@@ -231,9 +393,49 @@ class Recipe(ObjectBase):
         self.serving_size = db_row['ServingSize']
         self.instructions = db_row['Instructions']
         self.recipe_image_id = db_row['RecipeImageID']
-        self.recipe_pic = self.recipedb.get_image(self.recipe_image_id)
+
+        # Related objects are not loaded until somebody asks for them, since
+        # most listings only need the columns above. RecipeDB.prefetch may
+        # fill these in ahead of time for a whole batch of recipes.
+        self._author = None
+        self._recipe_pic = None
+        self._ingredients = None
+        self._tags = None
+        # Recipes that come from RecipeDB.search are ranked by how many of the
+        # requested ingredients they matched, then by the relevance of the
+        # text match. Everything else ties at 1 and 0.
+        self._search_score = 1
+        self._search_relevance = 0.0
+
+    @property
+    def author(self):
+        if self._author is None and self.author_id is not None:
+            self._author = self.recipedb.get_user(id=self.author_id)
+        return self._author
+
+    @property
+    def recipe_pic(self):
+        if self._recipe_pic is None and self.recipe_image_id is not None:
+            self._recipe_pic = self.recipedb.get_image(self.recipe_image_id)
+        return self._recipe_pic
+
+    @property
+    def page_cursor(self):
+        '''
+        Pass this as the `after` argument of RecipeDB.get_recipes or search
+        to get the page of results that follows this recipe.
+        '''
+        return helpers.make_page_cursor(
+            self._search_score,
+            self._search_relevance,
+            self.date_added,
+            self.id,
+        )
 
     def get_ingredients(self):
+        if self._ingredients is not None:
+            return set(self._ingredients)
+
         cur = self.recipedb.sql.cursor()
         cur.execute('SELECT * FROM Recipe_Ingredient_Map WHERE RecipeID = ?', [self.id])
         lines = cur.fetchall()
@@ -243,14 +445,22 @@ class Recipe(ObjectBase):
 
     def get_ingredients_and_tags(self):
         everything = {qi.ingredient for qi in self.get_ingredients()}
-        tags = set()
-        for ingredient in everything:
-            tags.update(ingredient.get_tags())
-        everything.update(tags)
-        while len(tags) > 0:
-            tags = {tag.get_parent() for tag in tags}
-            tags = {tag for tag in tags if tag is not None}
-            everything.update(tags)
+        if self._tags is not None:
+            everything.update(self._tags)
+            return everything
+
+        cur = self.recipedb.sql.cursor()
+        cur.execute('''
+            SELECT DISTINCT IngredientTag.* FROM Recipe_Ingredient_Map
+            INNER JOIN Ingredient_IngredientTag_Map
+                ON Ingredient_IngredientTag_Map.IngredientID = Recipe_Ingredient_Map.IngredientID
+            INNER JOIN IngredientTag_Closure
+                ON IngredientTag_Closure.DescendantID = Ingredient_IngredientTag_Map.IngredientTagID
+            INNER JOIN IngredientTag
+                ON IngredientTag.IngredientTagID = IngredientTag_Closure.AncestorID
+            WHERE Recipe_Ingredient_Map.RecipeID = ?
+        ''', [self.id])
+        everything.update(self.recipedb.get_cached_instance('ingredient_tag', row) for row in cur.fetchall())
         return everything
 
     def set_recipe_pic(self, image):
@@ -314,10 +524,13 @@ class User(UserMixin, ObjectBase):
         self.bio_text = db_row['BioText']
         self.date_joined = db_row['DateJoined']
         self.profile_image_id = db_row['ProfileImageID']
-        if self.profile_image_id is not None:
-            self.profile_pic = self.recipedb.get_image(self.profile_image_id)
-        else:
-            self.profile_pic = None
+        self._profile_pic = None
+
+    @property
+    def profile_pic(self):
+        if self._profile_pic is None and self.profile_image_id is not None:
+            self._profile_pic = self.recipedb.get_image(self.profile_image_id)
+        return self._profile_pic
 
     def set_display_name(self, display_name):
         raise NotImplementedError
@@ -1,22 +1,42 @@
 import bcrypt
+import contextlib
 import copy
+import functools
 import json
 import logging
 import os
+import re
 import sqlite3
 import tempfile
-import shutil
+import threading
+import time
 
+from . import caching
+from . import connections
 from . import constants
+from . import decorators
 from . import exceptions
 from . import helpers
+from . import images
+from . import ingest
+from . import metrics
 from . import objects
+from . import tracing
 
 from voussoirkit import pathclass
 from voussoirkit import sqlhelpers
 
 logging.basicConfig()
 
+# The object types which are kept in RecipeDB's identity map, with the class
+# to construct and the column that identifies them.
+CACHED_THING_CLASSES = {
+    'image': (objects.Image, 'ImageID'),
+    'ingredient': (objects.Ingredient, 'IngredientID'),
+    'ingredient_tag': (objects.IngredientTag, 'IngredientTagID'),
+    'user': (objects.User, 'UserID'),
+}
+
 
 class RecipeDB:
     def __init__(
@@ -36,11 +56,37 @@ class RecipeDB:
         self.log = logging.getLogger('recipedb:%s' % self.data_directory.absolute_path)
         self.log.setLevel(logging.DEBUG)
 
+        # CONFIG
+        self.config_filepath = self.data_directory.with_child(constants.DEFAULT_CONFIGNAME)
+        self.config = self._load_config()
+        self.log.setLevel(self.config['log_level'])
+
         # DATABASE
         self.database_filepath = self.data_directory.with_child(constants.DEFAULT_DBNAME)
 
         existing_database = self.database_filepath.exists
-        self.sql = sqlite3.connect(self.database_filepath.absolute_path)
+        tracing_config = self.config['query_tracing']
+        if tracing_config['enabled']:
+            self.tracer = tracing.Tracer(
+                repeat_threshold=tracing_config['repeat_threshold'],
+                keep_recent=tracing_config['keep_recent'],
+            )
+            factory = tracing.TracingConnection
+        else:
+            self.tracer = None
+            factory = sqlite3.Connection
+
+        self._connections = connections.ConnectionPool(
+            self.database_filepath.absolute_path,
+            max_readers=self.config['max_read_connections'],
+            pragmas=self.config['sqlite'],
+            factory=factory,
+            reader_timeout=self.config['read_connection_timeout'],
+        )
+        if self.tracer is not None:
+            self._connections.add_connect_hook(self.tracer.attach)
+        self.log.info('SQLite settings: %s', self._connections.get_pragmas())
+        self._writer_owner = None
 
         if not existing_database:
             self._first_time_setup()
@@ -48,16 +94,63 @@ class RecipeDB:
         if existing_database:
             self._check_version()
 
-        # CONFIG
-        self.config_filepath = self.data_directory.with_child(constants.DEFAULT_CONFIGNAME)
-        self.config = self._load_config()
-        self.log.setLevel(self.config['log_level'])
+        # OBJECT CACHES
+        self.caches = {
+            thing_type: caching.ObjectCache(maxlen=self.config['cache_size'][thing_type])
+            for thing_type in CACHED_THING_CLASSES
+        }
 
         # IMAGE DIRECTORY
         self.image_directory = self.data_directory.with_child(constants.DEFAULT_IMAGEDIR)
         os.makedirs(self.image_directory.absolute_path, exist_ok=True)
 
+        # Mutators run inside a transaction, which commits when the
+        # outermost block exits. Callbacks in on_commit_queue run after the
+        # real commit succeeds and are discarded if the work is rolled back.
         self.on_commit_queue = []
+        self._savepoints = []
+        # (thing_type, id) of the objects cached while a transaction is open,
+        # which may describe uncommitted rows. See _cache_instance.
+        self._touched = []
+
+        # New images are stored and resized in the background. The events
+        # of the images still being processed are set when they finish.
+        self._ingest_pool = ingest.IngestPool(self.config['ingest_workers'])
+        self._ingests = {}
+        self._resume_ingest()
+
+        metrics.REGISTRY.add_collector(self._collect_metrics)
+
+        # The setup above read through a connection leased to this thread,
+        # which would otherwise stay leased for as long as the thread lives.
+        self._connections.release()
+
+    @property
+    def sql(self):
+        '''
+        The connection for the current thread: the writer while it holds an
+        open transaction, otherwise its leased read-only connection.
+        '''
+        if self._writer_owner == threading.get_ident():
+            return self._connections.writer
+        return self._connections.reader()
+
+    def _cache_instance(self, thing_type, thing):
+        '''
+        Put the object in its cache. Inside a transaction, the current thread
+        reads through the writer and may see rows which aren't committed yet,
+        so the object is noted in order to be evicted if they roll back.
+
+        Images which are still processing aren't cached, because the row may
+        be finished by the time the object is stored, by this process or
+        another one, and the cached object would then never catch up. Each
+        lookup reads them afresh until _finish_ingest caches the result.
+        '''
+        if thing_type == 'image' and thing.is_processing:
+            return
+        self.caches[thing_type][thing.id] = thing
+        if self._writer_owner == threading.get_ident():
+            self._touched.append((thing_type, thing.id))
 
     def _check_version(self):
         '''
@@ -75,6 +168,87 @@ class RecipeDB:
             )
             raise exc
 
+    def _collect_metrics(self):
+        '''
+        Report the cache and connection pool counters, which are kept by
+        those objects already, to the metrics registry.
+        '''
+        cache_stats = self.get_cache_stats()
+        pool_stats = self._connections.stats()
+
+        def cache_family(name, kind, help, key):
+            samples = [
+                (name, {'cache': thing_type}, stats[key])
+                for (thing_type, stats) in cache_stats.items()
+            ]
+            return (name, kind, help, samples)
+
+        def pool_family(name, kind, help, key):
+            return (name, kind, help, [(name, {}, pool_stats[key])])
+
+        return [
+            cache_family('recipedb_cache_hits_total', 'counter', 'Object cache lookups which were found.', 'hits'),
+            cache_family('recipedb_cache_misses_total', 'counter', 'Object cache lookups which went to the database.', 'misses'),
+            cache_family('recipedb_cache_size', 'gauge', 'Objects held in each cache.', 'size'),
+            cache_family('recipedb_cache_maxlen', 'gauge', 'Configured capacity of each cache.', 'maxlen'),
+            pool_family('recipedb_read_connections_leased', 'gauge', 'Read connections held by a thread.', 'leased'),
+            pool_family('recipedb_read_connections_idle', 'gauge', 'Open read connections waiting to be leased.', 'idle'),
+            pool_family('recipedb_read_connections_max', 'gauge', 'The max_read_connections setting.', 'max_readers'),
+            pool_family('recipedb_read_connection_waits_total', 'counter', 'Times a thread waited for a free read connection.', 'reader_waits'),
+            ('recipedb_images_processing', 'gauge', 'Images being stored and resized in the background.', [
+                ('recipedb_images_processing', {}, len(self._ingests)),
+            ]),
+        ]
+
+    def _evict_touched(self, start):
+        '''
+        Evict the objects cached since the transaction or savepoint which
+        is being rolled back began.
+        '''
+        for (thing_type, thing_id) in self._touched[start:]:
+            self.caches[thing_type].remove(thing_id)
+        del self._touched[start:]
+
+    def _finish_ingest(self, image, started, future):
+        '''
+        Record the outcome of an image's background processing, in the
+        database and on the object which was created for it, which is then
+        cached unless a lookup has already cached the finished row.
+        '''
+        image_id = image.id
+        try:
+            try:
+                (filepath, hash, byte_size, mimetype) = future.result()
+            except Exception:
+                self.log.error('Could not process image %s.', image_id, exc_info=True)
+                data = {
+                    'ImageID': image_id,
+                    'Status': constants.IMAGE_STATUS_FAILED,
+                }
+            else:
+                data = {
+                    'ImageID': image_id,
+                    'ImageFilePath': filepath,
+                    'Hash': hash,
+                    'ByteSize': byte_size,
+                    'MimeType': mimetype,
+                    'Status': constants.IMAGE_STATUS_READY,
+                }
+
+            with self.transaction():
+                cur = self.sql.cursor()
+                (query, bindings) = sqlhelpers.update_filler(data, where_key='ImageID')
+                query = 'UPDATE Image %s' % query
+                cur.execute(query, bindings)
+
+            image._set_ingest_result(data)
+            if self.caches['image'].get(image_id) is None:
+                self._cache_instance('image', image)
+            metrics.INGEST_SECONDS.observe(time.perf_counter() - started, data['Status'])
+            self.log.debug('Image %s is %s.', image_id, data['Status'])
+        finally:
+            self._ingests.pop(image_id).set()
+
     def _first_time_setup(self):
         '''
         This method is run when the database is being created for the first
@@ -82,11 +256,10 @@ class RecipeDB:
         '''
         self.log.debug('Performing first-time setup')
 
-        cur = self.sql.cursor()
-        statements = constants.DB_INIT.split(';')
-        for statement in statements:
-            cur.execute(statement)
-        self.sql.commit()
+        # The trigger bodies contain semicolons of their own, so the script
+        # can't be split into statements naively.
+        self._connections.writer.executescript(constants.DB_INIT)
+        self._connections.writer.commit()
 
     def _load_config(self):
         config = copy.deepcopy(constants.DEFAULT_CONFIGURATION)
@@ -106,6 +279,31 @@ class RecipeDB:
                 handle.write(json.dumps(config, indent=4, sort_keys=True))
         return config
 
+    def _resume_ingest(self):
+        '''
+        Restart the processing of images which were still processing when
+        the program last stopped. Storing a file twice is harmless, since
+        the store already has it by then.
+        '''
+        cur = self.sql.cursor()
+        # The status is written out instead of bound so that the partial
+        # index index_Image_Processing can be used.
+        cur.execute("SELECT * FROM Image WHERE Status = 'processing'")
+        for image_row in cur.fetchall():
+            image = objects.Image(self, image_row)
+            self.log.debug('Resuming processing of image %s.', image.id)
+            self._start_ingest(image)
+
+    def _start_ingest(self, image):
+        # While processing, the image's file_path is the source file.
+        self._ingests[image.id] = threading.Event()
+        self._ingest_pool.submit(
+            images.ingest_file,
+            image.file_path,
+            self.image_directory.absolute_path,
+            on_done=functools.partial(self._finish_ingest, image, time.perf_counter()),
+        )
+
     def _assert_valid_password(self, password):
         '''
         If something is wrong, raise an exception.
@@ -130,9 +328,12 @@ class RecipeDB:
         if len(badchars) > 0:
             raise exceptions.InvalidUsernameCharacters(name=name, badchars=badchars)
 
-    def _coerce_quantitied_ingredient(self, ingredient):
+    def _coerce_quantitied_ingredient(self, ingredient, known_ingredients=None):
         '''
         Try to convert the given input to a QuantitiedIngredient.
+
+        known_ingredients: An optional dict of normalized name to Ingredient
+        which is consulted before going to the database.
         '''
         if isinstance(ingredient, objects.QuantitiedIngredient):
             return ingredient
@@ -143,7 +344,11 @@ class RecipeDB:
             quantity = None
 
         if isinstance(ingredient, str):
-            ingredient = self.get_or_create_ingredient(name=ingredient)
+            name = self._normalize_ingredient_name(ingredient)
+            if known_ingredients is not None and name in known_ingredients:
+                ingredient = known_ingredients[name]
+            else:
+                ingredient = self.get_or_create_ingredient(name=ingredient)
 
         if isinstance(ingredient, objects.Ingredient):
             ingredient = objects.QuantitiedIngredient.from_existing(
@@ -156,6 +361,102 @@ class RecipeDB:
 
         return ingredient
 
+    def _get_or_create_ingredients(self, names):
+        '''
+        Return a dict mapping each of the given normalized names to its
+        Ingredient, looking them all up with one query and inserting the
+        missing ones with a single executemany.
+        '''
+        names = set(names)
+        rows = self._select_in('''
+            SELECT Ingredient.Name, Ingredient.* FROM Ingredient
+            WHERE Ingredient.Name IN {qmarks}
+            UNION ALL
+            SELECT IngredientAutocorrect.AlternateName, Ingredient.* FROM IngredientAutocorrect
+            INNER JOIN Ingredient ON Ingredient.IngredientID = IngredientAutocorrect.IngredientID
+            WHERE IngredientAutocorrect.AlternateName IN {qmarks}
+        ''', names)
+        ingredients = {row[0]: self.get_cached_instance('ingredient', row[1:]) for row in rows}
+
+        new_ingredients = [
+            {'IngredientID': helpers.random_hex(), 'Name': name}
+            for name in names if name not in ingredients
+        ]
+        if new_ingredients:
+            self._insert_many('Ingredient', constants.SQL_INGREDIENT_COLUMNS, new_ingredients)
+            for data in new_ingredients:
+                ingredients[data['Name']] = self.get_cached_instance('ingredient', data)
+            self.log.debug('Created %d ingredients', len(new_ingredients))
+
+        return ingredients
+
+    def _insert_many(self, table, columns, datas):
+        '''
+        Insert a list of row dicts into the table with one executemany.
+        '''
+        if not datas:
+            return
+        (qmarks, _) = sqlhelpers.insert_filler(columns, datas[0])
+        query = 'INSERT INTO %s VALUES(%s)' % (table, qmarks)
+        # Every row is built by our own helpers with the same keys, so once
+        # the first has been checked the rest can skip insert_filler.
+        bindings = [[data[column] for column in columns] for data in datas]
+        cur = self.sql.cursor()
+        cur.executemany(query, bindings)
+
+    def _make_recipe_data(
+            self,
+            *,
+            author,
+            blurb,
+            country_of_origin,
+            cuisine,
+            instructions,
+            meal_type,
+            name,
+            prep_time,
+            serving_size,
+            recipe_image,
+        ):
+        '''
+        Build the Recipe row for a new recipe.
+        '''
+        if author is not None:
+            author_id = author.id
+        else:
+            author_id = None
+
+        if recipe_image is not None:
+            recipe_image_id = recipe_image.id
+        else:
+            recipe_image_id = None
+
+        recipe_data = {
+            'RecipeID': helpers.random_hex(),
+            'Name': name,
+            'AuthorID': author_id,
+            'CountryOfOrigin': country_of_origin,
+            'MealType': meal_type,
+            'Cuisine': cuisine,
+            'PrepTime': prep_time,
+            'DateAdded': helpers.now(),
+            'DateModified': helpers.now(),
+            'Blurb': blurb,
+            'ServingSize': serving_size,
+            'Instructions': instructions,
+            'RecipeImageID': recipe_image_id,
+        }
+        return recipe_data
+
+    def _make_recipe_ingredient_data(self, recipe_id, quant_ingredient):
+        return {
+            'RecipeID': recipe_id,
+            'IngredientID': quant_ingredient.ingredient.id,
+            'IngredientQuantity': quant_ingredient.quantity,
+            'IngredientPrefix': quant_ingredient.prefix,
+            'IngredientSuffix': quant_ingredient.suffix,
+        }
+
     def _normalize_ingredient_name(self, name):
         '''
         Apply any normalization rules that bring multiple equivalent forms
@@ -164,6 +465,27 @@ class RecipeDB:
         name = name.replace('_', ' ')
         return name
 
+    def _select_in(self, query, values, bindings=None):
+        '''
+        Run a query of the form `... IN {qmarks} ...` against `values`,
+        splitting it into as many statements as needed to stay under the
+        binding limit, and return all of the rows. If {qmarks} appears more
+        than once, each occurrence is bound to the same chunk of values.
+        '''
+        if bindings is None:
+            bindings = []
+        values = list(values)
+        repeats = query.count('{qmarks}')
+        chunk_length = (constants.SQL_MAX_BINDINGS - len(bindings)) // repeats
+        cur = self.sql.cursor()
+        rows = []
+        for chunk in helpers.chunk_sequence(values, chunk_length):
+            qmarks = '(%s)' % ', '.join('?' * len(chunk))
+            cur.execute(query.format(qmarks=qmarks), (list(chunk) * repeats) + bindings)
+            rows.extend(cur.fetchall())
+        return rows
+
+    @decorators.time_me
     def check_password(self, user, password):
         '''
         Check a typed password against the user's password
@@ -171,10 +493,59 @@ class RecipeDB:
         password = password.encode('utf-8')
         return bcrypt.checkpw(password, user.password_hash)
 
+    @decorators.time_me
+    def commit(self):
+        '''
+        Commit pending changes and then run the callbacks in on_commit_queue.
+        Inside a `transaction()` block this does nothing, and the commit
+        happens when the outermost block exits.
+        '''
+        with self._connections.write_lock:
+            if self._savepoints:
+                return
+
+            self._connections.writer.commit()
+            self._touched.clear()
+            while self.on_commit_queue:
+                task = self.on_commit_queue.pop(0)
+                args = task.get('args', [])
+                kwargs = task.get('kwargs', {})
+                task['action'](*args, **kwargs)
+
+    def get_cache_stats(self):
+        '''
+        Return the size and hit / miss counts of each object cache, for
+        tuning the `cache_size` section of the config file.
+        '''
+        return {thing_type: cache.stats() for (thing_type, cache) in self.caches.items()}
+
+    def get_cached_instance(self, thing_type, db_row):
+        '''
+        Return the cached object for this row if there is one, otherwise
+        construct it, cache it, and return it. This way each row is only
+        represented by one object for as long as it stays in the cache.
+        '''
+        (thing_class, id_column) = CACHED_THING_CLASSES[thing_type]
+        if isinstance(db_row, dict):
+            thing_id = db_row[id_column]
+        else:
+            thing_id = db_row[0]
+
+        thing = self.caches[thing_type].get(thing_id)
+        if thing is None:
+            thing = thing_class(self, db_row)
+            self._cache_instance(thing_type, thing)
+        return thing
+
+    @decorators.time_me
     def get_image(self, id):
         '''
         Fetch an image by its ID
         '''
+        image = self.caches['image'].get(id)
+        if image is not None:
+            return image
+
         cur = self.sql.cursor()
         cur.execute('SELECT * FROM Image WHERE ImageID = ?', [id])
         image_row = cur.fetchone()
@@ -183,20 +554,35 @@ class RecipeDB:
         else:
             raise ValueError('Image %s does not exist' % id)
 
+        self._cache_instance('image', image)
         return image
 
+    @decorators.time_me
     def get_or_create_ingredient(self, name):
         try:
             return self.get_ingredient(name=name)
         except exceptions.NoSuchIngredient:
             return self.new_ingredient(name)
 
+    @decorators.time_me
+    @decorators.transaction
+    def get_or_create_ingredients(self, names):
+        '''
+        Return a dict mapping each of the given names, normalized, to its
+        Ingredient, creating the missing ones. Much faster than calling
+        get_or_create_ingredient for each name.
+        '''
+        names = [self._normalize_ingredient_name(name) for name in names]
+        return self._get_or_create_ingredients(names)
+
+    @decorators.time_me
     def get_or_create_ingredient_tag(self, name):
         try:
             return self.get_ingredient_tag(name=name)
         except exceptions.NoSuchIngredientTag:
             return self.new_ingredient_tag(name)
 
+    @decorators.time_me
     def get_ingredient(self, *, id=None, name=None):
         '''
         Fetch a single Ingredient by its ID or name.
@@ -212,6 +598,10 @@ class RecipeDB:
         return ingredient
 
     def get_ingredient_by_id(self, id):
+        ingredient = self.caches['ingredient'].get(id)
+        if ingredient is not None:
+            return ingredient
+
         cur = self.sql.cursor()
         cur.execute('SELECT * FROM Ingredient WHERE IngredientID = ?', [id])
         ingredient_row = cur.fetchone()
@@ -220,6 +610,7 @@ class RecipeDB:
             raise exceptions.NoSuchIngredient('ID: ' + id)
 
         ingredient = objects.Ingredient(self, ingredient_row)
+        self._cache_instance('ingredient', ingredient)
         return ingredient
 
     def get_ingredient_by_name(self, name):
@@ -238,9 +629,10 @@ class RecipeDB:
         if ingredient_row is None:
             raise exceptions.NoSuchIngredient('Name: ' + name)
 
-        ingredient = objects.Ingredient(self, ingredient_row)
+        ingredient = self.get_cached_instance('ingredient', ingredient_row)
         return ingredient
 
+    @decorators.time_me
     def get_ingredient_tag(self, *, id=None, name=None):
         '''
         Fetch a single IngredientTag by its ID or name.
@@ -256,6 +648,10 @@ class RecipeDB:
         return tag
 
     def get_ingredient_tag_by_id(self, id):
+        tag = self.caches['ingredient_tag'].get(id)
+        if tag is not None:
+            return tag
+
         cur = self.sql.cursor()
         cur.execute('SELECT * FROM IngredientTag WHERE IngredientTagID = ?', [id])
         tag_row = cur.fetchone()
@@ -264,6 +660,7 @@ class RecipeDB:
             raise exceptions.NoSuchIngredientTag('ID: ' + id)
 
         tag = objects.IngredientTag(self, tag_row)
+        self._cache_instance('ingredient_tag', tag)
         return tag
 
     def get_ingredient_tag_by_name(self, name):
@@ -276,9 +673,10 @@ class RecipeDB:
         if tag_row is None:
             raise exceptions.NoSuchIngredientTag('Name: ' + name)
 
-        tag = objects.IngredientTag(self, tag_row)
+        tag = self.get_cached_instance('ingredient_tag', tag_row)
         return tag
 
+    @decorators.time_me
     def get_recipe(self, id):
         '''
         Fetch a single Recipe by its ID.
@@ -294,16 +692,44 @@ class RecipeDB:
 
         return recipe
 
-    def get_recipes(self):
+    @decorators.time_me
+    def get_recipes(self, *, after=None, limit=None, prefetch=None):
         '''
-        Returns all recipes
+        Returns recipes, newest first.
+
+        after: The page_cursor of the last recipe on the previous page. Only
+        recipes which come after it are returned.
+
+        limit: The maximum number of recipes to return.
+
+        prefetch: A list of relations to load for all of the recipes at once.
+        See `prefetch`.
         '''
+        wheres = ''
+        bindings = []
+
+        if after is not None:
+            (score, relevance, date_added, recipe_id) = helpers.parse_page_cursor(after)
+            wheres = 'WHERE (DateAdded, RecipeID) < (?, ?)'
+            bindings.extend([date_added, recipe_id])
+
+        if limit is not None:
+            limits = 'LIMIT ?'
+            bindings.append(limit)
+        else:
+            limits = ''
+
+        query = 'SELECT * FROM Recipe {wheres} ORDER BY DateAdded DESC, RecipeID DESC {limits}'
+        query = query.format(wheres=wheres, limits=limits)
         cur = self.sql.cursor()
-        cur.execute('SELECT * FROM Recipe')
+        cur.execute(query, bindings)
         recipe_rows = cur.fetchall()
         recipe_objects = [objects.Recipe(self, row) for row in recipe_rows]
+        if prefetch:
+            self.prefetch(recipe_objects, prefetch)
         return recipe_objects
 
+    @decorators.time_me
     def get_user(self, *, id=None, username=None):
         '''
         Fetch an user by their ID
@@ -322,6 +748,10 @@ class RecipeDB:
         '''
         Fetch an user by their ID
         '''
+        user = self.caches['user'].get(id)
+        if user is not None:
+            return user
+
         cur = self.sql.cursor()
         cur.execute('SELECT * FROM User WHERE UserID = ?', [id])
         user_row = cur.fetchone()
@@ -331,6 +761,7 @@ class RecipeDB:
         else:
             raise exceptions.NoSuchUser('ID:' + id)
 
+        self._cache_instance('user', user)
         return user
     
     def get_user_by_username(self, username):
@@ -342,41 +773,70 @@ class RecipeDB:
         user_row = cur.fetchone()
 
         if user_row is not None:
-            user = objects.User(self, user_row)
+            user = self.get_cached_instance('user', user_row)
         else:
             raise exceptions.NoSuchUser('Name: ' + username)
 
         return user
 
+    @decorators.time_me
+    @decorators.transaction
+    def insert_many(self, table, columns, datas):
+        '''
+        Insert a list of row dicts into the table all at once.
+
+        The rows are not validated, so this is for bulk loading data which
+        was built to match the table, like the benchmark's corpus. Anything
+        else should go through the new_* methods.
+        '''
+        self._insert_many(table, columns, datas)
+
+    @decorators.time_me
+    @decorators.transaction
     def new_image(self, filepath):
         '''
-        Register a new image in the database.
+        Register the file as a new image and return it right away, with the
+        status 'processing'. Its dimensions, format and size are read from
+        the file's header without decoding it.
+
+        Once the transaction commits, the file is copied into the image
+        store and its renditions are made in the background, after which the
+        image is 'ready', or 'failed' if the file couldn't be read. The file
+        must stay where it is until then, and is served in the meantime.
+        Use Image.wait or wait_for_ingest to wait for it.
+
+        If the store already has a file with the same content, the new image
+        shares it.
         '''
-        # generate id and generate new filepath based on id
         if isinstance(filepath, pathclass.Path):
             filepath = filepath.absolute_path
+        filepath = os.path.abspath(filepath)
+        if not os.path.isfile(filepath):
+            raise FileNotFoundError(filepath)
 
-        id = helpers.random_hex()
-        filetype = filepath.rsplit('.', 1)[1]
-        new_filepath = '\\'.join(id[i:i + 4] for i in range(0, len(id), 4)) + '.' + filetype
-        new_filepath = self.image_directory.join(new_filepath)
-        os.makedirs(new_filepath.parent.absolute_path, exist_ok=True)
-        new_filepath = new_filepath.absolute_path
-        shutil.copyfile(filepath, new_filepath)
+        (mimetype, width, height) = images.read_image_header(filepath)
         data = {
-            'ImageID': id,
-            'ImageFilePath': new_filepath,
+            'ImageID': helpers.random_hex(),
+            'ImageFilePath': filepath,
+            'Hash': None,
+            'ByteSize': os.path.getsize(filepath),
+            'MimeType': mimetype,
+            'Status': constants.IMAGE_STATUS_PROCESSING,
+            'Width': width,
+            'Height': height,
         }
 
         cur = self.sql.cursor()
         (qmarks, bindings) = sqlhelpers.insert_filler(constants.SQL_IMAGE_COLUMNS, data)
         query = 'INSERT INTO Image VALUES(%s)' % qmarks
         cur.execute(query, bindings)
-        self.sql.commit()
-        image = objects.Image(self, data)
+        image = self.get_cached_instance('image', data)
         self.log.debug('Created image with ID: %s, filepath: %s' % (image.id, image.file_path))
+        self.queue_on_commit(self._start_ingest, image)
         return image
 
+    @decorators.time_me
+    @decorators.transaction
     def new_ingredient(self, name):
         '''
         Add a new Ingredient to the database.
@@ -399,12 +859,13 @@ class RecipeDB:
         (qmarks, bindings) = sqlhelpers.insert_filler(constants.SQL_INGREDIENT_COLUMNS, data)
         query = 'INSERT INTO Ingredient VALUES(%s)' % qmarks
         cur.execute(query, bindings)
-        self.sql.commit()
 
-        ingredient = objects.Ingredient(self, data)
+        ingredient = self.get_cached_instance('ingredient', data)
         self.log.debug('Created ingredient %s', ingredient.name)
         return ingredient
 
+    @decorators.time_me
+    @decorators.transaction
     def new_ingredient_tag(self, name, parent=None):
         '''
         Create a new IngredientTag, either a root or grouped under `parent`.
@@ -432,12 +893,26 @@ class RecipeDB:
         (qmarks, bindings) = sqlhelpers.insert_filler(constants.SQL_INGREDIENTTAG_COLUMNS, data)
         query = 'INSERT INTO IngredientTag VALUES(%s)' % qmarks
         cur.execute(query, bindings)
-        self.sql.commit()
 
-        tag = objects.IngredientTag(self, data)
+        # Every tag is its own ancestor at depth 0, and inherits the ancestry
+        # of its parent one level deeper.
+        cur.execute(
+            'INSERT INTO IngredientTag_Closure VALUES(?, ?, 0)',
+            [data['IngredientTagID'], data['IngredientTagID']]
+        )
+        if parent_id is not None:
+            cur.execute('''
+                INSERT INTO IngredientTag_Closure
+                SELECT AncestorID, ?, Depth + 1 FROM IngredientTag_Closure
+                WHERE DescendantID = ?
+            ''', [data['IngredientTagID'], parent_id])
+
+        tag = self.get_cached_instance('ingredient_tag', data)
         self.log.debug('Created IngredientTag %s', tag.name)
         return tag
 
+    @decorators.time_me
+    @decorators.transaction
     def new_recipe(
             self,
             *,
@@ -459,63 +934,94 @@ class RecipeDB:
         author: May be a string representing the author's ID, or a User object.
         ingredients: A list of either ingredient's ID, or Ingredient objects.
         '''
-        cur = self.sql.cursor()
-
-        recipe_id = helpers.random_hex()
-
-        if author is not None:
-            author_id = author.id
-        else:
-            author_id = None
-
-        if recipe_image is not None:
-            recipe_image_id = recipe_image.id
-        else:
-            recipe_image_id = None
-
-        recipe_data = {
-            'RecipeID': recipe_id,
-            'Name': name,
-            'AuthorID': author_id,
-            'CountryOfOrigin': country_of_origin,
-            'MealType': meal_type,
-            'Cuisine': cuisine,
-            'PrepTime': prep_time,
-            'DateAdded': helpers.now(),
-            'DateModified': helpers.now(),
-            'Blurb': blurb,
-            'ServingSize': serving_size,
-            'Instructions': instructions,
-            'RecipeImageID': recipe_image_id,
-        }
-
-        (qmarks, bindings) = sqlhelpers.insert_filler(constants.SQL_RECIPE_COLUMNS, recipe_data)
-        query = 'INSERT INTO Recipe VALUES(%s)' % qmarks
-        cur.execute(query, bindings)
-
+        recipe_data = self._make_recipe_data(
+            author=author,
+            blurb=blurb,
+            country_of_origin=country_of_origin,
+            cuisine=cuisine,
+            instructions=instructions,
+            meal_type=meal_type,
+            name=name,
+            prep_time=prep_time,
+            serving_size=serving_size,
+            recipe_image=recipe_image,
+        )
         ingredients = [self._coerce_quantitied_ingredient(ingredient) for ingredient in ingredients]
-
-        for quant_ingredient in ingredients:
-            recipe_ingredient_data = {
-                'RecipeID': recipe_id,
-                'IngredientID': quant_ingredient.ingredient.id,
-                'IngredientQuantity': quant_ingredient.quantity,
-                'IngredientPrefix': quant_ingredient.prefix,
-                'IngredientSuffix': quant_ingredient.suffix,
-            }
-            (qmarks, bindings) = sqlhelpers.insert_filler(
-                constants.SQL_RECIPEINGREDIENT_COLUMNS,
-                recipe_ingredient_data
-            )
-            query = 'INSERT INTO Recipe_Ingredient_Map VALUES(%s)' % qmarks
-            cur.execute(query, bindings)
-
-        self.sql.commit()
+        recipe_ingredient_datas = [
+            self._make_recipe_ingredient_data(recipe_data['RecipeID'], quant_ingredient)
+            for quant_ingredient in ingredients
+        ]
+
+        self._insert_many('Recipe', constants.SQL_RECIPE_COLUMNS, [recipe_data])
+        self._insert_many(
+            'Recipe_Ingredient_Map',
+            constants.SQL_RECIPEINGREDIENT_COLUMNS,
+            recipe_ingredient_datas,
+        )
 
         recipe = objects.Recipe(self, recipe_data)
         self.log.debug('Created recipe %s', recipe.name)
         return recipe
 
+    @decorators.time_me
+    def new_recipes_bulk(self, recipes, *, chunk_size=500):
+        '''
+        Add many recipes at once. `recipes` may be any iterable of dicts,
+        including a generator, where each dict holds the keyword arguments
+        that new_recipe takes.
+
+        The input is consumed chunk_size recipes at a time. For each chunk,
+        every distinct ingredient name is resolved with one query, the
+        missing ingredients, the recipes and their ingredient rows are each
+        inserted with one executemany, and the whole chunk is committed once.
+
+        Return the number of recipes that were added.
+        '''
+        start_time = time.perf_counter()
+        total = 0
+        for chunk in helpers.chunk_iterable(recipes, chunk_size):
+            with self.transaction():
+                self._new_recipes_chunk(chunk)
+            total += len(chunk)
+            self.log.debug('Added %d recipes so far', total)
+
+        elapsed = time.perf_counter() - start_time
+        rate = (total / elapsed) if elapsed else 0
+        self.log.info('Added %d recipes in %.3f seconds (%d per second)', total, elapsed, rate)
+        return total
+
+    def _new_recipes_chunk(self, recipes):
+        names = set()
+        for recipe in recipes:
+            for ingredient in recipe['ingredients']:
+                if isinstance(ingredient, (tuple, list)):
+                    ingredient = ingredient[0]
+                if isinstance(ingredient, str):
+                    names.add(self._normalize_ingredient_name(ingredient))
+        known_ingredients = self._get_or_create_ingredients(names)
+
+        recipe_datas = []
+        recipe_ingredient_datas = []
+        for recipe in recipes:
+            recipe = dict(recipe)
+            ingredients = recipe.pop('ingredients')
+            recipe_data = self._make_recipe_data(**recipe)
+            recipe_datas.append(recipe_data)
+            for ingredient in ingredients:
+                quant_ingredient = self._coerce_quantitied_ingredient(ingredient, known_ingredients)
+                recipe_ingredient_datas.append(
+                    self._make_recipe_ingredient_data(recipe_data['RecipeID'], quant_ingredient)
+                )
+
+        self._insert_many('Recipe', constants.SQL_RECIPE_COLUMNS, recipe_datas)
+        self._insert_many(
+            'Recipe_Ingredient_Map',
+            constants.SQL_RECIPEINGREDIENT_COLUMNS,
+            recipe_ingredient_datas,
+        )
+
+    @decorators.time_me
+    @decorators.transaction
     def new_user(
             self,
             username: str,
@@ -569,12 +1075,94 @@ class RecipeDB:
         query = 'INSERT INTO User VALUES(%s)' % qmarks
         cur.execute(query, bindings)
 
-        self.sql.commit()
-
-        user = objects.User(self, user_data)
+        user = self.get_cached_instance('user', user_data)
         self.log.debug('Created user %s with ID %s', user.username, user.id)
         return user
 
+    def queue_on_commit(self, action, *args, **kwargs):
+        '''
+        Call `action(*args, **kwargs)` after the current work is committed,
+        or immediately if no transaction is open.
+        '''
+        with self._connections.write_lock:
+            self.on_commit_queue.append({'action': action, 'args': args, 'kwargs': kwargs})
+            if not self._savepoints:
+                self.commit()
+
+    @decorators.time_me
+    def prefetch(self, recipes, relations):
+        '''
+        Load related objects for a whole batch of recipes with one query per
+        relation, instead of one query per recipe when each is accessed.
+
+        relations: A list containing any of:
+            'author': Recipe.author
+            'image': Recipe.recipe_pic
+            'ingredients': Recipe.get_ingredients()
+            'tags': Recipe.get_ingredients_and_tags(). Implies 'ingredients'.
+        '''
+        relations = set(relations)
+        unknown = relations.difference({'author', 'image', 'ingredients', 'tags'})
+        if unknown:
+            raise ValueError('Unknown relations %s.' % unknown)
+
+        recipes = list(recipes)
+        if not recipes:
+            return
+
+        if 'author' in relations:
+            author_ids = {recipe.author_id for recipe in recipes if recipe.author_id is not None}
+            rows = self._select_in('SELECT * FROM User WHERE UserID IN {qmarks}', author_ids)
+            users = {row[0]: self.get_cached_instance('user', row) for row in rows}
+            for recipe in recipes:
+                recipe._author = users.get(recipe.author_id)
+
+        if 'image' in relations:
+            image_ids = {recipe.recipe_image_id for recipe in recipes if recipe.recipe_image_id is not None}
+            rows = self._select_in('SELECT * FROM Image WHERE ImageID IN {qmarks}', image_ids)
+            images = {row[0]: self.get_cached_instance('image', row) for row in rows}
+            for recipe in recipes:
+                recipe._recipe_pic = images.get(recipe.recipe_image_id)
+
+        recipe_ids = {recipe.id for recipe in recipes}
+
+        if 'ingredients' in relations or 'tags' in relations:
+            map_rows = self._select_in('SELECT * FROM Recipe_Ingredient_Map WHERE RecipeID IN {qmarks}', recipe_ids)
+            map_rows = [dict(zip(constants.SQL_RECIPEINGREDIENT_COLUMNS, row)) for row in map_rows]
+            ingredient_ids = {row['IngredientID'] for row in map_rows}
+            rows = self._select_in('SELECT * FROM Ingredient WHERE IngredientID IN {qmarks}', ingredient_ids)
+            ingredients = {row[0]: self.get_cached_instance('ingredient', row) for row in rows}
+
+            quantitied = {recipe_id: set() for recipe_id in recipe_ids}
+            for row in map_rows:
+                quant_ingredient = objects.QuantitiedIngredient.from_existing(
+                    ingredients[row['IngredientID']],
+                    quantity=row['IngredientQuantity'],
+                    prefix=row['IngredientPrefix'],
+                    suffix=row['IngredientSuffix'],
+                )
+                quantitied[row['RecipeID']].add(quant_ingredient)
+            for recipe in recipes:
+                recipe._ingredients = quantitied[recipe.id]
+
+        if 'tags' in relations:
+            rows = self._select_in('''
+                SELECT DISTINCT Recipe_Ingredient_Map.RecipeID, IngredientTag.*
+                FROM Recipe_Ingredient_Map
+                INNER JOIN Ingredient_IngredientTag_Map
+                    ON Ingredient_IngredientTag_Map.IngredientID = Recipe_Ingredient_Map.IngredientID
+                INNER JOIN IngredientTag_Closure
+                    ON IngredientTag_Closure.DescendantID = Ingredient_IngredientTag_Map.IngredientTagID
+                INNER JOIN IngredientTag
+                    ON IngredientTag.IngredientTagID = IngredientTag_Closure.AncestorID
+                WHERE Recipe_Ingredient_Map.RecipeID IN {qmarks}
+            ''', recipe_ids)
+            tags = {recipe_id: set() for recipe_id in recipe_ids}
+            for row in rows:
+                tags[row[0]].add(self.get_cached_instance('ingredient_tag', row[1:]))
+            for recipe in recipes:
+                recipe._tags = tags[recipe.id]
+
     def _get_ingredient_or_tag(self, name):
         try:
             return self.get_ingredient(name=name)
@@ -591,7 +1179,7 @@ class RecipeDB:
     def _normalize_ingredient_set(self, ingredients):
         '''
         When the user searches for a recipe, they might be providing us with
-        a variety of data.
+        a variety of data. Return the set of Ingredient and IngredientTag IDs.
         '''
         if ingredients is None:
             return None
@@ -607,15 +1195,51 @@ class RecipeDB:
         for ingredient in ingredients:
             if isinstance(ingredient, str):
                 ingredient = self._get_ingredient_or_tag(name=ingredient)
-                if ingredient is not None:
-                    final_ingredients.add(ingredient.name)
             if isinstance(ingredient, (objects.Ingredient, objects.IngredientTag)):
-                final_ingredients.add(ingredient.name)
+                final_ingredients.add(ingredient.id)
         return final_ingredients
 
+    def _normalize_search_text(self, text):
+        '''
+        Convert the user's text into an FTS5 query in which every word must
+        appear, either whole or as the prefix of a longer word.
+        Returns None if there is no text or it is blank, meaning the text
+        doesn't filter the search, or '' if it has no searchable words, like
+        "!!!", meaning nothing can match it.
+        '''
+        if text is None or not text.strip():
+            return None
+
+        words = re.findall(r'\w+', text)
+        if not words:
+            return ''
+
+        return ' '.join('"%s"*' % word for word in words)
+
+    def release_connection(self):
+        '''
+        Return the current thread's read connection to the pool. Call this
+        when a thread or request is done with the database; the thread will
+        lease a connection again the next time it needs one.
+        '''
+        self._connections.release()
+
+    def rollback(self):
+        '''
+        Discard all uncommitted changes and queued callbacks. Objects cached
+        during the transaction may describe rows that no longer exist, so
+        they are evicted. The rest of the cache is untouched.
+        '''
+        with self._connections.write_lock:
+            self._connections.writer.rollback()
+            self.on_commit_queue.clear()
+            self._evict_touched(0)
+
+    @decorators.time_me
     def search(
             self,
             *,
+            after=None,
             author=None,
             country=None,
             cuisine=None,
@@ -624,78 +1248,298 @@ class RecipeDB:
             limit=None,
             meal_type=None,
             name=None,
+            prefetch=None,
             strict_ingredients=False,
+            text=None,
         ):
+        '''
+        Search is compiled into a single SQL statement. Recipes are ranked by
+        the number of requested ingredients or tags they contain, then newest
+        first, and only the requested page of results is loaded.
+
+        after: The page_cursor of the last recipe on the previous page of
+        results for the same search. Only recipes which come after it are
+        returned.
+
+        ingredients, ingredients_exclude: Ingredient or IngredientTag objects
+        or names, or a comma-separated string of names. A tag matches every
+        ingredient anywhere beneath it.
+
+        strict_ingredients: If True, only return recipes that contain all of
+        the requested ingredients.
+
+        prefetch: A list of relations to load for all of the results at once.
+        See `prefetch`.
+
+        text: Words to look for in the name, blurb and instructions. Matching
+        recipes are ranked by BM25 after the ingredient score. Words also
+        match as prefixes, so "chick" finds "chicken".
+        '''
+        ingredients = self._normalize_ingredient_set(ingredients)
+        ingredients_exclude = self._normalize_ingredient_set(ingredients_exclude)
+        text = self._normalize_search_text(text)
+
+        if ingredients is not None and not ingredients:
+            return []
+
+        if text is not None and not text:
+            return []
+
+        ctes = []
+        cte_bindings = []
+        joins = ''
         wheres = []
         bindings = []
 
+        if ingredients:
+            # Each search term expands to the ingredient itself, or to every
+            # ingredient under the tag, labeled with the term it came from so
+            # that we can count how many distinct terms each recipe matched.
+            qmarks = '(%s)' % ', '.join('?' * len(ingredients))
+            ctes.append('''
+            search_terms(TermID, IngredientID) AS (
+                SELECT IngredientID, IngredientID FROM Ingredient
+                WHERE IngredientID IN {qmarks}
+                UNION
+                SELECT IngredientTag_Closure.AncestorID, Ingredient_IngredientTag_Map.IngredientID
+                FROM IngredientTag_Closure
+                INNER JOIN Ingredient_IngredientTag_Map
+                    ON Ingredient_IngredientTag_Map.IngredientTagID = IngredientTag_Closure.DescendantID
+                WHERE IngredientTag_Closure.AncestorID IN {qmarks}
+            )
+            '''.format(qmarks=qmarks))
+            cte_bindings.extend(ingredients)
+            cte_bindings.extend(ingredients)
+            joins = '''
+            INNER JOIN Recipe_Ingredient_Map ON Recipe_Ingredient_Map.RecipeID = Recipe.RecipeID
+            INNER JOIN search_terms ON search_terms.IngredientID = Recipe_Ingredient_Map.IngredientID
+            '''
+            score = 'COUNT(DISTINCT search_terms.TermID)'
+        else:
+            score = '1'
+
+        if text is not None:
+            # bm25 only works directly against the FTS table, so the CTE must
+            # not be flattened into the join and GROUP BY below.
+            ctes.append('''
+            text_matches(RecipeID, Relevance) AS MATERIALIZED (
+                SELECT RecipeID, -bm25(Recipe_FTS, {weights}) FROM Recipe_FTS
+                WHERE Recipe_FTS MATCH ?
+            )
+            '''.format(weights=', '.join(str(w) for w in constants.FTS_COLUMN_WEIGHTS)))
+            cte_bindings.append(text)
+            joins += '''
+            INNER JOIN text_matches ON text_matches.RecipeID = Recipe.RecipeID
+            '''
+            relevance = 'text_matches.Relevance'
+        else:
+            relevance = '0.0'
+
+        if ingredients_exclude:
+            qmarks = '(%s)' % ', '.join('?' * len(ingredients_exclude))
+            ctes.append('''
+            excluded_ingredients(IngredientID) AS (
+                SELECT IngredientID FROM Ingredient
+                WHERE IngredientID IN {qmarks}
+                UNION
+                SELECT Ingredient_IngredientTag_Map.IngredientID
+                FROM IngredientTag_Closure
+                INNER JOIN Ingredient_IngredientTag_Map
+                    ON Ingredient_IngredientTag_Map.IngredientTagID = IngredientTag_Closure.DescendantID
+                WHERE IngredientTag_Closure.AncestorID IN {qmarks}
+            )
+            '''.format(qmarks=qmarks))
+            cte_bindings.extend(ingredients_exclude)
+            cte_bindings.extend(ingredients_exclude)
+            wheres.append('''
+            NOT EXISTS (
+                SELECT 1 FROM Recipe_Ingredient_Map AS excluded_map
+                WHERE excluded_map.RecipeID = Recipe.RecipeID
+                AND excluded_map.IngredientID IN excluded_ingredients
+            )
+            ''')
+
         if author is not None:
-            wheres.append('AuthorID = ?')
+            wheres.append('Recipe.AuthorID = ?')
             bindings.append(author.id)
 
         if country is not None:
-            wheres.append('Country = ?')
+            wheres.append('Recipe.CountryOfOrigin = ?')
             bindings.append(country)
 
         if cuisine is not None:
-            wheres.append('Cuisine = ?')
+            wheres.append('Recipe.Cuisine = ?')
             bindings.append(cuisine)
 
-        ingredients = self._normalize_ingredient_set(ingredients)
-        ingredients_exclude = self._normalize_ingredient_set(ingredients_exclude)
-
         if meal_type is not None:
-            wheres.append('MealType = ?')
+            wheres.append('Recipe.MealType = ?')
             bindings.append(meal_type)
 
         if name is not None:
-            wheres.append('Name LIKE ?')
+            wheres.append('Recipe.Name LIKE ?')
             bindings.append(name)
 
+        havings = []
+        having_bindings = []
+
+        if strict_ingredients and ingredients:
+            havings.append('MatchCount = ?')
+            having_bindings.append(len(ingredients))
+
+        if after is not None:
+            # Every column in the ORDER BY is descending, so the rest of the
+            # results are exactly the rows which compare less than the cursor.
+            (after_score, after_relevance, after_date, after_id) = helpers.parse_page_cursor(after)
+            if ingredients:
+                havings.append('(MatchCount, Relevance, Recipe.DateAdded, Recipe.RecipeID) < (?, ?, ?, ?)')
+                having_bindings.extend([after_score, after_relevance, after_date, after_id])
+            elif text is not None:
+                wheres.append('(text_matches.Relevance, Recipe.DateAdded, Recipe.RecipeID) < (?, ?, ?)')
+                bindings.extend([after_relevance, after_date, after_id])
+            else:
+                wheres.append('(Recipe.DateAdded, Recipe.RecipeID) < (?, ?)')
+                bindings.extend([after_date, after_id])
+
+        if ctes:
+            ctes = 'WITH ' + ', '.join(ctes)
+        else:
+            ctes = ''
+
         if wheres:
-            wheres = ' AND '.join(wheres)
-            wheres = 'WHERE ' + wheres
+            wheres = 'WHERE ' + ' AND '.join(wheres)
         else:
             wheres = ''
 
+        if ingredients:
+            group_by = 'GROUP BY Recipe.RecipeID'
+            if havings:
+                group_by += ' HAVING ' + ' AND '.join(havings)
+            order_by = 'MatchCount DESC, Relevance DESC, Recipe.DateAdded DESC, Recipe.RecipeID DESC'
+        elif text is not None:
+            group_by = ''
+            order_by = 'Relevance DESC, Recipe.DateAdded DESC, Recipe.RecipeID DESC'
+        else:
+            # Leaving out the constant scores lets SQLite walk the DateAdded
+            # index instead of sorting.
+            group_by = ''
+            order_by = 'Recipe.DateAdded DESC, Recipe.RecipeID DESC'
+
+        if limit is not None:
+            limits = 'LIMIT ?'
+            limit_bindings = [limit]
+        else:
+            limits = ''
+            limit_bindings = []
+
+        query = '''
+        {ctes}
+        SELECT Recipe.*, {score} AS MatchCount, {relevance} AS Relevance FROM Recipe
+        {joins}
+        {wheres}
+        {group_by}
+        ORDER BY {order_by}
+        {limits}
+        '''
+        query = query.format(
+            ctes=ctes,
+            score=score,
+            relevance=relevance,
+            joins=joins,
+            wheres=wheres,
+            group_by=group_by,
+            order_by=order_by,
+            limits=limits,
+        )
+        bindings = cte_bindings + bindings + having_bindings + limit_bindings
+
         cur = self.sql.cursor()
-        query = 'SELECT * FROM Recipe {wheres}'
-        query = query.format(wheres=wheres)
-        self.log.debug("%s %s", query, bindings)
+        self.log.debug('%s %s', query, bindings)
         cur.execute(query, bindings)
+        results = []
+        for row in cur.fetchall():
+            recipe = objects.Recipe(self, row[:-2])
+            recipe._search_score = row[-2]
+            recipe._search_relevance = row[-1]
+            results.append(recipe)
+
+        if prefetch:
+            self.prefetch(results, prefetch)
+        return results
 
-        match_counts = {}
-        while True:
-            recipe_row = cur.fetchone()
-            if recipe_row is None:
-                break
-
-            recipe = objects.Recipe(self, recipe_row)
-            recipe_ingredients = recipe.get_ingredients_and_tags()
-            recipe_ingredients = {i.name for i in recipe_ingredients}
-
-            if ingredients_exclude is not None:
-                if recipe_ingredients.intersection(ingredients_exclude):
-                    continue
-
-            if ingredients is not None:
-                matches = recipe_ingredients.intersection(ingredients)
-
-                if not matches:
-                    continue
-
-                matched_all = matches == ingredients
-                if strict_ingredients and not matched_all:
-                    continue
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+        Group every change made inside the block into a single commit:
 
-                match_counts[recipe] = len(matches)
+            with rdb.transaction():
+                rdb.new_ingredient('salt')
+                rdb.new_ingredient('pepper')
 
+        Blocks may be nested. An exception inside a nested block rolls back
+        to the savepoint where that block began; an exception in the
+        outermost block rolls back everything. Either way it is re-raised.
+        '''
+        with self._connections.write_lock:
+            writer = self._connections.writer
+            savepoint_id = 'savepoint_%d' % len(self._savepoints)
+            queue_length = len(self.on_commit_queue)
+            touched_length = len(self._touched)
+            if self._savepoints:
+                writer.execute('SAVEPOINT %s' % savepoint_id)
             else:
-                match_counts[recipe] = 1
-
-            if limit is not None and len(match_counts) >= limit:
-                break
-
-        results = sorted(match_counts.keys(), key=match_counts.get, reverse=True)
+                if writer.in_transaction:
+                    writer.commit()
+                # Take the write lock up front. Most mutators read before
+                # they write, and in WAL mode a deferred transaction which
+                # tries to upgrade while another process is writing fails
+                # immediately instead of waiting for busy_timeout.
+                writer.execute('BEGIN IMMEDIATE')
+                self._writer_owner = threading.get_ident()
+            self._savepoints.append(savepoint_id)
+
+            try:
+                yield self
+            except BaseException:
+                self._savepoints.pop()
+                if self._savepoints:
+                    writer.execute('ROLLBACK TO %s' % savepoint_id)
+                    writer.execute('RELEASE %s' % savepoint_id)
+                    del self.on_commit_queue[queue_length:]
+                    self._evict_touched(touched_length)
+                else:
+                    self._writer_owner = None
+                    self.rollback()
+                raise
+
+            self._savepoints.pop()
+            if self._savepoints:
+                writer.execute('RELEASE %s' % savepoint_id)
+            else:
+                self._writer_owner = None
+                self.commit()
 
-        return results
+    def wait_for_ingest(self, images=None, timeout=None):
+        '''
+        Wait until the given images, or else all images, have finished
+        processing. Return True if they all have, or False if the timeout ran
+        out first.
+
+        Images which this RecipeDB hasn't started processing, such as ones
+        whose transaction hasn't committed yet, are not waited for.
+        Don't call this inside a transaction, since finishing an image needs
+        to write to the database.
+        '''
+        if images is None:
+            events = list(self._ingests.values())
+        else:
+            events = [self._ingests.get(image.id) for image in images]
+            events = [event for event in events if event is not None]
+
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        for event in events:
+            if timeout is None:
+                event.wait()
+            elif not event.wait(max(0, deadline - time.monotonic())):
+                return False
+        return True
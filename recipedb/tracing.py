@@ -0,0 +1,229 @@
+'''
+This file contains the opt-in query tracer, which records every statement
+RecipeDB runs along with its duration and the line of code that ran it.
+
+Statements are grouped into traces, typically one per web request, so that
+the number of queries behind a page and any statement repeated over and
+over (the N+1 pattern of loading a list and then querying once per item)
+are easy to see.
+'''
+import collections
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+# Frames from these files are skipped when finding a statement's call site,
+# since the interesting line is whoever asked for the query.
+_SKIPPED_FILES = {
+    os.path.normcase(os.path.abspath(__file__)),
+    os.path.normcase(os.path.abspath(os.path.join(os.path.dirname(__file__), 'connections.py'))),
+}
+
+_WHITESPACE = re.compile(r'\s+')
+
+# How many frames of the caller's stack to keep, innermost first. One frame
+# is usually a generic helper like get_thing_by_id, the next ones show
+# which loop called it.
+CALL_SITE_DEPTH = 3
+
+def _call_site():
+    frame = sys._getframe(2)
+    while frame is not None and os.path.normcase(frame.f_code.co_filename) in _SKIPPED_FILES:
+        frame = frame.f_back
+
+    sites = []
+    while frame is not None and len(sites) < CALL_SITE_DEPTH:
+        sites.append('%s:%d in %s' % (
+            os.path.basename(frame.f_code.co_filename),
+            frame.f_lineno,
+            frame.f_code.co_name,
+        ))
+        frame = frame.f_back
+    return ' < '.join(sites) or None
+
+def normalize_statement(statement):
+    return _WHITESPACE.sub(' ', statement).strip()
+
+
+class QueryRecord:
+    def __init__(self, statement, call_site):
+        self.statement = statement
+        self.call_site = call_site
+        # Includes the time spent fetching the results, which for SQLite is
+        # where most of a SELECT's work happens.
+        self.duration = 0
+
+
+class Trace:
+    '''
+    The statements run during one unit of work, such as a web request.
+    '''
+    def __init__(self, name, repeat_threshold):
+        self.name = name
+        self.repeat_threshold = repeat_threshold
+        self.queries = []
+        self.started = time.time()
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def total_time(self):
+        return sum(query.duration for query in self.queries)
+
+    def repeated(self):
+        '''
+        Return a list of dicts describing each statement that was run at
+        least `repeat_threshold` times, most frequent first. These are
+        usually a loop that should have been one query.
+        '''
+        groups = collections.OrderedDict()
+        for query in self.queries:
+            groups.setdefault(normalize_statement(query.statement), []).append(query)
+
+        repeated = [
+            {
+                'statement': statement,
+                'count': len(queries),
+                'total_time': sum(query.duration for query in queries),
+                'call_sites': sorted(set(query.call_site for query in queries if query.call_site)),
+            }
+            for (statement, queries) in groups.items()
+            if len(queries) >= self.repeat_threshold
+        ]
+        repeated.sort(key=lambda group: group['count'], reverse=True)
+        return repeated
+
+    def jsonify(self):
+        return {
+            'name': self.name,
+            'started': self.started,
+            'count': self.count,
+            'total_time': self.total_time,
+            'repeated': self.repeated(),
+            'queries': [
+                {
+                    'statement': normalize_statement(query.statement),
+                    'duration': query.duration,
+                    'call_site': query.call_site,
+                }
+                for query in self.queries
+            ],
+        }
+
+
+class Tracer:
+    '''
+    Collects QueryRecords from TracingConnections into the Trace that is
+    active on the current thread. Statements run while no trace is active
+    are not recorded.
+
+    The most recent `keep_recent` finished traces are kept for inspection.
+    '''
+    def __init__(self, *, repeat_threshold=5, keep_recent=50):
+        self.repeat_threshold = repeat_threshold
+        self.recent = collections.deque(maxlen=keep_recent)
+        self._local = threading.local()
+
+    def attach(self, connection):
+        '''
+        Connect hook for ConnectionPool. The connections must have been
+        created with TracingConnection as their factory.
+        '''
+        connection.tracer = self
+
+    @property
+    def current(self):
+        return getattr(self._local, 'trace', None)
+
+    def start(self, name):
+        trace = Trace(name, repeat_threshold=self.repeat_threshold)
+        self._local.trace = trace
+        return trace
+
+    def stop(self):
+        trace = self.current
+        if trace is None:
+            return None
+        self._local.trace = None
+        self.recent.append(trace)
+        return trace
+
+    def record(self, statement):
+        trace = self.current
+        if trace is None:
+            return None
+        query = QueryRecord(statement, _call_site())
+        trace.queries.append(query)
+        return query
+
+
+class TracingCursor(sqlite3.Cursor):
+    '''
+    Times each statement, and the fetches that follow it, into the tracer's
+    current trace.
+    '''
+    _query = None
+
+    def _timed(self, method, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            if self._query is not None:
+                self._query.duration += time.perf_counter() - start
+
+    def _begin(self, statement):
+        tracer = getattr(self.connection, 'tracer', None)
+        self._query = tracer.record(statement) if tracer is not None else None
+
+    def execute(self, statement, *args):
+        self._begin(statement)
+        self._timed(sqlite3.Cursor.execute, statement, *args)
+        return self
+
+    def executemany(self, statement, *args):
+        self._begin(statement)
+        self._timed(sqlite3.Cursor.executemany, statement, *args)
+        return self
+
+    def executescript(self, script):
+        self._begin(script)
+        self._timed(sqlite3.Cursor.executescript, script)
+        return self
+
+    def fetchone(self):
+        return self._timed(sqlite3.Cursor.fetchone)
+
+    def fetchmany(self, *args, **kwargs):
+        return self._timed(sqlite3.Cursor.fetchmany, *args, **kwargs)
+
+    def fetchall(self):
+        return self._timed(sqlite3.Cursor.fetchall)
+
+    def __next__(self):
+        return self._timed(sqlite3.Cursor.__next__)
+
+
+class TracingConnection(sqlite3.Connection):
+    '''
+    Connection factory whose cursors report to `self.tracer`, which the
+    Tracer's connect hook sets.
+    '''
+    tracer = None
+
+    def cursor(self, factory=TracingCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def executescript(self, script):
+        return self.cursor().executescript(script)
@@ -0,0 +1,55 @@
+'''
+Several processes writing to the same RecipeDB at once, as the web frontend
+does when it runs more than one worker. Every write must wait its turn for
+the database's write lock instead of failing with "database is locked".
+'''
+import multiprocessing
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import recipedb
+
+PROCESSES = 4
+WRITES_PER_PROCESS = 150
+
+def _write_ingredients(data_directory, worker):
+    rdb = recipedb.RecipeDB(data_directory)
+    rdb.log.setLevel('WARNING')
+    errors = []
+    for index in range(WRITES_PER_PROCESS):
+        try:
+            # new_ingredient reads before it writes, which is where a
+            # deferred transaction would fail to take the write lock.
+            rdb.new_ingredient('ingredient %d %d' % (worker, index))
+        except Exception as exc:
+            errors.append(repr(exc))
+    return errors
+
+
+class ConcurrentWriteTest(unittest.TestCase):
+    def test_processes_write_without_lock_errors(self):
+        with tempfile.TemporaryDirectory() as data_directory:
+            rdb = recipedb.RecipeDB(data_directory)
+            rdb.log.setLevel('WARNING')
+
+            context = multiprocessing.get_context('spawn')
+            with context.Pool(PROCESSES) as pool:
+                results = pool.starmap(
+                    _write_ingredients,
+                    [(data_directory, worker) for worker in range(PROCESSES)],
+                )
+
+            errors = [error for result in results for error in result]
+            self.assertEqual(errors, [])
+
+            cur = rdb.sql.cursor()
+            cur.execute('SELECT COUNT(*) FROM Ingredient')
+            self.assertEqual(cur.fetchone()[0], PROCESSES * WRITES_PER_PROCESS)
+
+
+if __name__ == '__main__':
+    unittest.main()
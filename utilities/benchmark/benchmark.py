@@ -0,0 +1,302 @@
+'''
+Time the core RecipeDB operations against a synthetic corpus and write the
+results as JSON, so that runs from different revisions can be compared.
+
+    python benchmark.py --recipes 100000 --output after.json --compare before.json
+
+The corpus is generated once per size, seed and database version and
+reused by later runs. The writes are measured against a throwaway copy of
+it, so every run reads the same data.
+'''
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import recipedb
+
+import corpus as corpus_module
+
+PRESETS = {
+    '1k': 1000,
+    '100k': 100000,
+    '1m': 1000000,
+}
+DEFAULT_REPEAT = 50
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class Benchmark:
+    def __init__(self, rdb, corpus, *, repeat, seed):
+        self.rdb = rdb
+        self.corpus = corpus
+        self.repeat = repeat
+        self.rng = random.Random(seed)
+        self.results = {}
+
+        cur = rdb.sql.cursor()
+        cur.execute('SELECT RecipeID FROM Recipe')
+        self.recipe_ids = [row[0] for row in cur.fetchall()]
+
+    def measure(self, name, function, repeat=None):
+        '''
+        Call function(iteration) `repeat` times and record the timings.
+        '''
+        if repeat is None:
+            repeat = self.repeat
+        timings = []
+        for iteration in range(repeat):
+            start = time.perf_counter()
+            function(iteration)
+            timings.append(time.perf_counter() - start)
+
+        timings.sort()
+        result = {
+            'calls': repeat,
+            'min': timings[0],
+            'median': statistics.median(timings),
+            'p95': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+            'max': timings[-1],
+            'mean': statistics.mean(timings),
+        }
+        result['ops_per_sec'] = (1 / result['mean']) if result['mean'] else None
+        self.results[name] = result
+        print('%-32s median %9.3f ms   p95 %9.3f ms   %10.1f ops/sec' % (
+            name,
+            result['median'] * 1000,
+            result['p95'] * 1000,
+            result['ops_per_sec'] or 0,
+        ))
+
+    def random_ingredients(self, count):
+        return ','.join(self.rng.sample(self.corpus.ingredient_names[:50], count))
+
+    def run_reads(self):
+        rdb = self.rdb
+        rng = self.rng
+        corpus = self.corpus
+
+        self.measure('get_recipe', lambda i: rdb.get_recipe(rng.choice(self.recipe_ids)))
+        self.measure('get_recipes_first_page', lambda i: rdb.get_recipes(limit=48, prefetch=['image']))
+
+        cur = rdb.sql.cursor()
+        cur.execute(
+            'SELECT * FROM Recipe ORDER BY DateAdded DESC, RecipeID DESC LIMIT 1 OFFSET ?',
+            [len(self.recipe_ids) // 2]
+        )
+        deep_cursor = recipedb.objects.Recipe(rdb, cur.fetchone()).page_cursor
+        self.measure('get_recipes_deep_page', lambda i: rdb.get_recipes(after=deep_cursor, limit=48))
+
+        self.measure('recipe_page', lambda i: self._recipe_page(rng.choice(self.recipe_ids)))
+
+        self.measure('search_ingredients', lambda i: rdb.search(ingredients=self.random_ingredients(2), limit=48))
+        self.measure(
+            'search_ingredients_strict',
+            lambda i: rdb.search(ingredients=self.random_ingredients(3), strict_ingredients=True, limit=48),
+        )
+        self.measure(
+            'search_ingredients_exclude',
+            lambda i: rdb.search(
+                ingredients=self.random_ingredients(1),
+                ingredients_exclude=self.random_ingredients(1),
+                limit=48,
+            ),
+        )
+        self.measure('search_tag', lambda i: rdb.search(ingredients=rng.choice(corpus.tag_names), limit=48))
+        self.measure('search_name', lambda i: rdb.search(name=rng.choice(corpus_module.DISHES), limit=48))
+        self.measure('search_text', lambda i: rdb.search(text=rng.choice(corpus_module.FOODS), limit=48))
+        self.measure(
+            'search_author',
+            lambda i: rdb.search(author=rdb.get_user(username=rng.choice(corpus.usernames)), limit=48),
+        )
+        self.measure('search_meal_type', lambda i: rdb.search(meal_type=rng.choice(corpus_module.MEAL_TYPES), limit=48))
+        self.measure(
+            'search_combined',
+            lambda i: rdb.search(
+                ingredients=self.random_ingredients(1),
+                cuisine=rng.choice(corpus_module.CUISINES),
+                text=rng.choice(corpus_module.FOODS),
+                limit=48,
+            ),
+        )
+
+        roots = [rdb.get_ingredient_tag(name=name) for name in corpus_module.TAG_ROOTS]
+        leaves = [rdb.get_ingredient_tag(name=name) for name in corpus.tag_names if '.' in name]
+        self.measure('tag_descendants', lambda i: rng.choice(roots).get_descendants())
+        self.measure('tag_ancestors', lambda i: rng.choice(leaves).get_ancestors())
+        self.measure('tag_ingredients', lambda i: rng.choice(roots).get_ingredients())
+
+    def run_writes(self):
+        # The writes go to a copy, so that they don't pile up in the cached
+        # dataset and make later runs read a bigger database.
+        scratch_directory = tempfile.mkdtemp(prefix='recipedb_benchmark_')
+        try:
+            rdb = copy_dataset(self.rdb, scratch_directory)
+            self._run_writes(rdb)
+        finally:
+            shutil.rmtree(scratch_directory, ignore_errors=True)
+
+    def _run_writes(self, rdb):
+        rng = self.rng
+        author = rdb.get_user(username=self.corpus.usernames[0])
+        run_id = recipedb.helpers.random_hex(6)
+
+        def new_recipe(iteration):
+            rdb.new_recipe(
+                author=author,
+                blurb='Benchmark recipe.',
+                country_of_origin=rng.choice(corpus_module.COUNTRIES),
+                cuisine=rng.choice(corpus_module.CUISINES),
+                ingredients=rng.sample(self.corpus.ingredient_names, 8),
+                instructions='Mix everything together.',
+                meal_type=rng.choice(corpus_module.MEAL_TYPES),
+                name='Benchmark Recipe %s %d' % (run_id, iteration),
+                prep_time=10,
+                serving_size=2,
+                recipe_image=None,
+            )
+        self.measure('new_recipe', new_recipe)
+
+        # new_user is dominated by bcrypt, so it gets fewer calls.
+        self.measure(
+            'new_user',
+            lambda i: rdb.new_user('b%s%d' % (run_id, i), corpus_module.PASSWORD),
+            repeat=max(1, self.repeat // 10),
+        )
+
+    def _recipe_page(self, recipe_id):
+        recipe = self.rdb.get_recipe(recipe_id)
+        self.rdb.prefetch([recipe], ['author', 'ingredients'])
+        recipe.get_ingredients_and_tags()
+
+def git_revision():
+    try:
+        output = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=BENCHMARK_DIR,
+            stderr=subprocess.DEVNULL,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode('ascii').strip()
+
+def copy_dataset(rdb, data_directory):
+    '''
+    Copy the database into data_directory, which must be empty, and return
+    a RecipeDB for the copy. Image files are not copied.
+    '''
+    destination = sqlite3.connect(os.path.join(data_directory, recipedb.constants.DEFAULT_DBNAME))
+    try:
+        rdb.sql.backup(destination)
+    finally:
+        destination.close()
+    copy = recipedb.RecipeDB(data_directory)
+    copy.log.setLevel(logging.WARNING)
+    return copy
+
+def default_data_directory(name, recipe_count, seed):
+    '''
+    Datasets are kept per database version as well as size and seed, since
+    one generated for another version of the schema can't be opened.
+    '''
+    return os.path.join(
+        BENCHMARK_DIR,
+        '_benchmark_data',
+        '%s_%d_%d_v%d' % (name, recipe_count, seed, recipedb.constants.DATABASE_VERSION),
+    )
+
+def open_dataset(data_directory, corpus, fresh=False, image_filepaths=()):
+    '''
+    Return a RecipeDB holding the corpus, generating it if the directory
+    doesn't have one yet.
+    '''
+    if fresh and os.path.isdir(data_directory):
+        shutil.rmtree(data_directory)
+
+    exists = os.path.isfile(os.path.join(data_directory, recipedb.constants.DEFAULT_DBNAME))
+    try:
+        rdb = recipedb.RecipeDB(data_directory)
+    except recipedb.exceptions.DatabaseOutOfDate:
+        print('%s was generated for another database version. Use --fresh to regenerate it.' % data_directory)
+        raise
+    rdb.log.setLevel(logging.WARNING)
+    if not exists:
+        print('Generating %d recipes in %s' % (corpus.recipe_count, data_directory))
+        start = time.perf_counter()
+        corpus_module.populate(rdb, corpus, image_filepaths=image_filepaths)
+        print('Generated in %.1f seconds' % (time.perf_counter() - start))
+    return rdb
+
+def compare(results, baseline_filename):
+    with open(baseline_filename, 'r') as handle:
+        baseline = json.load(handle)['results']
+    print()
+    print('%-32s %12s %12s %8s' % ('', 'before ms', 'after ms', 'change'))
+    for (name, result) in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['median']
+        after = result['median']
+        change = ((after - before) / before * 100) if before else 0
+        print('%-32s %12.3f %12.3f %+7.1f%%' % (name, before * 1000, after * 1000, change))
+
+def benchmark_argparse(args):
+    if args.recipes in PRESETS:
+        recipe_count = PRESETS[args.recipes]
+    else:
+        recipe_count = int(args.recipes)
+
+    corpus = corpus_module.make_corpus(recipe_count, seed=args.seed)
+    data_directory = args.data_directory or default_data_directory('bench', recipe_count, args.seed)
+    rdb = open_dataset(data_directory, corpus, fresh=args.fresh)
+
+    bench = Benchmark(rdb, corpus, repeat=args.repeat, seed=args.seed)
+    bench.run_reads()
+    if not args.no_writes:
+        bench.run_writes()
+
+    output = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+            'corpus': corpus.describe(),
+        },
+        'results': bench.results,
+    }
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(output, handle, indent=4, sort_keys=True)
+        print('Wrote %s' % args.output)
+
+    if args.compare:
+        compare(bench.results, args.compare)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--recipes', default='1k', help='1k, 100k, 1m, or any number.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--data_directory', '--data-directory', dest='data_directory', default=None)
+    parser.add_argument('--fresh', action='store_true', help='Regenerate the corpus even if it exists.')
+    parser.add_argument('--no_writes', '--no-writes', dest='no_writes', action='store_true')
+    parser.add_argument('--output', default=None, help='Write the results to this JSON file.')
+    parser.add_argument('--compare', default=None, help='JSON file from an earlier run to compare against.')
+    parser.set_defaults(func=benchmark_argparse)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == '__main__':
+    raise SystemExit(main(sys.argv[1:]))
@@ -0,0 +1,210 @@
+'''
+Deterministic synthetic corpora for benchmarking RecipeDB.
+
+The same seed and recipe count always produce the same users, ingredients,
+tag hierarchy and recipes, so timings from different revisions of the code
+can be compared against identical data. Popularity follows a Zipf-like
+curve: a few ingredients appear in most recipes and a few authors write
+most of them, as on the real site.
+'''
+import bcrypt
+import itertools
+import random
+
+from recipedb import constants
+from recipedb import helpers
+
+# Every generated user has this password, so the load tests can log in.
+PASSWORD = 'benchmark'
+
+CUISINES = [
+    'American', 'Chinese', 'French', 'Greek', 'Indian', 'Italian', 'Japanese',
+    'Korean', 'Mexican', 'Spanish', 'Thai', 'Vietnamese',
+]
+COUNTRIES = [
+    'China', 'France', 'Greece', 'India', 'Italy', 'Japan', 'Korea', 'Mexico',
+    'Spain', 'Thailand', 'United States', 'Vietnam',
+]
+MEAL_TYPES = ['Appetizer', 'Breakfast', 'Dessert', 'Dinner', 'Drink', 'Lunch', 'Sauce', 'Snack']
+
+ADJECTIVES = [
+    'baked', 'braised', 'creamy', 'crispy', 'fluffy', 'golden', 'grilled',
+    'hearty', 'herbed', 'honey', 'roasted', 'rustic', 'savory', 'smoky',
+    'spiced', 'spicy', 'sticky', 'sweet', 'tangy', 'zesty',
+]
+DISHES = [
+    'bake', 'bowl', 'bread', 'cake', 'casserole', 'curry', 'dumplings',
+    'noodles', 'pasta', 'pie', 'salad', 'sandwich', 'skillet', 'soup', 'stew',
+    'stir fry', 'tacos', 'tart',
+]
+FOODS = [
+    'almond', 'apple', 'bacon', 'basil', 'bean', 'beef', 'berry', 'broccoli',
+    'butter', 'cabbage', 'carrot', 'cheese', 'chicken', 'chili', 'chocolate',
+    'cinnamon', 'coconut', 'corn', 'cream', 'cucumber', 'egg', 'flour',
+    'garlic', 'ginger', 'honey', 'lamb', 'leek', 'lemon', 'lentil', 'lime',
+    'maple', 'milk', 'mint', 'mushroom', 'mustard', 'oat', 'olive', 'onion',
+    'orange', 'paprika', 'parsley', 'pea', 'peach', 'pepper', 'pork',
+    'potato', 'pumpkin', 'rice', 'salmon', 'salt', 'sesame', 'shrimp',
+    'spinach', 'sugar', 'thyme', 'tofu', 'tomato', 'vanilla', 'walnut',
+    'yogurt', 'zucchini',
+]
+FORMS = ['', 'chopped', 'dried', 'fresh', 'frozen', 'ground', 'smoked', 'toasted', 'whole']
+VERBS = [
+    'add', 'bake', 'beat', 'blend', 'boil', 'chill', 'chop', 'combine',
+    'drain', 'fold', 'fry', 'garnish', 'mix', 'pour', 'roast', 'season',
+    'serve', 'simmer', 'slice', 'stir', 'toss', 'whisk',
+]
+QUANTITIES = [None, None, '1 cup', '2 cups', '1 tbsp', '2 tbsp', '1 tsp', '1/2 tsp', '1 lb', 'pinch']
+
+# Top-level tag names; each gets children and grandchildren below it.
+TAG_ROOTS = ['dairy', 'fruit', 'grain', 'herb', 'meat', 'nut', 'seafood', 'spice', 'sweetener', 'vegetable']
+TAG_CHILDREN = 4
+TAG_GRANDCHILDREN = 3
+
+def zipf_weights(count, exponent=1.07):
+    return [1 / (rank ** exponent) for rank in range(1, count + 1)]
+
+def default_user_count(recipe_count):
+    return max(10, min(20000, recipe_count // 50))
+
+def default_ingredient_count(recipe_count):
+    return max(200, min(len(FOODS) * len(FORMS), int(recipe_count ** 0.5) * 5))
+
+class Corpus:
+    '''
+    The names that were generated, which the benchmarks use to pick
+    realistic arguments.
+    '''
+    def __init__(self, *, seed, recipe_count, usernames, ingredient_names, tag_names):
+        self.seed = seed
+        self.recipe_count = recipe_count
+        self.usernames = usernames
+        self.ingredient_names = ingredient_names
+        self.tag_names = tag_names
+
+    def describe(self):
+        return {
+            'seed': self.seed,
+            'recipes': self.recipe_count,
+            'users': len(self.usernames),
+            'ingredients': len(self.ingredient_names),
+            'ingredient_tags': len(self.tag_names),
+        }
+
+def make_corpus(recipe_count, *, seed=0, user_count=None, ingredient_count=None):
+    '''
+    Return the Corpus for these parameters without touching a database.
+    '''
+    rng = random.Random(seed)
+    if user_count is None:
+        user_count = default_user_count(recipe_count)
+    if ingredient_count is None:
+        ingredient_count = default_ingredient_count(recipe_count)
+
+    usernames = ['user%05d' % index for index in range(user_count)]
+
+    ingredient_names = [
+        ('%s %s' % (form, food)).strip()
+        for (form, food) in itertools.product(FORMS, FOODS)
+    ]
+    rng.shuffle(ingredient_names)
+    ingredient_names = ingredient_names[:ingredient_count]
+
+    tag_names = []
+    for root in TAG_ROOTS:
+        tag_names.append(root)
+        for child in range(TAG_CHILDREN):
+            tag_names.append('%s group %d' % (root, child))
+            for grandchild in range(TAG_GRANDCHILDREN):
+                tag_names.append('%s group %d.%d' % (root, child, grandchild))
+
+    return Corpus(
+        seed=seed,
+        recipe_count=recipe_count,
+        usernames=usernames,
+        ingredient_names=ingredient_names,
+        tag_names=tag_names,
+    )
+
+def _make_sentence(rng, ingredient_names):
+    words = [rng.choice(VERBS), 'the', rng.choice(ingredient_names)]
+    words.extend(rng.choice(FOODS + VERBS + ADJECTIVES) for _ in range(rng.randint(3, 10)))
+    return ' '.join(words).capitalize() + '.'
+
+def generate_recipes(corpus, users, images=()):
+    '''
+    Yield new_recipe keyword dicts for the corpus. `users` is the list of
+    User objects in the same order as corpus.usernames. If `images` are
+    given, each recipe gets one of them.
+    '''
+    rng = random.Random(corpus.seed + 1)
+    ingredient_weights = list(itertools.accumulate(zipf_weights(len(corpus.ingredient_names))))
+    author_weights = list(itertools.accumulate(zipf_weights(len(users), exponent=0.8)))
+
+    for index in range(corpus.recipe_count):
+        ingredient_count = max(2, min(25, int(rng.gauss(9, 3))))
+        picked = rng.choices(corpus.ingredient_names, cum_weights=ingredient_weights, k=ingredient_count)
+        ingredients = [(name, rng.choice(QUANTITIES)) for name in dict.fromkeys(picked)]
+        name = '%s %s %s' % (rng.choice(ADJECTIVES), picked[0], rng.choice(DISHES))
+        instructions = '\n\n'.join(
+            _make_sentence(rng, picked) for _ in range(rng.randint(3, 8))
+        )
+        yield {
+            'author': rng.choices(users, cum_weights=author_weights)[0],
+            'blurb': _make_sentence(rng, picked),
+            'country_of_origin': rng.choice(COUNTRIES),
+            'cuisine': rng.choice(CUISINES),
+            'ingredients': ingredients,
+            'instructions': instructions,
+            'meal_type': rng.choice(MEAL_TYPES),
+            'name': name.title(),
+            'prep_time': rng.randint(5, 240),
+            'serving_size': rng.randint(1, 12),
+            'recipe_image': rng.choice(images) if images else None,
+        }
+
+def populate(rdb, corpus, *, chunk_size=1000, image_filepaths=()):
+    '''
+    Fill an empty RecipeDB with the corpus. The files in image_filepaths
+    are imported and shared out among the recipes.
+    '''
+    rng = random.Random(corpus.seed + 2)
+
+    # bcrypt is deliberately slow, so every user shares one hash instead of
+    # spending minutes in new_user.
+    password_hash = bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt())
+    user_datas = [
+        {
+            'UserID': helpers.random_hex(),
+            'Username': username,
+            'DisplayName': username.title(),
+            'PasswordHash': password_hash,
+            'BioText': 'A synthetic user for benchmarking.',
+            'DateJoined': helpers.now(),
+            'ProfileImageID': None,
+        }
+        for username in corpus.usernames
+    ]
+    with rdb.transaction():
+        rdb.insert_many('User', constants.SQL_USER_COLUMNS, user_datas)
+    users = [rdb.get_user(id=data['UserID']) for data in user_datas]
+
+    with rdb.transaction():
+        tags = {}
+        for name in corpus.tag_names:
+            if ' group ' not in name:
+                parent = None
+            else:
+                parent = tags[name.rsplit('.', 1)[0] if '.' in name else name.split(' group ')[0]]
+            tags[name] = rdb.new_ingredient_tag(name, parent=parent)
+
+        leaf_tags = [tag for (name, tag) in tags.items() if '.' in name]
+        ingredients = rdb.get_or_create_ingredients(corpus.ingredient_names)
+        for ingredient in ingredients.values():
+            for tag in rng.sample(leaf_tags, rng.randint(1, 2)):
+                ingredient.add_tag(tag)
+
+    images = [rdb.new_image(filepath) for filepath in image_filepaths]
+    rdb.new_recipes_bulk(generate_recipes(corpus, users, images), chunk_size=chunk_size)
+    # So that the measurements don't share the machine with the resizing.
+    rdb.wait_for_ingest()
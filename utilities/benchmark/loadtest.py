@@ -0,0 +1,427 @@
+'''
+Load test the Flask frontend against a synthetic corpus, reporting latency
+percentiles, requests per second and SQL statements per request for each
+route.
+
+By default requests go through Flask's test client in this process, which
+measures the application without any network in the way:
+
+    python loadtest.py --recipes 10000 --concurrency 8 --requests 2000
+
+With --gevent the site is served by gevent's WSGIServer on localhost, the
+same way onthehouse_flask_launch.py serves it, and the workers are
+greenlets making real HTTP requests:
+
+    python loadtest.py --gevent --concurrency 50 --requests 5000
+
+The mix of routes is given as name=weight pairs:
+
+    python loadtest.py --mix recipe=5,search=2,login=0
+'''
+import sys
+
+# Monkeypatching has to happen before anything else imports socket or
+# threading, so it can't wait for argparse.
+if '--gevent' in sys.argv[1:]:
+    import gevent.monkey
+    gevent.monkey.patch_all()
+
+import argparse
+import bisect
+import http.client
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+import recipedb
+
+import benchmark
+import corpus as corpus_module
+
+ROOT_DIR = os.path.dirname(os.path.dirname(benchmark.BENCHMARK_DIR))
+FRONTEND_DIR = os.path.join(ROOT_DIR, 'frontends', 'onthehouse_flask')
+SAMPLE_IMAGES_DIR = os.path.join(ROOT_DIR, 'utilities', 'samplerecipes', 'sample_images')
+
+DEFAULT_MIX = {
+    'recipe_list': 20,
+    'recipe': 30,
+    'search': 20,
+    'user': 10,
+    'image': 15,
+    'login': 5,
+}
+
+# Upper bounds of the latency histogram buckets, in milliseconds.
+HISTOGRAM_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+ROUTE_HEADER = 'X-Loadtest-Route'
+SQL_COUNT_HEADER = 'X-Loadtest-SQL'
+
+class SQLCounter:
+    '''
+    Counts the statements each request runs, using a trace callback on every
+    RecipeDB connection, and reports the count in a response header.
+    '''
+    def __init__(self):
+        # Under gevent's monkeypatching this is greenlet-local, which is
+        # what we want since each request has its own greenlet.
+        self.local = threading.local()
+
+    def install(self, rdb, site):
+        rdb._connections.add_connect_hook(lambda connection: connection.set_trace_callback(self.trace))
+        site.wsgi_app = self.wrap(site.wsgi_app)
+
+    def trace(self, statement):
+        # Statements run internally by triggers and virtual tables such as
+        # FTS5 are reported with a leading comment. They aren't queries the
+        # application chose to make, so they don't count.
+        if statement.startswith('--'):
+            return
+        self.local.count = getattr(self.local, 'count', 0) + 1
+
+    def wrap(self, app):
+        def middleware(environ, start_response):
+            self.local.count = 0
+            def counting_start_response(status, headers, *args):
+                # Flask calls start_response once the view has finished, so
+                # the count is complete by now.
+                headers.append((SQL_COUNT_HEADER, str(self.local.count)))
+                return start_response(status, headers, *args)
+            return app(environ, counting_start_response)
+        return middleware
+
+class RouteStats:
+    def __init__(self):
+        self.timings = []
+        self.sql_counts = []
+        self.statuses = {}
+        self.errors = 0
+
+    def add(self, elapsed, status, sql_count):
+        self.timings.append(elapsed)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if status is None or status >= 400:
+            self.errors += 1
+        if sql_count is not None:
+            self.sql_counts.append(sql_count)
+
+    def summarize(self, duration):
+        timings = sorted(self.timings)
+        histogram = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        for elapsed in timings:
+            histogram[bisect.bisect_left(HISTOGRAM_BUCKETS, elapsed * 1000)] += 1
+        labels = ['<=%dms' % bucket for bucket in HISTOGRAM_BUCKETS] + ['>%dms' % HISTOGRAM_BUCKETS[-1]]
+
+        return {
+            'requests': len(timings),
+            'errors': self.errors,
+            'statuses': {str(status): count for (status, count) in sorted(self.statuses.items(), key=str)},
+            'rps': (len(timings) / duration) if duration else None,
+            'mean': (sum(timings) / len(timings)) if timings else None,
+            'p50': percentile(timings, 0.50),
+            'p95': percentile(timings, 0.95),
+            'p99': percentile(timings, 0.99),
+            'max': timings[-1] if timings else None,
+            'sql_per_request': (sum(self.sql_counts) / len(self.sql_counts)) if self.sql_counts else None,
+            'sql_max': max(self.sql_counts) if self.sql_counts else None,
+            'histogram': dict(zip(labels, histogram)),
+        }
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+def parse_mix(mix_string):
+    mix = dict(DEFAULT_MIX)
+    if not mix_string:
+        return mix
+    for pair in mix_string.split(','):
+        (name, weight) = pair.split('=')
+        name = name.strip()
+        if name not in DEFAULT_MIX:
+            raise ValueError('Unknown route %s, expected one of %s' % (name, ', '.join(DEFAULT_MIX)))
+        mix[name] = float(weight)
+    mix = {name: weight for (name, weight) in mix.items() if weight > 0}
+    if not mix:
+        raise ValueError('The mix needs at least one route with a positive weight.')
+    return mix
+
+class RequestMaker:
+    '''
+    Picks routes according to the mix and builds realistic arguments for
+    them from the data in the database.
+    '''
+    def __init__(self, rdb, corpus, mix):
+        self.corpus = corpus
+        self.routes = list(mix.keys())
+        self.cum_weights = list(itertools.accumulate(mix.values()))
+
+        cur = rdb.sql.cursor()
+        cur.execute('SELECT RecipeID FROM Recipe')
+        self.recipe_ids = [row[0] for row in cur.fetchall()]
+        cur.execute('SELECT ImageID FROM Image')
+        self.image_ids = [row[0] for row in cur.fetchall()]
+        rdb.release_connection()
+
+        if 'image' in mix and not self.image_ids:
+            raise ValueError('The dataset has no images, take "image" out of the mix.')
+
+    def make(self, rng):
+        '''
+        Return (route, method, path, form) for a randomly chosen route.
+        '''
+        route = rng.choices(self.routes, cum_weights=self.cum_weights)[0]
+        form = None
+        method = 'GET'
+        if route == 'recipe_list':
+            path = '/recipe'
+        elif route == 'recipe':
+            path = '/recipe/%s' % rng.choice(self.recipe_ids)
+        elif route == 'search':
+            params = {'ingredients': ','.join(rng.sample(self.corpus.ingredient_names[:50], 2))}
+            if rng.random() < 0.5:
+                params['q'] = rng.choice(corpus_module.FOODS)
+            if rng.random() < 0.3:
+                params['meal_type'] = rng.choice(corpus_module.MEAL_TYPES)
+            path = '/recipe/search?' + urllib.parse.urlencode(params)
+        elif route == 'user':
+            path = '/user/%s' % rng.choice(self.corpus.usernames)
+        elif route == 'image':
+            path = '/image/%s' % rng.choice(self.image_ids)
+        elif route == 'login':
+            method = 'POST'
+            path = '/login'
+            form = {'username': rng.choice(self.corpus.usernames), 'password': corpus_module.PASSWORD}
+        return (route, method, path, form)
+
+class TestClientTransport:
+    '''
+    Sends requests straight into the WSGI app with Flask's test client.
+    '''
+    def __init__(self, site):
+        self.site = site
+
+    def session(self):
+        client = self.site.test_client()
+        def send(route, method, path, form):
+            response = client.open(path, method=method, data=form, headers={ROUTE_HEADER: route})
+            response.get_data()
+            sql_count = response.headers.get(SQL_COUNT_HEADER)
+            response.close()
+            return (response.status_code, int(sql_count) if sql_count else None)
+        return send
+
+class HTTPTransport:
+    '''
+    Sends requests over keep-alive HTTP connections to a running server.
+    '''
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    def session(self):
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        def send(route, method, path, form):
+            headers = {ROUTE_HEADER: route}
+            body = None
+            if form is not None:
+                body = urllib.parse.urlencode(form)
+                headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                return (None, None)
+            sql_count = response.getheader(SQL_COUNT_HEADER)
+            return (response.status, int(sql_count) if sql_count else None)
+        return send
+
+def run_load(transport, request_maker, *, total_requests, concurrency, seed):
+    '''
+    Send `total_requests` requests from `concurrency` workers and return
+    ({route: RouteStats}, duration).
+    '''
+    stats = {route: RouteStats() for route in request_maker.routes}
+    remaining = iter(range(total_requests))
+    remaining_lock = threading.Lock()
+
+    def worker(worker_index):
+        rng = random.Random(seed * 1000 + worker_index)
+        send = transport.session()
+        while True:
+            with remaining_lock:
+                if next(remaining, None) is None:
+                    return
+            (route, method, path, form) = request_maker.make(rng)
+            start = time.perf_counter()
+            (status, sql_count) = send(route, method, path, form)
+            elapsed = time.perf_counter() - start
+            stats[route].add(elapsed, status, sql_count)
+
+    workers = [threading.Thread(target=worker, args=[index], daemon=True) for index in range(concurrency)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return (stats, time.perf_counter() - start)
+
+def open_site(data_directory, corpus, fresh):
+    '''
+    Generate the dataset if needed, then import the frontend so that its
+    RecipeDB opens the dataset.
+    '''
+    # Every recipe gets one of the sample images so /image has something
+    # to serve.
+    image_filepaths = sorted(
+        os.path.join(SAMPLE_IMAGES_DIR, name) for name in os.listdir(SAMPLE_IMAGES_DIR)
+    )
+    recipedb_directory = os.path.join(data_directory, '_recipedb')
+    rdb = benchmark.open_dataset(recipedb_directory, corpus, fresh=fresh, image_filepaths=image_filepaths)
+    rdb._connections.close()
+    os.makedirs(data_directory, exist_ok=True)
+
+    # The frontend opens recipedb.constants.DEFAULT_DATADIR relative to the
+    # working directory when it is imported.
+    os.chdir(data_directory)
+    sys.path.insert(0, FRONTEND_DIR)
+    import onthehouse_flask
+    onthehouse_flask.site.debug = False
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    return (onthehouse_flask.site, onthehouse_flask.endpoints.common.rdb)
+
+def serve_gevent(site):
+    import gevent.pywsgi
+    import onthehouse_flask.gevent_sendfile
+    server = gevent.pywsgi.WSGIServer(
+        listener=('127.0.0.1', 0),
+        application=site,
+        handler_class=onthehouse_flask.gevent_sendfile.SendfileWSGIHandler,
+        log=None,
+    )
+    server.start()
+    return server
+
+def print_report(summaries, duration):
+    print()
+    print('%-12s %8s %6s %9s %9s %9s %9s %7s' % (
+        'route', 'requests', 'errors', 'req/sec', 'p50 ms', 'p95 ms', 'p99 ms', 'sql/req'
+    ))
+    for (route, summary) in summaries.items():
+        if not summary['requests']:
+            continue
+        print('%-12s %8d %6d %9.1f %9.2f %9.2f %9.2f %7s' % (
+            route,
+            summary['requests'],
+            summary['errors'],
+            summary['rps'],
+            summary['p50'] * 1000,
+            summary['p95'] * 1000,
+            summary['p99'] * 1000,
+            '%.1f' % summary['sql_per_request'] if summary['sql_per_request'] is not None else '-',
+        ))
+    total = sum(summary['requests'] for summary in summaries.values())
+    print('%-12s %8d %6s %9.1f' % ('total', total, '', total / duration if duration else 0))
+
+    print()
+    print('Latency histogram')
+    for (route, summary) in summaries.items():
+        if not summary['requests']:
+            continue
+        buckets = ' '.join('%s:%d' % item for item in summary['histogram'].items() if item[1])
+        print('%-12s %s' % (route, buckets))
+
+def loadtest_argparse(args):
+    if args.recipes in benchmark.PRESETS:
+        recipe_count = benchmark.PRESETS[args.recipes]
+    else:
+        recipe_count = int(args.recipes)
+
+    mix = parse_mix(args.mix)
+    corpus = corpus_module.make_corpus(recipe_count, seed=args.seed)
+    data_directory = os.path.abspath(
+        args.data_directory or benchmark.default_data_directory('loadtest', recipe_count, args.seed)
+    )
+    (site, rdb) = open_site(data_directory, corpus, args.fresh)
+    rdb.log.setLevel(logging.WARNING)
+
+    counter = SQLCounter()
+    counter.install(rdb, site)
+    request_maker = RequestMaker(rdb, corpus, mix)
+
+    server = None
+    if args.gevent:
+        server = serve_gevent(site)
+        transport = HTTPTransport('127.0.0.1', server.server_port)
+        print('Serving on 127.0.0.1:%d with gevent' % server.server_port)
+    else:
+        transport = TestClientTransport(site)
+
+    if args.warmup:
+        run_load(transport, request_maker, total_requests=args.warmup, concurrency=args.concurrency, seed=args.seed + 1)
+
+    print('Sending %d requests from %d workers' % (args.requests, args.concurrency))
+    (stats, duration) = run_load(
+        transport,
+        request_maker,
+        total_requests=args.requests,
+        concurrency=args.concurrency,
+        seed=args.seed,
+    )
+    if server is not None:
+        server.stop()
+
+    summaries = {route: route_stats.summarize(duration) for (route, route_stats) in stats.items()}
+    print_report(summaries, duration)
+
+    if args.output:
+        output = {
+            'meta': {
+                'revision': benchmark.git_revision(),
+                'timestamp': time.time(),
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'platform': platform.platform(),
+                'transport': 'gevent' if args.gevent else 'test_client',
+                'concurrency': args.concurrency,
+                'requests': args.requests,
+                'duration': duration,
+                'mix': mix,
+                'corpus': corpus.describe(),
+            },
+            'results': summaries,
+        }
+        with open(args.output, 'w') as handle:
+            json.dump(output, handle, indent=4, sort_keys=True)
+        print('Wrote %s' % args.output)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--recipes', default='1k', help='1k, 100k, 1m, or any number.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--warmup', type=int, default=50, help='Requests to send before measuring.')
+    parser.add_argument('--mix', default=None, help='Route weights, like recipe=5,search=2,login=0.')
+    parser.add_argument('--gevent', action='store_true', help='Serve over HTTP with gevent.')
+    parser.add_argument('--data_directory', '--data-directory', dest='data_directory', default=None)
+    parser.add_argument('--fresh', action='store_true', help='Regenerate the corpus even if it exists.')
+    parser.add_argument('--output', default=None, help='Write the results to this JSON file.')
+    parser.set_defaults(func=loadtest_argparse)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == '__main__':
+    raise SystemExit(main(sys.argv[1:]))
@@ -1,26 +1,442 @@
 import argparse
+import contextlib
 import os
 import sqlite3
 import sys
+import time
 
 import recipedb
 
-def upgrade_1_to_2(sql):
+# Each version's upgrade is a list of steps, registered in order with @step.
+# A plain step runs as a single transaction. A batched step is called over
+# and over with the rowid it stopped at, each batch in its own transaction,
+# until it reports that there are no rows left.
+#
+# The position of the upgrade is written to the UpgradeCheckpoint table in
+# the same transaction as the work it describes, so an upgrade which is
+# interrupted or crashes picks up where it left off the next time it runs.
+STEPS = {}
+
+DEFAULT_BATCH_SIZE = 1000
+
+# Used by --dry-run when a step doesn't declare its own rate.
+DEFAULT_ROWS_PER_SECOND = 100000
+
+# Minimum number of seconds between progress lines for batched steps.
+PROGRESS_INTERVAL = 1
+
+CHECKPOINT_TABLE = '''
+CREATE TABLE IF NOT EXISTS UpgradeCheckpoint(
+    Version INT PRIMARY KEY,
+    StepIndex INT,
+    LastRowID INT,
+    RowsDone INT
+)
+'''
+
+class Step:
+    def __init__(self, function, *, table, batched, rows_per_second):
+        self.function = function
+        self.name = function.__name__
+        self.table = table
+        self.batched = batched
+        self.rows_per_second = rows_per_second
+
+def step(version, *, table=None, batched=False, rows_per_second=DEFAULT_ROWS_PER_SECOND):
     '''
-    docstring
+    Register the decorated function as the next step of the upgrade to
+    `version`.
+
+    table: The table whose size determines how long the step takes, used
+    for progress and for --dry-run estimates.
+
+    batched: If False, the function is called as function(sql). If True, it
+    is called as function(sql, after_rowid, batch_size), must process at
+    most batch_size rows of `table` with a rowid greater than after_rowid,
+    and return (last_rowid, row_count). A row_count of 0 ends the step.
     '''
-    pass
+    def wrapper(function):
+        STEPS.setdefault(version, []).append(Step(
+            function,
+            table=table,
+            batched=batched,
+            rows_per_second=rows_per_second,
+        ))
+        return function
+    return wrapper
 
+################################################################################
 
-def upgrade_all(database_filename):
+@step(2, table='IngredientTag')
+def create_ingredient_tag_closure(sql):
     '''
-    Given the filename of a phototagger database, apply all of the needed
-    upgrade_x_to_y functions in order.
+    In this version, the IngredientTag_Closure table was added so that the
+    full ancestry or descendancy of a tag can be read with one query instead
+    of walking ParentTagID one level at a time.
+    '''
+    cur = sql.cursor()
+    cur.execute('''
+    CREATE TABLE IngredientTag_Closure(
+        AncestorID TEXT,
+        DescendantID TEXT,
+        Depth INT,
+        FOREIGN KEY(AncestorID) REFERENCES IngredientTag(IngredientTagID),
+        FOREIGN KEY(DescendantID) REFERENCES IngredientTag(IngredientTagID)
+    )
+    ''')
+    cur.execute('''
+    INSERT INTO IngredientTag_Closure
+    WITH RECURSIVE closure(AncestorID, DescendantID, Depth) AS (
+        SELECT IngredientTagID, IngredientTagID, 0 FROM IngredientTag
+        UNION ALL
+        SELECT IngredientTag.ParentTagID, closure.DescendantID, closure.Depth + 1
+        FROM closure
+        INNER JOIN IngredientTag ON IngredientTag.IngredientTagID = closure.AncestorID
+        WHERE IngredientTag.ParentTagID IS NOT NULL
+    )
+    SELECT AncestorID, DescendantID, Depth FROM closure
+    ''')
+    cur.execute('CREATE INDEX index_IngredientTagClosure_AncestorID on IngredientTag_Closure(AncestorID, DescendantID)')
+    cur.execute('CREATE INDEX index_IngredientTagClosure_DescendantID on IngredientTag_Closure(DescendantID, AncestorID)')
+
+@step(2, table='Ingredient_IngredientTag_Map', rows_per_second=500000)
+def index_ingredient_tag_map(sql):
+    cur = sql.cursor()
+    cur.execute('CREATE INDEX IF NOT EXISTS index_IngredientIngredientTagMap_IngredientTagID on Ingredient_IngredientTag_Map(IngredientTagID)')
+
+@step(3, table='Recipe', rows_per_second=500000)
+def index_recipe_date_added(sql):
+    '''
+    In this version, an index on Recipe(DateAdded, RecipeID) was added for
+    the keyset pagination of recipe listings.
+    '''
+    cur = sql.cursor()
+    cur.execute('CREATE INDEX IF NOT EXISTS index_Recipe_DateAdded on Recipe(DateAdded, RecipeID)')
+
+@step(4)
+def create_recipe_fts(sql):
+    '''
+    In this version, the Recipe_FTS full-text index was added over the name,
+    blurb and instructions of each recipe, along with the triggers that keep
+    it in sync.
+    '''
+    cur = sql.cursor()
+    cur.execute('''
+    CREATE VIRTUAL TABLE Recipe_FTS USING fts5(
+        RecipeID UNINDEXED,
+        Name,
+        Blurb,
+        Instructions,
+        tokenize='porter unicode61'
+    )
+    ''')
+
+@step(4, table='Recipe', batched=True, rows_per_second=50000)
+def populate_recipe_fts(sql, after_rowid, batch_size):
+    cur = sql.cursor()
+    cur.execute(
+        'SELECT rowid, RecipeID, Name, Blurb, Instructions FROM Recipe WHERE rowid > ? ORDER BY rowid LIMIT ?',
+        [after_rowid, batch_size]
+    )
+    rows = cur.fetchall()
+    cur.executemany(
+        'INSERT INTO Recipe_FTS(RecipeID, Name, Blurb, Instructions) VALUES(?, ?, ?, ?)',
+        [row[1:] for row in rows]
+    )
+    if not rows:
+        return (after_rowid, 0)
+    return (rows[-1][0], len(rows))
+
+@step(4)
+def create_recipe_fts_triggers(sql):
+    cur = sql.cursor()
+    cur.execute('''
+    CREATE TRIGGER trigger_Recipe_FTS_insert AFTER INSERT ON Recipe
+    BEGIN
+        INSERT INTO Recipe_FTS(RecipeID, Name, Blurb, Instructions)
+        VALUES (new.RecipeID, new.Name, new.Blurb, new.Instructions);
+    END
+    ''')
+    cur.execute('''
+    CREATE TRIGGER trigger_Recipe_FTS_delete AFTER DELETE ON Recipe
+    BEGIN
+        DELETE FROM Recipe_FTS WHERE RecipeID = old.RecipeID;
+    END
+    ''')
+    cur.execute('''
+    CREATE TRIGGER trigger_Recipe_FTS_update AFTER UPDATE OF Name, Blurb, Instructions ON Recipe
+    BEGIN
+        DELETE FROM Recipe_FTS WHERE RecipeID = old.RecipeID;
+        INSERT INTO Recipe_FTS(RecipeID, Name, Blurb, Instructions)
+        VALUES (new.RecipeID, new.Name, new.Blurb, new.Instructions);
+    END
+    ''')
+
+@step(5, table='IngredientTag', rows_per_second=500000)
+def index_ingredient_tag(sql):
+    '''
+    In this version, indexes were added for the structured search filters
+    and the profile page, each ending in (DateAdded, RecipeID) so that the
+    newest-first ordering comes straight from the index, and for looking up
+    tags by name or parent.
+
+    The database is in WAL mode, so readers keep working while each index
+    is being built.
+    '''
+    cur = sql.cursor()
+    cur.execute('CREATE INDEX IF NOT EXISTS index_IngredientTag_TagName on IngredientTag(TagName)')
+    cur.execute('CREATE INDEX IF NOT EXISTS index_IngredientTag_ParentTagID on IngredientTag(ParentTagID)')
+
+@step(5, table='Recipe', rows_per_second=500000)
+def index_recipe_author(sql):
+    cur = sql.cursor()
+    cur.execute('CREATE INDEX IF NOT EXISTS index_Recipe_AuthorID on Recipe(AuthorID, DateAdded, RecipeID)')
+
+@step(5, table='Recipe', rows_per_second=500000)
+def index_recipe_country(sql):
+    cur = sql.cursor()
+    cur.execute('CREATE INDEX IF NOT EXISTS index_Recipe_CountryOfOrigin on Recipe(CountryOfOrigin, DateAdded, RecipeID)')
+
+@step(5, table='Recipe', rows_per_second=500000)
+def index_recipe_cuisine(sql):
+    cur = sql.cursor()
+    cur.execute('CREATE INDEX IF NOT EXISTS index_Recipe_Cuisine on Recipe(Cuisine, DateAdded, RecipeID)')
+
+@step(5, table='Recipe', rows_per_second=500000)
+def index_recipe_meal_type(sql):
+    cur = sql.cursor()
+    cur.execute('CREATE INDEX IF NOT EXISTS index_Recipe_MealType on Recipe(MealType, DateAdded, RecipeID)')
+
+@step(6)
+def add_image_content_columns(sql):
+    '''
+    In this version, new images are stored by the sha256 of their content,
+    so that the same file uploaded twice is stored once, and the Image table
+    records each file's hash, size and mimetype.
+
+    Existing files stay where they are, but their hash, size and mimetype are
+    filled in so that they are found when the same file is uploaded again.
+    '''
+    cur = sql.cursor()
+    cur.execute('ALTER TABLE Image ADD COLUMN Hash TEXT')
+    cur.execute('ALTER TABLE Image ADD COLUMN ByteSize INT')
+    cur.execute('ALTER TABLE Image ADD COLUMN MimeType TEXT')
+    cur.execute('CREATE INDEX IF NOT EXISTS index_Image_Hash on Image(Hash)')
+
+@step(6, table='Image', batched=True, rows_per_second=200)
+def hash_existing_images(sql, after_rowid, batch_size):
+    cur = sql.cursor()
+    cur.execute(
+        'SELECT rowid, ImageID, ImageFilePath FROM Image WHERE rowid > ? ORDER BY rowid LIMIT ?',
+        [after_rowid, batch_size]
+    )
+    rows = cur.fetchall()
+    for (rowid, image_id, filepath) in rows:
+        try:
+            (hash, byte_size, mimetype) = recipedb.images.hash_file(filepath)
+        except FileNotFoundError:
+            print('Image %s is missing its file %s.' % (image_id, filepath))
+            continue
+        cur.execute(
+            'UPDATE Image SET Hash = ?, ByteSize = ?, MimeType = ? WHERE ImageID = ?',
+            [hash, byte_size, mimetype, image_id]
+        )
+    if not rows:
+        return (after_rowid, 0)
+    return (rows[-1][0], len(rows))
+
+@step(7, table='Image', rows_per_second=500000)
+def add_image_status(sql):
+    '''
+    In this version, new images are stored and resized in the background,
+    and the Status column says whether that has finished. Existing images
+    were stored when they were added, so they are all ready.
+    '''
+    cur = sql.cursor()
+    cur.execute('ALTER TABLE Image ADD COLUMN Status TEXT')
+    cur.execute('UPDATE Image SET Status = ?', [recipedb.constants.IMAGE_STATUS_READY])
+    cur.execute("CREATE INDEX IF NOT EXISTS index_Image_Processing on Image(ImageID) WHERE Status = 'processing'")
+
+@step(8)
+def add_image_dimension_columns(sql):
+    '''
+    In this version, the width and height of each image are recorded so that
+    pages can reserve its space and offer each rendition in a srcset.
+    '''
+    cur = sql.cursor()
+    cur.execute('ALTER TABLE Image ADD COLUMN Width INT')
+    cur.execute('ALTER TABLE Image ADD COLUMN Height INT')
+
+@step(8, table='Image', batched=True, rows_per_second=5000)
+def read_existing_image_dimensions(sql, after_rowid, batch_size):
+    cur = sql.cursor()
+    cur.execute(
+        'SELECT rowid, ImageID, ImageFilePath FROM Image WHERE rowid > ? ORDER BY rowid LIMIT ?',
+        [after_rowid, batch_size]
+    )
+    rows = cur.fetchall()
+    for (rowid, image_id, filepath) in rows:
+        try:
+            (mimetype, width, height) = recipedb.images.read_image_header(filepath)
+        except FileNotFoundError:
+            print('Image %s is missing its file %s.' % (image_id, filepath))
+            continue
+        cur.execute(
+            'UPDATE Image SET Width = ?, Height = ? WHERE ImageID = ?',
+            [width, height, image_id]
+        )
+    if not rows:
+        return (after_rowid, 0)
+    return (rows[-1][0], len(rows))
+
+@step(9, table='Recipe_Ingredient_Map', rows_per_second=500000)
+def index_recipe_ingredient_postings(sql):
+    '''
+    In this version, both indexes on Recipe_Ingredient_Map carry the other
+    ID as well, so that each ingredient's index entries are the list of
+    recipes that use it, and each recipe's are the list of its ingredients.
+    Search reads the matches and the exclusions from the indexes alone.
+    '''
+    cur = sql.cursor()
+    cur.execute('DROP INDEX IF EXISTS index_RecipeIngredientMap_RecipeID')
+    cur.execute('CREATE INDEX index_RecipeIngredientMap_RecipeID on Recipe_Ingredient_Map(RecipeID, IngredientID)')
+    cur.execute('DROP INDEX IF EXISTS index_RecipeIngredientMap_IngredientID')
+    cur.execute('CREATE INDEX index_RecipeIngredientMap_IngredientID on Recipe_Ingredient_Map(IngredientID, RecipeID)')
+
+################################################################################
+
+@contextlib.contextmanager
+def transaction(sql):
+    sql.execute('BEGIN IMMEDIATE')
+    try:
+        yield
+    except BaseException:
+        sql.execute('ROLLBACK')
+        raise
+    sql.execute('COMMIT')
+
+def count_rows(sql, table):
+    if table is None:
+        return 0
+    try:
+        return sql.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+
+def format_seconds(seconds):
+    (minutes, seconds) = divmod(round(seconds), 60)
+    (hours, minutes) = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+def save_checkpoint(sql, version, step_index, last_rowid, rows_done):
+    sql.execute(
+        'INSERT OR REPLACE INTO UpgradeCheckpoint VALUES(?, ?, ?, ?)',
+        [version, step_index, last_rowid, rows_done]
+    )
+
+def run_batched_step(sql, version, step_index, step, last_rowid, rows_done, batch_size):
+    total = count_rows(sql, step.table)
+    start_time = time.perf_counter()
+    last_print = start_time
+    rows_this_run = 0
+    while True:
+        with transaction(sql):
+            (new_last_rowid, row_count) = step.function(sql, last_rowid, batch_size)
+            if row_count == 0:
+                save_checkpoint(sql, version, step_index + 1, 0, 0)
+            else:
+                save_checkpoint(sql, version, step_index, new_last_rowid, rows_done + row_count)
+
+        if row_count == 0:
+            break
+
+        last_rowid = new_last_rowid
+        rows_done += row_count
+        rows_this_run += row_count
+        now = time.perf_counter()
+        if now - last_print >= PROGRESS_INTERVAL:
+            rate = rows_this_run / (now - start_time)
+            percent = (100 * rows_done / total) if total else 100
+            print('    %s: %d / %d rows (%.1f%%), %d rows/sec' % (step.name, rows_done, total, percent, rate))
+            last_print = now
+
+    elapsed = time.perf_counter() - start_time
+    rate = (rows_this_run / elapsed) if elapsed else 0
+    print('    %s: %d rows in %s, %d rows/sec' % (step.name, rows_done, format_seconds(elapsed), rate))
+
+def upgrade_version(sql, version, batch_size):
+    '''
+    Run the steps of one version's upgrade, starting from the checkpoint if
+    a previous run was interrupted, and then set the user_version.
+    '''
+    row = sql.execute(
+        'SELECT StepIndex, LastRowID, RowsDone FROM UpgradeCheckpoint WHERE Version = ?',
+        [version]
+    ).fetchone()
+    if row is None:
+        (resume_index, resume_rowid, resume_rows_done) = (0, 0, 0)
+    else:
+        (resume_index, resume_rowid, resume_rows_done) = row
+        print('    Resuming at step %d after %d rows.' % (resume_index + 1, resume_rows_done))
+
+    for (step_index, step) in enumerate(STEPS.get(version, [])):
+        if step_index < resume_index:
+            continue
+
+        if step.batched:
+            if step_index == resume_index:
+                (last_rowid, rows_done) = (resume_rowid, resume_rows_done)
+            else:
+                (last_rowid, rows_done) = (0, 0)
+            run_batched_step(sql, version, step_index, step, last_rowid, rows_done, batch_size)
+            continue
+
+        rows = count_rows(sql, step.table)
+        start_time = time.perf_counter()
+        with transaction(sql):
+            step.function(sql)
+            save_checkpoint(sql, version, step_index + 1, 0, 0)
+        elapsed = time.perf_counter() - start_time
+        if step.table is None:
+            print('    %s: done in %s' % (step.name, format_seconds(elapsed)))
+        else:
+            rate = (rows / elapsed) if elapsed else 0
+            print('    %s: %d rows in %s, %d rows/sec' % (step.name, rows, format_seconds(elapsed), rate))
+
+    with transaction(sql):
+        sql.execute('PRAGMA user_version = %d' % version)
+        sql.execute('DELETE FROM UpgradeCheckpoint WHERE Version = ?', [version])
+
+def estimate_upgrades(sql, current_version, needed_version):
+    '''
+    Print each pending step with the size of the table it works on and a
+    rough runtime, without changing the database.
+    '''
+    total_seconds = 0
+    for version in range(current_version + 1, needed_version + 1):
+        print('Upgrade from %d to %d' % (version - 1, version))
+        for step in STEPS.get(version, []):
+            if step.table is None:
+                print('    %s' % step.name)
+                continue
+            rows = count_rows(sql, step.table)
+            seconds = rows / step.rows_per_second
+            total_seconds += seconds
+            print('    %s: %d rows, about %s' % (step.name, rows, format_seconds(seconds)))
+    print('Estimated total: %s' % format_seconds(total_seconds))
+
+def upgrade_all(database_filename, *, batch_size=DEFAULT_BATCH_SIZE, dry_run=False):
+    '''
+    Given the filename of a recipedb database, apply all of the needed
+    upgrade steps in order.
     '''
     if not os.path.isfile(database_filename):
         raise FileNotFoundError(database_filename)
 
-    sql = sqlite3.connect(database_filename)
+    # Transactions are managed explicitly so that each step or batch commits
+    # together with its checkpoint.
+    sql = sqlite3.connect(database_filename, isolation_level=None)
+    sql.execute('PRAGMA busy_timeout = 5000')
     cur = sql.cursor()
 
     cur.execute('PRAGMA user_version')
@@ -31,28 +447,39 @@ def upgrade_all(database_filename):
         print('Already up-to-date with version %d.' % needed_version)
         return
 
-    for version_number in range(current_version + 1, needed_version + 1):
-        print('Upgrading from %d to %d' % (current_version, version_number))
-        upgrade_function = 'upgrade_%d_to_%d' % (current_version, version_number)
-        upgrade_function = eval(upgrade_function)
-        upgrade_function(sql)
-        sql.cursor().execute('PRAGMA user_version = %d' % version_number)
-        sql.commit()
-        current_version = version_number
+    if dry_run:
+        estimate_upgrades(sql, current_version, needed_version)
+        return
+
+    sql.execute(CHECKPOINT_TABLE)
+    for version in range(current_version + 1, needed_version + 1):
+        print('Upgrading from %d to %d' % (version - 1, version))
+        upgrade_version(sql, version, batch_size)
+    sql.execute('DROP TABLE UpgradeCheckpoint')
     print('Upgrades finished.')
 
 
 def upgrade_all_argparse(args):
-    return upgrade_all(database_filename=args.database_filename)
+    try:
+        return upgrade_all(
+            database_filename=args.database_filename,
+            batch_size=args.batch_size,
+            dry_run=args.dry_run,
+        )
+    except KeyboardInterrupt:
+        print('Interrupted. Run the upgrader again to resume.')
+        return 1
 
 def main(argv):
     parser = argparse.ArgumentParser()
 
     parser.add_argument('database_filename')
+    parser.add_argument('--batch_size', '--batch-size', dest='batch_size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--dry_run', '--dry-run', dest='dry_run', action='store_true')
     parser.set_defaults(func=upgrade_all_argparse)
 
     args = parser.parse_args(argv)
-    args.func(args)
+    return args.func(args)
 
 if __name__ == '__main__':
-    main(sys.argv[1:])
+    raise SystemExit(main(sys.argv[1:]))
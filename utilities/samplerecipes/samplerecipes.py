@@ -1,3 +1,6 @@
+import json
+import sys
+
 import recipedb
 
 from voussoirkit import pathclass
@@ -46,11 +49,14 @@ ingredient_tags = {
     ]
 }
 
-for (tag_name, ingredient_names) in ingredient_tags.items():
-    tag = rdb.get_or_create_ingredient_tag(name=tag_name)
-    for ingredient_name in ingredient_names:
-        ingredient = rdb.get_or_create_ingredient(name=ingredient_name)
-        ingredient.add_tag(tag)
+with rdb.transaction():
+    for (tag_name, ingredient_names) in ingredient_tags.items():
+        tag = rdb.get_or_create_ingredient_tag(name=tag_name)
+        for ingredient_name in ingredient_names:
+            ingredient = rdb.get_or_create_ingredient(name=ingredient_name)
+            ingredient.add_tag(tag)
+
+sample_recipes = []
 
 # 1
 instructions = '''
@@ -70,7 +76,7 @@ cheese mixture. Chill 6 to 24 hours.
 To serve, unmold on plate. Remove plastic wrap. Garnish with fresh basil, if
 desired. Serve with crackers.
 '''
-rdb.new_recipe(
+sample_recipes.append(dict(
     author=angela,
     blurb="This spread goes well with crackers or slided French bread.",
     country_of_origin="Unknown",
@@ -92,7 +98,7 @@ rdb.new_recipe(
     prep_time=10,
     serving_size=24,
     recipe_image=rdb.new_image(image_dir.with_child('cheese_pesto.jpg')),
-)
+))
 
 # 2
 blurb = '''
@@ -116,7 +122,7 @@ Place cooked vegetable mixture over half of omelet; top with cheese. With
 spatula, fold other half of omelet over vegetables. Gently slide out of pan onto
 plate. Serve immediately.
 '''
-rdb.new_recipe(
+sample_recipes.append(dict(
     author=bob,
     blurb=blurb,
     country_of_origin="Unknown",
@@ -139,7 +145,7 @@ rdb.new_recipe(
     prep_time=15,
     serving_size=1,
     recipe_image=rdb.new_image(image_dir.with_child('veggie_stuffed_omelette.jpg')),
-)
+))
 
 # 3
 blurb = '''
@@ -165,7 +171,7 @@ Recipe makes 2 (12 inch) pizzas. Divide dough in half, and spread onto pizza
 pans. Cover with sauce, and desired toppings. Bake at 400 degrees for 20
 minutes, or until crust is golden brown.
 '''
-rdb.new_recipe(
+sample_recipes.append(dict(
     author=caitlyn,
     blurb=blurb,
     country_of_origin="Unknown",
@@ -195,7 +201,7 @@ rdb.new_recipe(
     prep_time=90,
     serving_size=8,
     recipe_image=rdb.new_image(image_dir.with_child('homemade_pizza.jpg')),
-)
+))
 
 # 4
 instructions = '''
@@ -230,7 +236,7 @@ When the churros are just cool enough to handle, roll them in the cinnamon-sugar
 Pour the chocolate into individual bowls or cups. Serve the warm churros with
 the chocolate dip.
 '''
-rdb.new_recipe(
+sample_recipes.append(dict(
     author=angela,
     blurb="Recipe courtesy of Chocolateria San Gines",
     country_of_origin="Unknown",
@@ -254,7 +260,7 @@ rdb.new_recipe(
     prep_time=40,
     serving_size=10,
     recipe_image=rdb.new_image(image_dir.with_child('churro.jpg')),
-)
+))
 
 # 5
 instructions = '''
@@ -286,7 +292,7 @@ paddle. Sprinkle the rice with the vinegar, sugar, and salt while mixing with a
 spatula or rice paddle until the rice reaches body temperature. Keep the rice
 covered with damp paper towels or napkin until the rice is ready to use.
 '''
-rdb.new_recipe(
+sample_recipes.append(dict(
     author=bob,
     blurb="Recipe courtesy of Jill Davie",
     country_of_origin="Unknown",
@@ -310,7 +316,7 @@ rdb.new_recipe(
     prep_time=55,
     serving_size=30,
     recipe_image=rdb.new_image(image_dir.with_child('sushi.jpg')),
-)
+))
 
 # 6
 instructions = '''
@@ -342,7 +348,7 @@ paddle. Sprinkle the rice with the vinegar, sugar, and salt while mixing with a
 spatula or rice paddle until the rice reaches body temperature. Keep the rice
 covered with damp paper towels or napkin until the rice is ready to use.
 '''
-rdb.new_recipe(
+sample_recipes.append(dict(
     author=caitlyn,
     blurb="Recipe courtesy of Jill Davie",
     country_of_origin="Unknown",
@@ -366,7 +372,7 @@ rdb.new_recipe(
     prep_time=55,
     serving_size=30,
     recipe_image=rdb.new_image(image_dir.with_child('sushi_roll.jpg')),
-)
+))
 
 # 7
 blurb = '''
@@ -394,7 +400,7 @@ release excess pressure.
 Once the sauerkraut is finished, put a tight lid on the jar and move to cold
 storage. The sauerkraut's flavor will continue to develop as it ages.
 '''
-rdb.new_recipe(
+sample_recipes.append(dict(
     author=angela,
     blurb=blurb,
     country_of_origin="Unknown",
@@ -409,7 +415,7 @@ rdb.new_recipe(
     prep_time=10,
     serving_size=8,
     recipe_image=rdb.new_image(image_dir.with_child('sauerkraut.jpg')),
-)
+))
 
 # 8
 instructions = '''
@@ -422,7 +428,7 @@ At serving time, in a bowl whip cream and 2 tablespoons sugar till soft peaks
 form. Transfer chilled egg mixture to a punch bowl. Fold in whipped cream
 mixture. Serve at once. Sprinkle each serving with nutmeg.
 '''
-rdb.new_recipe(
+sample_recipes.append(dict(
     author=bob,
     blurb="Always a hit at our annual staff Christmas party.",
     country_of_origin="Unknown",
@@ -444,7 +450,7 @@ rdb.new_recipe(
     prep_time=15,
     serving_size=10,
     recipe_image=rdb.new_image(image_dir.with_child('eggnog.jpg')),
-)
+))
 
 # 9
 instructions = '''
@@ -463,7 +469,7 @@ oven for 40 to 45 minutes or until top springs back when lightly touched.
 Immediately invert cake (leave in pan); cook thoroughly. Loosen sides of cake
 from pan; remove cake.
 '''
-rdb.new_recipe(
+sample_recipes.append(dict(
     author=caitlyn,
     blurb="Eat your cake and diet, too. Angel Cake is low in calories and has no fat.",
     country_of_origin="Unknown",
@@ -482,7 +488,7 @@ rdb.new_recipe(
     prep_time=60,
     serving_size=12,
     recipe_image=rdb.new_image(image_dir.with_child('angel_cake.jpg')),
-)
+))
 
 # 10
 blurb = '''
@@ -497,7 +503,7 @@ Stir diced tomatoes, tomato sauce, and tomato paste into the pan.
 Season with oregano, basil, salt, and pepper. Simmer spaghetti sauce for 1 hour,
 stirring occasionally.
 '''
-rdb.new_recipe(
+sample_recipes.append(dict(
     author=angela,
     blurb=blurb,
     country_of_origin="Unknown",
@@ -521,7 +527,7 @@ rdb.new_recipe(
     prep_time=85,
     serving_size=6,
     recipe_image=rdb.new_image(image_dir.with_child('spaghetti_sauce.jpg')),
-)
+))
 
 # 11
 blurb = '''
@@ -546,7 +552,7 @@ meringue over pie, sealing the edges at the crust.
 
 Bake in preheated oven for 10 minutes, or until meringue is golden brown.
 '''
-rdb.new_recipe(
+sample_recipes.append(dict(
     author=bob,
     blurb=blurb,
     country_of_origin="Unknown",
@@ -569,7 +575,7 @@ rdb.new_recipe(
     prep_time=40,
     serving_size=8,
     recipe_image=rdb.new_image(image_dir.with_child('meringue.jpg')),
-)
+))
 
 # 12
 instructions = '''
@@ -607,7 +613,7 @@ and then return the sandwich packets to the grill over indirect heat for 1 to
 
 Unwrap and serve immediately.
 '''
-rdb.new_recipe(
+sample_recipes.append(dict(
     author=caitlyn,
     blurb="This grilled cheese sandwich recipe actually grills the cheese.",
     country_of_origin="Unknown",
@@ -630,7 +636,7 @@ rdb.new_recipe(
     prep_time=30,
     serving_size=2,
     recipe_image=rdb.new_image(image_dir.with_child('grilled_cheese.jpg')),
-)
+))
 
 # 13
 blurb = '''
@@ -645,7 +651,7 @@ In a small saucepan heat butter and milk over low heat until butter is melted.
 Using a potato masher or electric beater, slowly blend milk mixture into
 potatoes until smooth and creamy. Season with salt and pepper to taste.
 '''
-rdb.new_recipe(
+sample_recipes.append(dict(
     author=angela,
     blurb=blurb,
     country_of_origin="Unknown",
@@ -663,7 +669,7 @@ rdb.new_recipe(
     prep_time=35,
     serving_size=4,
     recipe_image=rdb.new_image(image_dir.with_child('mashed_potatoes.jpg')),
-)
+))
 
 # 14
 instructions = '''
@@ -678,7 +684,7 @@ stir till sauce thickens (1 to 2 minutes). Immediately remove from heat.
 If sauce is too thick or curdles, immediately beat in 1 to 2 tablespoons hot
 tap water. Serve the sauce with cooked vegetables, pultry, fish, or eggs.
 '''
-rdb.new_recipe(
+sample_recipes.append(dict(
     author=bob,
     blurb="A classic creamy sauce with a rich lemon flavor.",
     country_of_origin="Unknown",
@@ -696,4 +702,31 @@ rdb.new_recipe(
     prep_time=20,
     serving_size=8,
     recipe_image=rdb.new_image(image_dir.with_child('hollandaise.jpg')),
-)
+))
+
+rdb.new_recipes_bulk(sample_recipes)
+
+def load_corpus(filepath):
+    '''
+    Yield new_recipe arguments from a file containing one JSON object per
+    line. The author is given by username and the recipe has no image.
+    '''
+    users = {}
+    with open(filepath, 'r', encoding='utf-8') as handle:
+        for line in handle:
+            if not line.strip():
+                continue
+            recipe = json.loads(line)
+            username = recipe.pop('author', None)
+            if username is not None and username not in users:
+                users[username] = rdb.get_user(username=username)
+            recipe['author'] = users.get(username)
+            recipe['recipe_image'] = None
+            yield recipe
+
+# Any extra arguments are paths to larger corpora, which are streamed in.
+for filepath in sys.argv[1:]:
+    rdb.new_recipes_bulk(load_corpus(filepath))
+
+# The images are stored and resized in the background.
+rdb.wait_for_ingest()